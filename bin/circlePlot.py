@@ -3,19 +3,27 @@
 circlePlot.py
     by Sam Ng, Steve Benz, Zack Sanborn, and Evan Paull
 """
-import math, os, sys, re
+import hashlib, itertools, json, math, multiprocessing, os, sys, re, time
 
 import numpy as np
 import pandas
 from matplotlib import *
 use("Agg")
 from pylab import *
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.collections import PolyCollection
+from matplotlib.figure import Figure
+from matplotlib.image import imsave
 
 from optparse import OptionParser
+import iplStore
 
 color_parameters = ["min_color", "zero_color", "max_color", "min_value", "max_value", "boundary_method"]
 tstep = 0.01
 image_format = "png"
+order_cache_file = ".sample_order.json"
+order_cache_size = 16
 
 class RGB:
     """
@@ -92,39 +100,105 @@ def parseColorMap(input_file):
     f.close()
     return(color_map)
 
-def scmp(a, b, feature, ring_list):
+def sampleOrderKeys(samples, feature, order_data):
     """
-    Recursive cmp function for hierarchical sorting [CirclePlot specific]
+    Returns sort keys, most significant first, that order samples by feature in each
+    data set in turn: samples missing from a data set after the others, then by
+    value of the feature (or *), missing values last [CirclePlot specific]
     """
-    ## handle cases in which a sample is not in the sorting dataset
-    if (a not in ring_list[0].columns) and (b in ring_list[0].columns):
-        return(1)
-    elif (a in ring_list[0].columns) and (b not in ring_list[0].columns):
-        return(-1)
-    elif (a not in ring_list[0].columns) and (b not in ring_list[0].columns):
-        if len(ring_list) == 1:
-            return(0)
-        else:
-            return(scmp(a, b, feature, ring_list[1:]))
-    ## handle cases in which the feature is not in the sorting dataset, use * if possible
-    ring_feature = feature
-    if ring_feature not in ring_list[0].index:
-        if "*" in ring_list[0].index:
+    keys = []
+    for data in order_data:
+        columns = {}
+        for column, name in reversed(list(enumerate(data.columns))):
+            columns[name] = column
+        positions = np.array([columns.get(sample, -1) for sample in samples], dtype = int)
+        missing = positions < 0
+        keys.append(missing)
+        if feature in data.index:
+            ring_feature = feature
+        elif "*" in data.index:
             ring_feature = "*"
         else:
-            if len(ring_list) == 1:
-                return(0)
-            else:
-                return(scmp(a, b, feature, ring_list[1:]))
-    
-    value = cmp(ring_list[0][a][ring_feature], ring_list[0][b][ring_feature])
-    if value == 0:
-        if len(ring_list) == 1:
-            return(0)
-        else:
-            return(scmp(a, b, feature, ring_list[1:]))
-    else:
-        return(value)
+            continue
+        row = data.values[list(data.index).index(ring_feature)][np.maximum(positions, 0)]
+        try:
+            values = row.astype(float)
+            unknown = np.isnan(values) & ~missing
+            values[missing | unknown] = 0.0
+            keys += [unknown, values]
+        except (ValueError, TypeError):
+            ranks = np.zeros(len(samples), dtype = int)
+            if (~missing).any():
+                ranks[~missing] = np.unique(row[~missing], return_inverse = True)[1]
+            keys.append(ranks)
+    return(keys)
+
+def sortSamples(samples, order_parameters):
+    """
+    Returns samples sorted hierarchically on (feature, order_data) pairs, keeping
+    the given order for ties [CirclePlot specific]
+    """
+    keys = []
+    for (feature, order_data) in order_parameters:
+        keys += sampleOrderKeys(samples, feature, order_data)
+    if len(keys) == 0 or len(samples) == 0:
+        return(list(samples))
+    order = np.lexsort(keys[::-1])
+    return([samples[i] for i in order])
+
+def orderSignature(order_parameters, samples):
+    """
+    Identifies a sample ordering by its features, the size and time of its files
+    and the samples to sort [CirclePlot specific]
+    """
+    files = []
+    for (feature, order_files) in order_parameters:
+        for order_file in order_files:
+            if iplStore.isStore(order_file):
+                order_file = os.path.join(order_file, iplStore.metaFile)
+            st = os.stat(order_file)
+            files.append([os.path.abspath(order_file), st.st_size, st.st_mtime])
+    text = json.dumps([[feature for (feature, order_files) in order_parameters], files, samples])
+    return(hashlib.md5(text).hexdigest())
+
+def loadOrderCache(cache_file):
+    """
+    Returns the cached [signature, samples] pairs, oldest first [CirclePlot specific]
+    """
+    if not os.path.exists(cache_file):
+        return([])
+    f = open(cache_file, "r")
+    try:
+        cache = json.load(f)
+    except ValueError:
+        logger("WARNING: ignoring unreadable sample order cache %s\n" % (cache_file))
+        cache = []
+    f.close()
+    if isinstance(cache, dict):
+        cache = sorted(cache.items())
+    return(cache)
+
+def readSampleOrder(cache_file, signature):
+    """
+    Returns the cached sample order with this signature, or None [CirclePlot specific]
+    """
+    for (cached, samples) in loadOrderCache(cache_file):
+        if cached == signature:
+            return([str(sample) for sample in samples])
+    return(None)
+
+def writeSampleOrder(cache_file, signature, samples):
+    """
+    Adds a sample order to the cache, keeping the order_cache_size most recent ones and
+    replacing the file atomically [CirclePlot specific]
+    """
+    cache = [entry for entry in loadOrderCache(cache_file) if entry[0] != signature]
+    cache = (cache + [[signature, samples]])[-order_cache_size:]
+    tmp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+    f = open(tmp_file, "w")
+    json.dump(cache, f)
+    f.close()
+    os.rename(tmp_file, cache_file)
 
 def getColorFromMap(key, color_map):
     """
@@ -171,6 +245,136 @@ def getColorFromValue(value, min_value, max_value, min_color = RGB(0, 0, 255), z
     b = svalue * float(base_color.b - zero_color.b) + zero_color.b
     return(RGB(r, g, b).hex())
 
+def parseColor(color, default):
+    """
+    Returns the RGB of an r.g.b string or (r, g, b) color parameter [CirclePlot specific]
+    """
+    if color is None:
+        return(default)
+    if isinstance(color, str):
+        color = color.split(".")
+    try:
+        (r, g, b) = color
+        return(RGB(float(r), float(g), float(b)))
+    except ValueError:
+        raise Exception("color parameter not a valid color")
+
+def floatOrNaN(value):
+    try:
+        return(float(value))
+    except (ValueError, TypeError):
+        return(float("nan"))
+
+def rgbaArray(r, g, b):
+    """
+    Returns RGBA rows from float channels, rounded and clipped like RGB [CirclePlot specific]
+    """
+    channels = np.column_stack((r, g, b))
+    rounded = np.where(channels - np.floor(channels) >= 0.5, np.ceil(channels), np.floor(channels))
+    return(np.column_stack((np.clip(rounded, 0, 255) / 255.0, np.ones(len(channels)))))
+
+gray_rgba = rgbaArray([200], [200], [200])[0]
+
+def getColorsFromValues(values, min_value, max_value, min_color = RGB(0, 0, 255), zero_color = RGB(255, 255, 255), max_color = RGB(255, 0, 0)):
+    """
+    Returns getColorFromValue for an array of values as RGBA rows, gray where a value
+    is NaN or getColorFromValue would fail [CirclePlot specific]
+    """
+    values = np.asarray(values, dtype = float)
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        negative = values < 0.0
+        svalue = np.where(negative, np.where(values < min_value, 1.0, values / float(min_value)),
+                          np.where(values > max_value, 1.0, values / float(max_value)))
+        failed = np.isnan(values) | (~negative & ~(values > max_value) & (max_value == 0))
+    svalue[failed] = 0.0
+    base = [np.where(negative, getattr(min_color, c), getattr(max_color, c)) for c in ("r", "g", "b")]
+    zero = [getattr(zero_color, c) for c in ("r", "g", "b")]
+    colors = rgbaArray(*[svalue * (base[i] - zero[i]) + zero[i] for i in range(3)])
+    colors[failed] = gray_rgba
+    return(colors)
+
+class RingColors:
+    """
+    Colors one ring's samples for a feature as an RGBA array, with the sample columns
+    and color parameters of the ring resolved once [CirclePlot specific]
+    """
+    def __init__(self, data, samples, ring_map):
+        self.skip = "skip_ring" in ring_map
+        self.values = data.values
+        self.rows = {}
+        for row, name in reversed(list(enumerate(data.index))):
+            self.rows[name] = row
+        columns = dict([(name, column) for column, name in reversed(list(enumerate(data.columns)))])
+        self.columns = np.array([columns.get(sample, -1) for sample in samples], dtype = int)
+        self.missing = self.columns < 0
+        self.scaled = "min_value" in ring_map and "max_value" in ring_map
+        if self.scaled:
+            self.min_value = ring_map["min_value"]
+            self.max_value = ring_map["max_value"]
+            self.min_color = parseColor(ring_map.get("min_color"), RGB(0, 0, 255))
+            self.zero_color = parseColor(ring_map.get("zero_color"), RGB(255, 255, 255))
+            self.max_color = parseColor(ring_map.get("max_color"), RGB(255, 0, 0))
+        else:
+            ## discrete colors, looked up by the str() of each value, or of its
+            ## integer when the frame (or store) upcast an integer column to float
+            self.palette = [gray_rgba]
+            self.keys = {}
+            for key in ring_map:
+                try:
+                    (r, g, b) = ring_map[key].split(".")
+                    color = RGB(int(r), int(g), int(b))
+                except ValueError:
+                    continue
+                self.keys[key] = len(self.palette)
+                self.palette.append(rgbaArray([color.r], [color.g], [color.b])[0])
+            self.palette = np.array(self.palette)
+    def paletteIndex(self, value):
+        index = self.keys.get(str(value))
+        if index is None and isinstance(value, float) and np.isfinite(value) and value == int(value):
+            index = self.keys.get(str(int(value)))
+        if index is None:
+            return(0)
+        return(index)
+    def bounds(self, ring_feature):
+        min_value = self.min_value
+        max_value = self.max_value
+        if isinstance(min_value, dict):
+            min_value = min_value.get(ring_feature)
+        if isinstance(max_value, dict):
+            max_value = max_value.get(ring_feature)
+        try:
+            return(float(min_value), float(max_value))
+        except (ValueError, TypeError):
+            return(None)
+    def colors(self, feature):
+        """
+        Returns the RGBA colors of the samples for a feature, gray where a sample or
+        the feature (and "*") is missing [CirclePlot specific]
+        """
+        if self.skip:
+            return([])
+        colors = np.tile(gray_rgba, (len(self.columns), 1))
+        if feature in self.rows:
+            ring_feature = feature
+        elif "*" in self.rows:
+            ring_feature = "*"
+        else:
+            return(colors)
+        row = self.values[self.rows[ring_feature]][self.columns[~self.missing]]
+        if self.scaled:
+            bounds = self.bounds(ring_feature)
+            if bounds is None:
+                return(colors)
+            try:
+                row = row.astype(float)
+            except (ValueError, TypeError):
+                row = np.array([floatOrNaN(value) for value in row])
+            colors[~self.missing] = getColorsFromValues(row, bounds[0], bounds[1], min_color = self.min_color,
+                                                        zero_color = self.zero_color, max_color = self.max_color)
+        else:
+            colors[~self.missing] = self.palette[[self.paletteIndex(value) for value in row]]
+        return(colors)
+
 def polar(r, value):
     """
     Returns Euclidean coordinates from polar coordinates [CirclePlot specific]
@@ -180,133 +384,295 @@ def polar(r, value):
     y = r * math.sin(theta)
     return(x, y)
 
+def polarArray(r, values):
+    """
+    Returns an array of Euclidean points from polar coordinates [CirclePlot specific]
+    """
+    theta = -2.0 * math.pi * np.asarray(values, dtype = float) + math.pi / 2.0
+    return(np.column_stack((r * np.cos(theta), r * np.sin(theta))))
+
+def wedge(inner_radius, outer_radius, t0, t1):
+    """
+    Returns the polygon of a ring segment, outer arc then inner arc, in tstep steps [CirclePlot specific]
+    """
+    steps = np.arange(0.0, t1 - t0, tstep)
+    return(np.vstack((polarArray(inner_radius, [t0]),
+                      polarArray(outer_radius, t0 + steps),
+                      polarArray(outer_radius, [t1]),
+                      polarArray(inner_radius, t1 - steps),
+                      polarArray(inner_radius, [t0]))))
+
+class CirclePlotter:
+    """
+    Draws circle images of one ring and sample layout, computing the wedges once and
+    saving the same figure for every feature [CirclePlot specific]
+    """
+    def __init__(self, ring_sizes, border_color = RGB(0, 0, 0).hex(), inner_radius_total = 0.2, outer_radius_total = 0.5, width = 5):
+        self.layout = (tuple(ring_sizes), border_color, inner_radius_total, outer_radius_total, width)
+        self.figure = Figure(figsize = (width, width), dpi = 100, frameon = True, facecolor = "w")
+        self.canvas = FigureCanvasAgg(self.figure)
+        ax = self.figure.add_axes([0, 0, 1, 1], frameon = True)
+        ax.patch.set_facecolor("w")
+        ax.axis("off")
+        ax.set_xlim(-0.5, 0.5)
+        ax.set_ylim(-0.5, 0.5)
+        ring_width = (outer_radius_total - inner_radius_total) / float(len(ring_sizes))
+        
+        ## center
+        outer_radius = inner_radius_total - .01
+        center = np.vstack((polarArray(outer_radius, [0]),
+                            polarArray(outer_radius, np.arange(0.0, 1.0, tstep)),
+                            polarArray(outer_radius, [1])))
+        self.center = PolyCollection([center], linewidths = 1)
+        ax.add_collection(self.center)
+        
+        ## one collection of wedges per ring
+        self.rings = []
+        for ring_index in range(len(ring_sizes)):
+            inner_radius = (ring_index * ring_width) + inner_radius_total
+            outer_radius = ((ring_index + 1) * ring_width) + inner_radius_total-.01
+            n = ring_sizes[ring_index]
+            wedges = [wedge(inner_radius, outer_radius, float(spoke_index) / n, float(spoke_index + 1) / n)
+                      for spoke_index in range(n)]
+            ring = PolyCollection(wedges, linewidths = 1)
+            ax.add_collection(ring)
+            self.rings.append(ring)
+        
+        ## ring borders, skipped between two empty rings
+        if border_color != RGB(255, 255, 255).hex():
+            borders = []
+            for ring_index in range(len(ring_sizes) + 1):
+                inner_ring_empty = ring_index == 0 or ring_sizes[ring_index - 1] == 0
+                outer_ring_empty = ring_index == len(ring_sizes) or ring_sizes[ring_index] == 0
+                if inner_ring_empty and outer_ring_empty:
+                    continue
+                inner_radius = (ring_index * ring_width) + inner_radius_total - .01 + 0.0025
+                outer_radius = (ring_index * ring_width) + inner_radius_total - 0.0025
+                borders.append(wedge(inner_radius, outer_radius, 0.0, 1.0))
+            ax.add_collection(PolyCollection(borders, linewidths = 1, facecolors = border_color,
+                                             edgecolors = border_color))
+        self.label = ax.text(0, 0, "", ha = "center", va = "center")
+    def color(self, image_label = "", center_color = RGB(255, 255, 255).hex(), ring_colors = []):
+        """
+        Colors the wedges and sets the label
+        """
+        self.center.set_facecolor([center_color])
+        self.center.set_edgecolor([center_color])
+        for ring_index in range(len(self.rings)):
+            if len(ring_colors[ring_index]) > 0:
+                self.rings[ring_index].set_facecolor(ring_colors[ring_index])
+                self.rings[ring_index].set_edgecolor(ring_colors[ring_index])
+        self.label.set_text(image_label)
+    def plot(self, image_file, image_label = "", center_color = RGB(255, 255, 255).hex(), ring_colors = []):
+        """
+        Colors the wedges and saves the image
+        """
+        self.color(image_label = image_label, center_color = center_color, ring_colors = ring_colors)
+        self.figure.savefig(image_file)
+    def tile(self):
+        """
+        Returns the colored image as a height x width x 4 array of bytes
+        """
+        self.canvas.draw()
+        (width, height) = self.canvas.get_width_height()
+        return(np.frombuffer(self.canvas.buffer_rgba(), dtype = np.uint8).reshape(height, width, 4))
+
+circle_plotter = None
+
+def circlePlotter(ring_sizes, border_color = RGB(0, 0, 0).hex(), inner_radius_total = 0.2, outer_radius_total = 0.5, width = 5):
+    """
+    Returns the plotter of a layout, reusing the plotter of the last image with the
+    same layout [CirclePlot specific]
+    """
+    global circle_plotter
+    if circle_plotter is None or circle_plotter.layout != (tuple(ring_sizes), border_color, inner_radius_total, outer_radius_total, width):
+        circle_plotter = CirclePlotter(ring_sizes, border_color = border_color, inner_radius_total = inner_radius_total,
+                                       outer_radius_total = outer_radius_total, width = width)
+    return(circle_plotter)
+
 def plotCircle(image_file, image_label = "", center_color = RGB(255, 255, 255).hex(), ring_colors = [[RGB(200, 200, 200).hex()]], border_color = RGB(0, 0, 0).hex(), inner_radius_total = 0.2, outer_radius_total = 0.5, width = 5):
     """
-    Generates the circle image by building each ring from a list of colors [CirclePlot specific]
+    Generates the circle image by building each ring from a list of colors, reusing
+    the plotter of the last image with the same layout [CirclePlot specific]
     """
-    ## set image settings
-    image_size = (width, width)
-    fig = plt.figure(figsize = image_size, dpi = 100, frameon = True, facecolor = "w")
-    axes([0, 0, 1, 1], frameon = True, axisbg = "w")
-    axis("off")
-    ring_width = (outer_radius_total - inner_radius_total) / float(len(ring_colors))
-    
-    ## color center
-    outer_radius = inner_radius_total
-    outer_radius -= .01
-    x_list = []
-    y_list = []
-    x, y = polar(outer_radius, 0)
-    x_list.append(x)
-    y_list.append(y)
-    ti = 0
-    while ti < 1:
-        x, y = polar(outer_radius, ti)
-        x_list.append(x)
-        y_list.append(y)
-        ti += tstep
-        if ti > 1:
-            break
-    x, y = polar(outer_radius, 1)
-    x_list.append(x)
-    y_list.append(y)
-    fill(x_list, y_list, center_color, lw = 1, ec = center_color)
-    
-    ## color rings
-    for ring_index in range(len(ring_colors)):
-        inner_radius = (ring_index * ring_width) + inner_radius_total
-        outer_radius = ((ring_index + 1) * ring_width) + inner_radius_total-.01
-        for spoke_index in range(len(ring_colors[ring_index])):
-            t0 = float(spoke_index) / len(ring_colors[ring_index])
-            t1 = float(spoke_index + 1) / len(ring_colors[ring_index])
-            x_list = []
-            y_list = []
-            x, y = polar(inner_radius, t0)
-            x_list.append(x)
-            y_list.append(y)
-            ti = t0
-            while ti < t1:
-                x, y = polar(outer_radius, ti)
-                x_list.append(x)
-                y_list.append(y)
-                ti += tstep
-                if ti > t1:
-                    break
-            x, y = polar(outer_radius, t1)
-            x_list.append(x)
-            y_list.append(y)
-            ti = t1
-            while ti > t0:
-                x, y = polar(inner_radius, ti)
-                x_list.append(x)
-                y_list.append(y)
-                ti -= tstep
-                if ti < t0:
-                    break
-            x, y = polar(inner_radius, t0)
-            x_list.append(x)
-            y_list.append(y)
-            fill(x_list, y_list, ring_colors[ring_index][spoke_index], lw = 1, ec = ring_colors[ring_index][spoke_index])
-    
-    ## color ring borders
-    if border_color != RGB(255, 255, 255).hex():
-        for ring_index in range(len(ring_colors) + 1):
-            ## do not draw a border if previous and next ring are empty, else plot
-            inner_ring_empty = False
-            outer_ring_empty = False
-            if ring_index == 0:
-                inner_ring_empty = True
-            elif len(ring_colors[ring_index - 1]) == 0:
-                inner_ring_empty = True
-            else:
-                inner_ring_empty = False
-            if ring_index == len(ring_colors):
-                outer_ring_empty = True
-            elif len(ring_colors[ring_index]) == 0:
-                outer_ring_empty = True
+    plotter = circlePlotter([len(colors) for colors in ring_colors], border_color = border_color, inner_radius_total = inner_radius_total,
+                            outer_radius_total = outer_radius_total, width = width)
+    plotter.plot(image_file, image_label = image_label, center_color = center_color, ring_colors = ring_colors)
+
+def readMatrix(input_file, samples = None, features = None):
+    """
+    Reads a matrix file or binary IPL store into a data frame; from a store
+    only the given samples and features (and "*") are read [CirclePlot specific]
+    """
+    if not iplStore.isStore(input_file):
+        return pandas.read_csv(input_file, sep = "\t", index_col = 0)
+    store = iplStore.IPLStore(input_file)
+    columns = store.samples
+    if samples is not None:
+        columns = sorted(list(set(store.samples) & set(samples)))
+    if features is not None:
+        rows = sorted(list(set(store.entities) & set(features + ["*"])))
+        values = store.rows(rows)
+        values = values[:, [store.sampleIndex[sample] for sample in columns]]
+    else:
+        rows = store.entities
+        values = store.columns(columns)
+    return pandas.DataFrame(values.astype(np.float64), index = rows, columns = columns)
+
+def ringIndex(index, ring_count, color_map):
+    try:
+        return filter(lambda x: x in color_map, [index + 1, index - ring_count])[0]
+    except IndexError:
+        return index + 1
+
+render_state = {}
+
+def featureColors(feature):
+    """
+    Returns the label, center color and ring colors of a feature's circle from the
+    rings and colors in render_state [CirclePlot specific]
+    """
+    print_label = render_state["print_label"]
+    center_data = render_state["center_data"]
+    color_map = render_state["color_map"]
+    rings = render_state["rings"]
+    ## set label
+    image_label = ""
+    if print_label:
+        image_label = feature
+    ## set center color
+    if center_data is not None:
+        ring_index = 0
+        if feature in center_data:
+            if "min_value" in color_map[ring_index] and "max_value" in color_map[ring_index]:
+                min_value = color_map[ring_index]["min_value"]
+                max_value = color_map[ring_index]["max_value"]
+                center_color = getColorFromValue(center_data[feature], min_value, max_value)
             else:
-                outer_ring_empty = False
-            if inner_ring_empty and outer_ring_empty:
-                continue
-            inner_radius = (ring_index * ring_width) + inner_radius_total - .01 + 0.0025
-            outer_radius = (ring_index * ring_width) + inner_radius_total - 0.0025
-            t0 = 0.0
-            t1 = 1.0
-            x_list = []
-            y_list = []
-            x, y = polar(inner_radius, t0)
-            x_list.append(x)
-            y_list.append(y)
-            ti = t0
-            while ti < t1:
-                x, y = polar(outer_radius, ti)
-                x_list.append(x)
-                y_list.append(y)
-                ti += tstep
-                if ti > t1:
-                    break
-            x, y = polar(outer_radius, t1)
-            x_list.append(x)
-            y_list.append(y)
-            ti = t1
-            while ti > t0:
-                x, y = polar(inner_radius, ti)
-                x_list.append(x)
-                y_list.append(y)
-                ti -= tstep
-                if ti < t0:
-                    break
-            x, y = polar(inner_radius, t0)
-            x_list.append(x)
-            y_list.append(y)
-            fill(x_list, y_list, border_color, lw = 1, ec = border_color)
-
-    ## save image
-    text(0, 0, image_label, ha = "center", va = "center")
-    xlim(-0.5, 0.5)
-    ylim(-0.5, 0.5)
-    savefig(image_file)
-    close()
+                center_color = getColorFromMap(str(center_data[feature]), color_map[ring_index])
+        else:
+            center_color = RGB(200, 200, 200).hex()
+    else:
+        center_color = RGB(255, 255, 255).hex()
+    ## set ring colors
+    ring_colors = [ring.colors(feature) for ring in rings]
+    return(image_label, center_color, ring_colors)
+
+def drawFeature(feature):
+    """
+    Draws the circle of a feature to its own image file [CirclePlot specific]
+    """
+    image_name = re.sub("[/:]", "_", feature)
+    if len(image_name) > 100:
+        image_name = image_name[:100]
+    image_file = "%s/%s.%s" % (render_state["output_directory"], image_name, image_format)
+    (image_label, center_color, ring_colors) = featureColors(feature)
+    plotCircle(image_file, image_label = image_label, center_color = center_color, ring_colors = ring_colors, inner_radius_total = 0.2, outer_radius_total = 0.5, width = 5, border_color = RGB(0, 0, 0).hex())
+    return(feature)
+
+def colorCircle(feature):
+    """
+    Returns the plotter with the circle of a feature colored, for drawing into an
+    atlas [CirclePlot specific]
+    """
+    (image_label, center_color, ring_colors) = featureColors(feature)
+    plotter = circlePlotter([len(colors) for colors in ring_colors], border_color = RGB(0, 0, 0).hex(),
+                            inner_radius_total = 0.2, outer_radius_total = 0.5, width = 5)
+    plotter.color(image_label = image_label, center_color = center_color, ring_colors = ring_colors)
+    return(plotter)
+
+def drawSheet(sheet):
+    """
+    Draws the circles of a sheet's features as tiles of one image, row by row, and
+    returns the index entries of the features [CirclePlot specific]
+    """
+    (sheet_file, sheet_features, columns) = sheet
+    image = None
+    index = {}
+    for position, feature in enumerate(sheet_features):
+        tile = colorCircle(feature).tile()
+        (height, width) = tile.shape[:2]
+        if image is None:
+            rows = (len(sheet_features) + columns - 1) / columns
+            image = np.empty((rows * height, min(columns, len(sheet_features)) * width, 4), dtype = np.uint8)
+            image[:] = 255
+        (row, column) = divmod(position, columns)
+        image[row * height:(row + 1) * height, column * width:(column + 1) * width] = tile
+        index[feature] = {"file" : os.path.basename(sheet_file), "x" : column * width, "y" : row * height,
+                          "width" : width, "height" : height}
+    imsave(sheet_file, image)
+    return(sheet_features, index)
+
+def drawPages(pdf_file, features):
+    """
+    Draws the circles of features as the pages of one PDF, one figure setup for all
+    pages, and returns the index entries of the features [CirclePlot specific]
+    """
+    pdf = PdfPages(pdf_file)
+    index = {}
+    start = time.time()
+    for page, feature in enumerate(features):
+        pdf.savefig(colorCircle(feature).figure)
+        index[feature] = {"file" : os.path.basename(pdf_file), "page" : page + 1}
+        logger("Drew %s (%d/%d, %.1f features/s)\n" % (feature, page + 1, len(features),
+                                                      (page + 1) / max(time.time() - start, 1e-6)))
+    pdf.close()
+    return(index)
+
+def drawFeatures(features, jobs = 1):
+    """
+    Draws every feature, in jobs forked processes that share the rings read-only
+    and keep their own canvas, reporting progress [CirclePlot specific]
+    """
+    start = time.time()
+    pool = None
+    if jobs > 1 and len(features) > 1:
+        pool = multiprocessing.Pool(jobs)
+        drawn = pool.imap_unordered(drawFeature, features, max(1, len(features) / (jobs * 8)))
+    else:
+        drawn = itertools.imap(drawFeature, features)
+    for count, feature in enumerate(drawn):
+        logger("Drew %s (%d/%d, %.1f features/s)\n" % (feature, count + 1, len(features),
+                                                      (count + 1) / max(time.time() - start, 1e-6)))
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+def drawAtlas(atlas_name, features, jobs = 1, sheet_size = 10):
+    """
+    Draws every feature into atlas_name sprite sheets of at most sheet_size x sheet_size
+    tiles, a sheet per job, or into one multi-page PDF for the pdf format, and writes
+    atlas_name.json mapping each feature to its file and tile offset or page [CirclePlot specific]
+    """
+    output_directory = render_state["output_directory"]
+    atlas_format = image_format
+    if atlas_format == "svg":
+        logger("WARNING: svg has no pages, writing the atlas as pdf\n")
+        atlas_format = "pdf"
+    if atlas_format == "pdf":
+        index = drawPages("%s/%s.pdf" % (output_directory, atlas_name), features)
+    else:
+        tiles = sheet_size * sheet_size
+        sheets = [("%s/%s_%d.%s" % (output_directory, atlas_name, start / tiles, atlas_format),
+                   features[start:start + tiles], sheet_size) for start in range(0, len(features), tiles)]
+        start = time.time()
+        pool = None
+        if jobs > 1 and len(sheets) > 1:
+            pool = multiprocessing.Pool(jobs)
+            drawn = pool.imap_unordered(drawSheet, sheets)
+        else:
+            drawn = itertools.imap(drawSheet, sheets)
+        index = {}
+        for (sheet_features, sheet_index) in drawn:
+            index.update(sheet_index)
+            logger("Drew %d features (%d/%d, %.1f features/s)\n" % (len(sheet_features), len(index), len(features),
+                                                                    len(index) / max(time.time() - start, 1e-6)))
+        if pool is not None:
+            pool.close()
+            pool.join()
+    f = open("%s/%s.json" % (output_directory, atlas_name), "w")
+    json.dump({"format" : atlas_format, "features" : index}, f, indent = 1, sort_keys = True)
+    f.close()
 
 def main(args):
     ## parse arguments
@@ -315,14 +681,20 @@ def main(args):
                       help = "one column file of samples to plot")
     parser.add_option("-f", "--features", dest = "feature_file", default = None,
                       help = "one column file of features to plot")
-    parser.add_option("-o", "--order", dest = "order_parameters", default = None,
-                      help = "feature:file[,file ...] hierarchical sort on feature and data files")
+    parser.add_option("-o", "--order", dest = "order_parameters", action = "append", default = [],
+                      help = "feature;file[,file ...] hierarchical sort on feature and data files, repeat to break ties on more features")
     parser.add_option("-c", "--center", dest = "center_file", default = None,
                       help = "two column file of feature scores for center circle colors")
     parser.add_option("-m", "--mapping", dest = "color_map_file", default = None,
                       help = "color parameters file")
     parser.add_option("-e", "--extension", dest = "file_extension", default = "png",
                       help = "output file extension (default: png)")
+    parser.add_option("-j", "--jobs", dest = "jobs", type = "int", default = 1,
+                      help = "number of processes drawing images (default: 1)")
+    parser.add_option("-a", "--atlas", dest = "atlas_name", default = None,
+                      help = "draw all plots into atlas sprite sheets (one multi-page file for pdf) named after this, indexed in its .json")
+    parser.add_option("--atlas-size", dest = "atlas_size", type = "int", default = 10,
+                      help = "tiles per row and column of an atlas sheet (default: 10)")
     parser.add_option("-l", "--label", dest = "print_label", action = "store_true", default = False,
                       help = "output feature names for each plot")
     options, args = parser.parse_args()
@@ -337,17 +709,14 @@ def main(args):
     global image_format
     sample_file = options.sample_file
     feature_file = options.feature_file
-    if options.order_parameters is not None:
-        parts = options.order_parameters.split(";")
+    order_parameters = []
+    for order in options.order_parameters:
+        parts = order.split(";")
         if len(parts) == 1:
-            order_feature = parts[0]
-            order_files = []
+            order_parameters.append((parts[0], []))
         else:
-            order_feature = parts[0]
-            order_files = parts[1].split(",")
-    else:
-        order_feature = None
-        order_files = []
+            order_parameters.append((parts[0], parts[1].split(",")))
+    order_features = [feature for (feature, order_files) in order_parameters]
     center_file = options.center_file
     if options.color_map_file is not None:
         color_map = parseColorMap(options.color_map_file)
@@ -369,10 +738,17 @@ def main(args):
     if center_file is not None:
         center_data = pandas.read_csv(center_file, sep = "\t", index_col = 0).icol(0)
     
-    ## read circle files
+    ## read circle files, only the selected features unless the ring needs
+    ## all of its values for a global color boundary
     ring_data = []
     for index in range(len(ring_files)):
-        data = pandas.read_csv(ring_files[index], sep = "\t", index_col = 0)
+        ring_features = None
+        if feature_file is not None:
+            ring_map = color_map.get(ringIndex(index, len(ring_files), color_map), {})
+            if ring_map.get("boundary_method") != "global" or "min_value" in ring_map and "max_value" in ring_map:
+                ring_features = features + order_features
+        data = readMatrix(ring_files[index], samples = samples if sample_file is not None else None,
+                          features = ring_features)
         if sample_file is not None:
             data = data[sorted(list(set(data.columns) & set(samples)))]
         else:
@@ -383,20 +759,33 @@ def main(args):
             features = list(set(data.index) | set(features))
         ring_data.append(data)
     
-    ## determine sample sort
-    if order_feature is not None:
-        if len(order_files) > 0:
-            order_data = []
-            for index in range(len(order_files)):
-                data = pandas.read_csv(order_files[index], sep = "\t", index_col = 0)
-                if sample_file is not None:
-                    data = data[sorted(list(set(data.columns) & set(samples)))]
-                if feature_file is not None:
-                    data = data.loc[sorted(list(set(data.index) & set(features + ["*"])))]
-                order_data.append(data)
-        else:
-            order_data = ring_data
-        samples.sort(lambda x, y: scmp(x, y, order_feature, order_data))
+    ## determine sample sort, reusing the order of an earlier run on the same inputs
+    if len(order_parameters) > 0:
+        cache_file = os.path.join(output_directory, order_cache_file)
+        signature = orderSignature([(feature, order_files if len(order_files) > 0 else ring_files)
+                                    for (feature, order_files) in order_parameters], samples)
+        sorted_samples = readSampleOrder(cache_file, signature)
+        if sorted_samples is None:
+            order_data = {}
+            sort_parameters = []
+            for (feature, order_files) in order_parameters:
+                if len(order_files) == 0:
+                    sort_parameters.append((feature, ring_data))
+                    continue
+                for order_file in order_files:
+                    if order_file in order_data:
+                        continue
+                    data = readMatrix(order_file, samples = samples if sample_file is not None else None,
+                                      features = features + order_features if feature_file is not None else None)
+                    if sample_file is not None:
+                        data = data[sorted(list(set(data.columns) & set(samples)))]
+                    if feature_file is not None:
+                        data = data.loc[sorted(list(set(data.index) & set(features + order_features + ["*"])))]
+                    order_data[order_file] = data
+                sort_parameters.append((feature, [order_data[order_file] for order_file in order_files]))
+            sorted_samples = sortSamples(samples, sort_parameters)
+            writeSampleOrder(cache_file, signature, sorted_samples)
+        samples = sorted_samples
     
     ## determine color parameters
     if center_data is not None:
@@ -463,73 +852,14 @@ def main(args):
                     raise Exception("boundary method for ring is not valid")
     
     ## plot images
-    for feature in features:
-        ## set name and label
-        logger("Drawing %s\n" % (feature))
-        image_name = re.sub("[/:]", "_", feature)
-        if len(image_name) > 100:
-            image_name = image_name[:100]
-        image_file = "%s/%s.%s" % (output_directory, image_name, image_format)
-        image_label = ""
-        if print_label:
-            image_label = feature
-        ## set center color
-        if center_data is not None:
-            ring_index = 0
-            if feature in center_data:
-                if "min_value" in color_map[ring_index] and "max_value" in color_map[ring_index]:
-                    min_value = color_map[ring_index]["min_value"]
-                    max_value = color_map[ring_index]["max_value"]
-                    center_color = getColorFromValue(center_data[feature], min_value, max_value)
-                else:
-                    center_color = getColorFromMap(str(center_data[feature]), color_map[ring_index])
-            else:
-                center_color = RGB(200, 200, 200).hex()
-        else:
-            center_color = RGB(255, 255, 255).hex()
-        ## set ring colors
-        ring_colors = []
-        for index in range(len(ring_data)):
-            current_ring = []
-            if feature in ring_data[index].index:
-                ring_feature = feature
-            elif "*" in ring_data[index].index:
-                ring_feature = "*"
-            else:
-                ring_feature = None
-            ring_index = filter(lambda x: x in color_map.keys(), [index + 1, index - len(ring_data)])[0]
-            ## first check if this ring is to be skipped
-            if "skip_ring" in color_map[ring_index]:
-                ring_colors.append(current_ring)
-                continue
-            for sample in samples:
-                try:
-                    if "min_value" in color_map[ring_index] and "max_value" in color_map[ring_index]:
-                        if ring_feature in color_map[ring_index]["min_value"]:
-                            min_value = color_map[ring_index]["min_value"][ring_feature]
-                        else:
-                            min_value = color_map[ring_index]["min_value"]
-                        if ring_feature in color_map[ring_index]["max_value"]:
-                            max_value = color_map[ring_index]["max_value"][ring_feature]
-                        else:
-                            max_value = color_map[ring_index]["max_value"]
-                        min_color = RGB(0, 0, 255)
-                        zero_color = RGB(255, 255, 255)
-                        max_color = RGB(255, 0, 0)
-                        if "min_color" in color_map[ring_index]:
-                            min_color = RGB(color_map[ring_index]["min_color"][0], color_map[ring_index]["min_color"][1], color_map[ring_index]["min_color"][2])
-                        if "zero_color" in color_map[ring_index]:
-                            zero_color = RGB(color_map[ring_index]["zero_color"][0], color_map[ring_index]["zero_color"][1], color_map[ring_index]["zero_color"][2])
-                        if "max_color" in color_map[ring_index]:
-                            max_color = RGB(color_map[ring_index]["max_color"][0], color_map[ring_index]["max_color"][1], color_map[ring_index]["max_color"][2])
-                        current_ring.append(getColorFromValue(ring_data[index][sample].loc[ring_feature], min_value, max_value, min_color = min_color, zero_color = zero_color, max_color = max_color))
-                    else:
-                        current_ring.append(getColorFromMap(str(ring_data[index][sample].loc[ring_feature]), color_map[ring_index]))
-                except:
-                    current_ring.append(RGB(200, 200, 200).hex())
-            ring_colors.append(current_ring)
-        ## plot
-        plotCircle(image_file, image_label = image_label, center_color = center_color, ring_colors = ring_colors, inner_radius_total = 0.2, outer_radius_total = 0.5, width = 5, border_color = RGB(0, 0, 0).hex())
+    rings = [RingColors(ring_data[index], samples, color_map[ringIndex(index, len(ring_data), color_map)])
+             for index in range(len(ring_data))]
+    render_state.update({"output_directory" : output_directory, "print_label" : print_label,
+                         "center_data" : center_data, "color_map" : color_map, "rings" : rings})
+    if options.atlas_name is not None:
+        drawAtlas(options.atlas_name, features, jobs = options.jobs, sheet_size = options.atlas_size)
+    else:
+        drawFeatures(features, jobs = options.jobs)
 
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+"""collectParameters.py: collect EM expectations into a paradigm params file
+
+Sums the expected counts of every shared CondProbEstimation block over a
+list of *_learned_parameters.fa files (read in parallel), replaces entries
+fixed by mask.expectations, normalizes each target_dim group with the
+block's pseudo_count, replaces entries fixed by mask.params and writes the
+result with the summed logZ in its header.  A negative mask entry -k ties
+the entry to parameter k: the expected counts of tied entries are pooled,
+and tied parameters averaged.  The learned parameter files are read in
+the params file layout: a header line with logZ=, then "> " block headers
+each followed by one count per line, or by "i<tab>j<tab>count" lines for
+the public paradigm, whose counts are normalized over i for each j.
+
+galaxyParadigm.py uses this in place of the collectParameters binary
+unless run with --external-collect.  On public paradigm learned files it
+gives the parameters of exe/public/collectParameters (to the 6 decimals
+that writes), with logZ summed over all the files rather than taken from
+one of them.
+
+Usage:
+  collectParameters.py [options] output_params
+
+Options:
+   -m file    file listing the learned parameter files, one per line
+              (- for stdin); files may also be given as further arguments
+   -e file    mask.expectations (default: mask.expectations if present)
+   -p file    mask.params (default: mask.params if present)
+   -i int     em_iters for the header (default 0)
+   -j int     worker processes (default 1)
+"""
+import os, sys, re, getopt, multiprocessing
+import numpy as np
+import emConvergence
+
+chunkFiles = 16
+
+def readExpectations(filename):
+    """
+    Returns the logZ, the (header, counts) blocks and the index fields of a
+    learned parameters file
+    """
+    (header, blocks, labels) = emConvergence.readParams(filename, labels=True)
+    m = re.search("logZ=([0-9.e+-]*)", header)
+    logZ = 0.0
+    if m:
+        logZ = float(m.group(1))
+    return (logZ, blocks, labels)
+
+def sumExpectations(filenames):
+    """
+    Summed logZ and counts over files, with block headers, index fields and
+    keys in the order they first appear
+    """
+    logZ = 0.0
+    order = []
+    headers = {}
+    sums = {}
+    labels = {}
+    for filename in filenames:
+        (fileLogZ, blocks, fileLabels) = readExpectations(filename)
+        logZ += fileLogZ
+        for (h, counts) in blocks:
+            k = emConvergence.blockKey(h)
+            if k not in sums:
+                order.append(k)
+                headers[k] = h
+                sums[k] = counts.copy()
+                if k in fileLabels:
+                    labels[k] = fileLabels[k]
+            elif len(sums[k]) != len(counts):
+                raise ValueError("block %s of %s has %i values, expected %i"
+                                 % (k, filename, len(counts), len(sums[k])))
+            else:
+                sums[k] += counts
+    return (logZ, order, headers, sums, labels)
+
+def mergeSums(partials):
+    logZ = 0.0
+    order = []
+    headers = {}
+    sums = {}
+    labels = {}
+    for (partLogZ, partOrder, partHeaders, partSums, partLabels) in partials:
+        logZ += partLogZ
+        for k in partOrder:
+            if k not in sums:
+                order.append(k)
+                headers[k] = partHeaders[k]
+                sums[k] = partSums[k]
+                if k in partLabels:
+                    labels[k] = partLabels[k]
+            else:
+                sums[k] += partSums[k]
+    return (logZ, order, headers, sums, labels)
+
+def collectExpectations(filenames, jobs=1):
+    """
+    sumExpectations over chunks of files on jobs processes
+    """
+    chunks = [filenames[i:i + chunkFiles]
+              for i in range(0, len(filenames), chunkFiles)]
+    if jobs > 1 and len(chunks) > 1:
+        pool = multiprocessing.Pool(jobs)
+        partials = pool.imap(sumExpectations, chunks)
+        result = mergeSums(partials)
+        pool.close()
+        pool.join()
+        return result
+    return mergeSums([sumExpectations(c) for c in chunks])
+
+def applyMask(values, mask, key, average=False):
+    """
+    Replaces the entries fixed by a mask, and gives the entries tied by a
+    negative mask value their pooled sum, or mean with average
+    """
+    if key in mask and len(mask[key]) == len(values):
+        with np.errstate(invalid="ignore"):
+            tied = mask[key] < 0
+        fixed = ~np.isnan(mask[key]) & ~tied
+        values[fixed] = mask[key][fixed]
+        if tied.any():
+            ties = np.unique(mask[key][tied], return_inverse=True)[1]
+            pooled = np.bincount(ties, weights=values[tied])
+            if average:
+                pooled = pooled / np.bincount(ties)
+            values[tied] = pooled[ties]
+    return values
+
+def pseudoCount(header):
+    m = re.search("pseudo_count=([0-9.e+-]+)", header)
+    if m:
+        return float(m.group(1))
+    return 0.0
+
+def estimateParams(headers, sums, maskExpectations={}, maskParams={},
+                   labels={}):
+    """
+    Normalized parameters of every block from its expected counts
+    """
+    params = {}
+    for k in sums:
+        counts = applyMask(sums[k].copy(), maskExpectations, k)
+        counts = counts + pseudoCount(headers[k])
+        values = emConvergence.normalizeGroups(counts,
+                                               emConvergence.blockDims(headers[k]),
+                                               emConvergence.labelGroups(labels.get(k)))
+        params[k] = applyMask(values, maskParams, k, average=True)
+    return params
+
+def readFileList(filename):
+    if filename == "-":
+        f = sys.stdin
+    else:
+        f = open(filename, "r")
+    files = [line.strip() for line in f if line.strip()]
+    if f is not sys.stdin:
+        f.close()
+    return files
+
+def collectParameters(filenames, outFile, maskExpectationsFile=None,
+                      maskParamsFile=None, emIters=0, jobs=1):
+    (logZ, order, headers, sums, labels) = collectExpectations(filenames, jobs)
+    maskExpectations = {}
+    if maskExpectationsFile is not None:
+        maskExpectations = emConvergence.readMask(maskExpectationsFile)
+    maskParams = {}
+    if maskParamsFile is not None:
+        maskParams = emConvergence.readMask(maskParamsFile)
+    params = estimateParams(headers, sums, maskExpectations, maskParams,
+                            labels)
+    emConvergence.writeParams(outFile,
+                              "> parameters em_iters=%i logZ=%.12g" % (emIters,
+                                                                       logZ),
+                              [(headers[k], params[k]) for k in order], labels)
+    return logZ
+
+def usage(code=0):
+    print __doc__
+    if code != None: sys.exit(code)
+
+def main(args):
+    try:
+        opts, args = getopt.getopt(args, "m:e:p:i:j:")
+    except getopt.GetoptError, err:
+        print str(err)
+        usage(2)
+    if len(args) < 1:
+        usage(1)
+    outFile = args[0]
+    filenames = args[1:]
+    maskExpectationsFile = None
+    if os.path.exists("mask.expectations"):
+        maskExpectationsFile = "mask.expectations"
+    maskParamsFile = None
+    if os.path.exists("mask.params"):
+        maskParamsFile = "mask.params"
+    emIters = 0
+    jobs = 1
+    for o, a in opts:
+        if o == "-m":
+            filenames += readFileList(a)
+        elif o == "-e":
+            maskExpectationsFile = a
+        elif o == "-p":
+            maskParamsFile = a
+        elif o == "-i":
+            emIters = int(a)
+        elif o == "-j":
+            jobs = int(a)
+    if len(filenames) == 0:
+        print "no learned parameter files"
+        sys.exit(1)
+    collectParameters(filenames, outFile, maskExpectationsFile,
+                      maskParamsFile, emIters, jobs)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
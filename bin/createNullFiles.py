@@ -3,9 +3,10 @@ import os
 import sys
 import getopt
 import time
-import random
-import array
-import math
+import shutil
+import tempfile
+import multiprocessing
+import numpy as np
 
 #from guppy import hpy
 
@@ -19,6 +20,15 @@ batches = 1
 sameSample = False
 trueFileDir = ''
 geneIntersection = True
+seed = None
+jobs = 1
+naToken = "NA"
+floatPrecision = 12
+writeSidecars = False
+writeBufferSize = 1 << 20
+writeBlockCells = 1 << 18
+onlyBatch = None
+bucket = None
 
 def usage(code=0):
     print "createNullFiles.py: create null data files from tuples of data"
@@ -38,65 +48,154 @@ def usage(code=0):
     print "   -g float   minimum fraction of genes present in all files"
     print "   -t dir     write restricted true files here"
     print "   -u         use union of gene list rather than intersection"
+    print "   -r int     random seed, for reproducible null files"
+    print "   -j int     number of worker processes writing batches (default 1)"
+    print "   -d int     significant digits written for values (default 12)"
+    print "   -z         also write a binary .npz sidecar next to every output"
+    print "   -B int     write only this batch (1-based), needs -r; the files"
+    print "              are named as if all batches were written"
+    print "   -k int,int bucket,buckets: write only the rows of this slice of the"
+    print "              batch, the same rows whatever the slicing"
     print "   -q         don't output logging information"
     if code != None:
         sys.exit(code)
 
-class NamedMatrix(dict):
+class NamedMatrix(object):
+    """
+    A samples x genes float32 matrix, with indexes from sample (row) and
+    gene (column) names to positions
+    """
     @classmethod
     def fromFile(cls, filename, sep="\t"):
+        sidecar = sidecarFileName(filename)
+        if os.path.exists(sidecar) and \
+                os.path.getmtime(sidecar) >= os.path.getmtime(filename):
+            return cls.fromSidecar(filename)
         fh = open(filename, "r")
         header = fh.readline().rstrip("\r\n").split(sep)
         self = cls(header[0], header[1:])
+        numCols = len(self._colnames)
+        rownames = []
+        rowToIndex = {}
+        rows = []
         for l in fh:
             vals = l.rstrip("\r\n").split(sep)
-            fvals = array.array('f')
-            for v in vals[1:]:
-                try:
-                    fvals.append(float(v))
-                except ValueError:
-                    fvals.append(float('nan'))
-            self.addSample(vals[0], fvals)
+            fvals = np.empty(numCols, dtype=np.float32)
+            fvals.fill(np.nan)
+            n = min(len(vals) - 1, numCols)
+            try:
+                fvals[:n] = np.array(vals[1:n + 1], dtype=np.float32)
+            except ValueError:
+                for i, v in enumerate(vals[1:n + 1]):
+                    try:
+                        fvals[i] = float(v)
+                    except ValueError:
+                        pass
+            if vals[0] in rowToIndex:
+                rows[rowToIndex[vals[0]]] = fvals
+            else:
+                rowToIndex[vals[0]] = len(rownames)
+                rownames.append(vals[0])
+                rows.append(fvals)
         fh.close()
+        self.setData(rownames, rows)
         return self
-    def __init__(self, corner, colnames):
+    def __init__(self, corner, colnames, rownames=[], data=None):
         self._corner = corner
         self.__setColNames(colnames)
+        self.setData(rownames, data)
     def __setColNames(self, colnames):
-        self._colnames = colnames
+        self._colnames = list(colnames)
         self._nameToCol = dict(zip(self._colnames, range(len(self._colnames))))
+    def setData(self, rownames, data):
+        """
+        Replaces all rows, data is anything numpy can stack into a
+        len(rownames) x len(colnames) array
+        """
+        self._rownames = list(rownames)
+        self._rowToIndex = dict(zip(self._rownames,
+                                    range(len(self._rownames))))
+        if data is None or len(self._rownames) == 0:
+            self._data = np.empty((0, len(self._colnames)), dtype=np.float32)
+        elif isinstance(data, np.ndarray) and data.ndim == 2:
+            # keeps memory maps shared rather than copying them
+            self._data = np.asarray(data, dtype=np.float32)
+        else:
+            self._data = np.asarray(np.vstack(data), dtype=np.float32)
+    def keys(self):
+        return list(self._rownames)
+    def __len__(self):
+        return len(self._rownames)
+    def __contains__(self, sampleName):
+        return sampleName in self._rowToIndex
+    def __getitem__(self, sampleName):
+        return self._data[self._rowToIndex[sampleName]]
+    def rowIndexes(self, sampleNames):
+        return np.array([self._rowToIndex[s] for s in sampleNames],
+                        dtype=np.intp)
     def addSample(self, sampleName, vals):
         # print "adding sample %s with %i vals" % (sampleName, len(vals))
-        self[sampleName] = vals
+        vals = np.asarray(vals, dtype=np.float32)
+        if sampleName in self._rowToIndex:
+            self._data[self._rowToIndex[sampleName]] = vals
+        else:
+            self._rowToIndex[sampleName] = len(self._rownames)
+            self._rownames.append(sampleName)
+            self._data = np.vstack([self._data, vals])
     def restrictColumns(self, columnList):
         l = len(self._colnames)
-        colOrder = [self._nameToCol.get(name, l) for name in columnList]
-        for row in self.keys():
-            data = self[row]
-            data.append(float("nan"))
-            self[row] = array.array('f', [data[col] for col in colOrder])
+        colOrder = np.array([self._nameToCol.get(name, l)
+                             for name in columnList], dtype=np.intp)
+        padded = np.empty((len(self._rownames), l + 1), dtype=np.float32)
+        padded[:, :l] = self._data
+        padded[:, l] = np.nan
+        self._data = padded[:, colOrder]
         self.__setColNames(columnList)
     def describe(self):
-        print "%i rows, %i columns" % (len(self.keys()), len(self._colnames))
-    def writeLineToFile(self, fh, label, vals, sep="\t"):
-        fh.write(label)
-        for v in vals:
-            fh.write(sep)
-            try:
-                if not math.isnan(v):
-                    fh.write(str(v))
-                else:
-                    fh.write("NA")
-            except TypeError:
-                fh.write(str(v))
-        fh.write("\n")
-    def writeToFile(self, filename, sep="\t"):
-        fh = open(filename, "w")
-        self.writeLineToFile(fh, self._corner, self._colnames, sep)
-        for row in self.keys():
-            # print "writing row %s" % row
-            self.writeLineToFile(fh, row, self[row], sep)
+        print "%i rows, %i columns" % (len(self._rownames), len(self._colnames))
+    def formatRows(self, start, stop, sep="\t"):
+        """
+        Formats rows start:stop as text lines in one vectorized step
+        """
+        block = self._data[start:stop].astype(np.float64)
+        strings = np.char.mod("%%.%ig" % floatPrecision, block)
+        integral = np.char.isdigit(np.char.lstrip(strings, "-"))
+        strings = np.where(integral, np.char.add(strings, ".0"), strings)
+        strings[np.isnan(block)] = naToken
+        lines = []
+        for i in range(stop - start):
+            lines.append("%s%s%s\n" % (self._rownames[start + i], sep,
+                                        sep.join(strings[i])))
+        return "".join(lines)
+    def writeToFile(self, filename, sep="\t", sidecar=False):
+        fh = open(filename, "w", writeBufferSize)
+        fh.write("%s%s%s\n" % (self._corner, sep, sep.join(self._colnames)))
+        blockRows = max(1, writeBlockCells / max(1, len(self._colnames)))
+        for start in range(0, len(self._rownames), blockRows):
+            stop = min(start + blockRows, len(self._rownames))
+            fh.write(self.formatRows(start, stop, sep))
         fh.close()
+        if sidecar:
+            self.writeSidecar(filename)
+    def writeSidecar(self, filename):
+        """
+        Writes the matrix in binary next to its text file, fromFile reads
+        this instead of the text while it is newer than the text
+        """
+        np.savez(sidecarFileName(filename), data=self._data,
+                 corner=np.array(self._corner),
+                 rownames=np.array(self._rownames, dtype=str),
+                 colnames=np.array(self._colnames, dtype=str))
+    @classmethod
+    def fromSidecar(cls, filename):
+        npz = np.load(sidecarFileName(filename))
+        self = cls(str(npz["corner"]), [str(c) for c in npz["colnames"]],
+                   [str(r) for r in npz["rownames"]], npz["data"])
+        npz.close()
+        return self
+
+def sidecarFileName(filename):
+    return filename + ".npz"
 
 def outputFileName(outputPrefix, fn):
     path = outputPrefix + os.path.basename(fn)
@@ -106,14 +205,91 @@ def log(msg):
     if (verbose):
         sys.stderr.write(msg)
 
+def bucketRows(numSamples, bucket, buckets):
+    """
+    The null sample indexes of one bucket, contiguous and as even as possible
+    """
+    return np.array_split(np.arange(numSamples), buckets)[bucket]
+
+def nullBatch(b, numSamples, samples, genes, matrices, sampleRows, rng,
+              rowSubset=None):
+    """
+    Draws batch b of null samples for every matrix.  The same (sample, gene)
+    draws are used for all matrices so tuples across files are preserved.
+    The whole batch is always drawn, rowSubset only limits the rows that
+    are gathered.
+    """
+    numGenes = len(genes)
+    numOffset = 1 + numberingOffset + b*numSamples
+    if sameSample:
+        randomG = np.tile(np.arange(numGenes), (numSamples, 1))
+        for row in randomG:
+            rng.shuffle(row)
+        randomS = np.repeat(np.arange(numSamples)[:, np.newaxis],
+                            numGenes, axis=1)
+        names = [samplePrefix + "_" + str(b+1) + "_" + samples[i]
+                 for i in range(numSamples)]
+    else:
+        randomG = rng.randint(0, numGenes, size=(numSamples, numGenes))
+        randomS = rng.randint(0, len(samples), size=(numSamples, numGenes))
+        names = [samplePrefix + str(i + numOffset) for i in range(numSamples)]
+    if rowSubset is not None:
+        randomG = randomG[rowSubset]
+        randomS = randomS[rowSubset]
+        names = [names[i] for i in rowSubset]
+    nullM = []
+    for m, rows in zip(matrices, sampleRows):
+        nullM.append(NamedMatrix(m._corner, genes, names,
+                                 m._data[rows[randomS], randomG]))
+    return nullM
+
+def writeNullBatch(b, numSamples, files, samples, genes, matrices, sampleRows,
+                   rowSubset=None):
+    """
+    Writes batch b of the null files.  Every batch has its own random
+    stream seeded from (seed, b), so output doesn't depend on which
+    process writes which batch.
+    """
+    print "writing batch %i" % (b+1)
+    prefix = outputPrefix
+    if batches > 1 or onlyBatch is not None:
+        prefix += "_" + str(b + 1) +  "_"
+    rng = np.random.RandomState([seed, b])
+    nullM = nullBatch(b, numSamples, samples, genes, matrices, sampleRows, rng,
+                      rowSubset)
+    for fn, m in zip(files, nullM):
+        m.describe()
+        m.writeToFile(outputFileName(prefix, fn), sidecar=writeSidecars)
+
+sharedNullState = None
+
+def initNullWorker(shared):
+    """
+    Opens the input matrices saved by the parent read-only through memory
+    maps, so workers share the parent's data instead of copying it
+    """
+    global sharedNullState
+    matrices = []
+    for corner, dataFile in zip(shared["corners"], shared["dataFiles"]):
+        matrices.append(NamedMatrix(corner, shared["genes"], shared["samples"],
+                                    np.load(dataFile, mmap_mode="r")))
+    sharedNullState = dict(shared)
+    sharedNullState["matrices"] = matrices
+    sharedNullState["sampleRows"] = [m.rowIndexes(shared["samples"])
+                                     for m in matrices]
+
+def writeSharedNullBatch(b):
+    s = sharedNullState
+    writeNullBatch(b, s["numSamples"], s["files"], s["samples"], s["genes"],
+                   s["matrices"], s["sampleRows"])
+
 def createNullFiles(numSamples, files):
+    global seed
     #print hpy().heap()
     matrices = [NamedMatrix.fromFile(filename) for filename in files]
     #print hpy().heap()
-    samples = set(matrices[0].keys())
-    if len(matrices) > 1:
-        samples = samples.intersection(*[m.keys() for m in matrices[1:]])
-    samples = list(samples)
+    samples = [s for s in matrices[0].keys()
+               if all([s in m for m in matrices[1:]])]
     sampleFraction = [float(len(samples)) / len(m.keys()) for m in matrices]
     sFrac = [str(f) for f in sampleFraction]
     log("%i samples, fraction of each matrix: %s\n" % (len(samples), 
@@ -121,13 +297,21 @@ def createNullFiles(numSamples, files):
     if sameSample:
         numSamples = len(samples)
     
-    genes = set(matrices[0]._colnames)
-    if len(matrices) > 1:
-        if geneIntersection:
-            genes = genes.intersection(*[m._colnames for m in matrices[1:]])
-        else:
-            genes = genes.union(*[m._colnames for m in matrices[1:]])
-    genes = list(genes)
+    genes = []
+    seen = set()
+    for g in matrices[0]._colnames:
+        if g in seen:
+            continue
+        seen.add(g)
+        if not geneIntersection or \
+                all([g in m._nameToCol for m in matrices[1:]]):
+            genes.append(g)
+    if not geneIntersection:
+        for m in matrices[1:]:
+            for g in m._colnames:
+                if g not in seen:
+                    seen.add(g)
+                    genes.append(g)
     geneFraction = [float(len(genes)) / len(m._colnames) for m in matrices]
     gFrac = [str(f) for f in geneFraction]
     log("%i genes, fraction of each matrix: %s\n" % (len(genes), 
@@ -143,53 +327,60 @@ def createNullFiles(numSamples, files):
     print "restricting down to %d genes" % len(genes)
     for m in matrices:
         m.restrictColumns(genes)
+    sampleRows = [m.rowIndexes(samples) for m in matrices]
 
-    for b in range(batches):
-        print "writing batch %i" % (b+1)
-        nullM = [NamedMatrix(m._corner, genes) for m in matrices]
-        prefix = outputPrefix
-        numOffset = 1+ numberingOffset + b*numSamples
-        if batches > 1:
-            prefix += "_" + str(b + 1) +  "_"
-        for i in range(numSamples):
-            geneIndices = range(len(genes))
-            if sameSample:
-                random.shuffle(geneIndices)
-                randomG = geneIndices
-                randomS = [samples[i] for s in geneIndices]
-                sample = samplePrefix + "_" + str(b+1) + "_" + samples[i]
-            else:
-                randomG = [random.choice(geneIndices) for gi in geneIndices]
-                randomS = [random.choice(samples) for s in geneIndices]
-                sample = samplePrefix + str(i + numOffset)
-            for null, m in zip(nullM, matrices):
-                #data = [m[s][g] for s, g in zip(randomS, randomG)]
-                data = array.array('f')
-                for s, g in zip(randomS, randomG):
-                    data.append(m[s][g])
-                null.addSample(sample, data)
-                
-        for fn, m in zip(files, nullM):
-            m.describe()
-            m.writeToFile(outputFileName(prefix, fn))
+    if seed is None:
+        seed = np.random.RandomState().randint(0, 2**31 - 1)
+    log("using random seed %i\n" % seed)
+    if onlyBatch is not None:
+        rowSubset = None
+        if bucket is not None:
+            rowSubset = bucketRows(numSamples, bucket[0], bucket[1])
+        writeNullBatch(onlyBatch - 1, numSamples, files, samples, genes,
+                       matrices, sampleRows, rowSubset)
+    elif jobs > 1 and batches > 1:
+        shareDir = tempfile.mkdtemp(prefix="createNullFiles.",
+                                    dir=os.path.dirname(outputPrefix) or ".")
+        try:
+            shared = {"files" : files, "numSamples" : numSamples,
+                      "samples" : samples, "genes" : genes,
+                      "corners" : [m._corner for m in matrices],
+                      "dataFiles" : []}
+            for i, (m, rows) in enumerate(zip(matrices, sampleRows)):
+                dataFile = os.path.join(shareDir, "matrix%i.npy" % i)
+                np.save(dataFile, m._data[rows])
+                shared["dataFiles"].append(dataFile)
+            pool = multiprocessing.Pool(min(jobs, batches), initNullWorker,
+                                        (shared,))
+            try:
+                pool.map(writeSharedNullBatch, range(batches), 1)
+            finally:
+                pool.terminate()
+        finally:
+            shutil.rmtree(shareDir)
+    else:
+        for b in range(batches):
+            writeNullBatch(b, numSamples, files, samples, genes, matrices,
+                           sampleRows)
 
     if trueFileDir != '':
-        for fn, m in zip(files, matrices):
-            restrictM = NamedMatrix(m._corner, m._colnames)
-            for s in samples: restrictM.addSample(s, m[s]) 
+        for fn, m, rows in zip(files, matrices, sampleRows):
+            restrictM = NamedMatrix(m._corner, m._colnames, samples,
+                                    m._data[rows])
             outFileName = os.path.join(trueFileDir, os.path.basename(fn))
-            restrictM.writeToFile(outFileName)
+            restrictM.writeToFile(outFileName, sidecar=writeSidecars)
 
 def main(argv):
     try:
-        opts, args = getopt.getopt(argv[1:], "s:b:g:qp:o:t:u")
+        opts, args = getopt.getopt(argv[1:], "s:b:g:qp:o:t:ur:j:d:zB:k:")
     except getopt.GetoptError, err:
         print str(err)
         usage(2)
 
     global geneIntersection
     global minSampleFrac, minGeneFrac, outputPrefix, numberingOffset, verbose
-    global batches, trueFileDir, sameSample
+    global batches, trueFileDir, sameSample, seed, jobs
+    global floatPrecision, writeSidecars, onlyBatch, bucket
     for o, a in opts:
         if o == "-s":
             minSampleFrac = float(a)
@@ -208,10 +399,25 @@ def main(argv):
         if o == "-u":
             geneIntersection = False
             minGeneFrac = 0.0
+        if o == "-r":
+            seed = int(a)
+        if o == "-j":
+            jobs = int(a)
+        if o == "-d":
+            floatPrecision = int(a)
+        if o == "-z":
+            writeSidecars = True
+        if o == "-B":
+            onlyBatch = int(a)
+        if o == "-k":
+            bucket = tuple([int(v) for v in a.split(",")])
 
     if (len(args) < 2):
         print "Not enough arguments: specify number of samples and >=1 file"
         usage(1)
+    if onlyBatch is not None and seed is None:
+        print "Writing a single batch with -B needs the run's seed (-r)"
+        usage(1)
 
     if args[0] == "same":
         sameSample = True
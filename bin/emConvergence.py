@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+"""emConvergence.py: EM convergence tests and acceleration for paradigm
+
+Reads the CondProbEstimation blocks of successive params%i.txt files and
+decides when EM has converged: after at least minIters rounds, when the
+relative logZ improvement between the last two rounds drops below
+tolerance, when no parameter moves more than paramTolerance, or after
+maxIters rounds.  Optionally
+extrapolates each new parameter set along the last EM step, keeping masked
+(mask.params) entries and renormalizing every target_dim group, and backs
+off when a round loses likelihood.  Each round is appended to emLog.tab.
+
+Usage:
+  emConvergence.py [options] iteration
+
+Options:
+   -t flt     relative logZ improvement to stop at (default 0.001)
+   -p flt     largest parameter change to stop at (default: not used)
+   -m int     minimum EM rounds (default 3)
+   -M int     maximum EM rounds (default: no limit)
+   -a         extrapolate the parameters of each round
+
+Prints "converged" or "continue" for params<iteration+1>.txt.
+"""
+import os, sys, re, getopt
+import numpy as np
+
+logFile = "emLog.tab"
+logColumns = ["iteration", "logZ", "improvement", "max_param_delta",
+              "max_delta_block", "e_seconds", "m_seconds", "step", "status"]
+maskFile = "mask.params"
+minimumProbability = 1e-6
+
+class Settings(object):
+    """
+    EM stopping, acceleration and parameter collection settings
+    """
+    def __init__(self, tolerance=0.001, paramTolerance=None, minIters=3,
+                 maxIters=None, accelerate=False, step=1.0, collectJobs=1,
+                 externalCollect=False):
+        self.tolerance = tolerance
+        self.paramTolerance = paramTolerance
+        self.minIters = minIters
+        self.maxIters = maxIters
+        self.accelerate = accelerate
+        self.step = step
+        self.collectJobs = collectJobs
+        self.externalCollect = externalCollect
+
+def paramsFile(iteration):
+    return "params%i.txt" % iteration
+
+def parseParamLine(line):
+    """
+    Returns the index fields and the value of a params line, either "value"
+    or the public paradigm's "i<tab>j<tab>value"
+    """
+    parts = line.strip().split("\t")
+    return ("\t".join(parts[:-1]), float(parts[-1]))
+
+def readParams(filename, labels=False):
+    """
+    Returns the header line and the (header, values) blocks of a params
+    file, and with labels also the index fields of the lines of every block
+    that has them, keyed by block
+    """
+    f = open(filename, "r")
+    header = f.readline().rstrip("\n")
+    blocks = []
+    fields = []
+    for line in f:
+        line = line.rstrip("\r\n")
+        if line.startswith(">"):
+            blocks.append((line, []))
+            fields.append([])
+        elif line.strip() != "" and len(blocks) > 0:
+            (index, value) = parseParamLine(line)
+            blocks[-1][1].append(value)
+            fields[-1].append(index)
+    f.close()
+    blocks = [(h, np.array(v)) for (h, v) in blocks]
+    if labels:
+        return (header, blocks,
+                dict([(blockKey(h), l) for ((h, v), l) in zip(blocks, fields)
+                      if len(l) > 0 and l[0] != ""]))
+    return (header, blocks)
+
+def blockKey(header):
+    """
+    Identifies a block across params and mask files
+    """
+    return header.lstrip("> ").replace("mask ", "", 1)
+
+def blockDims(header):
+    m = re.search("target_dim=(\d+)", header)
+    if m:
+        return int(m.group(1))
+    return None
+
+def labelGroups(fields):
+    """
+    The parent state (j) of every line of a public paradigm block, whose
+    values are normalized over i for each j
+    """
+    if fields is None:
+        return None
+    return np.unique([l.split("\t")[-1] for l in fields], return_inverse=True)[1]
+
+def readLogZ(header):
+    m = re.search("logZ=([0-9.e+-]*)", header)
+    return float(m.group(1))
+
+def writeParams(filename, header, blocks, labels={}):
+    """
+    Writes a params file, with the index fields in labels in front of the
+    values of their blocks
+    """
+    f = open(filename, "w")
+    f.write(header + "\n")
+    for (h, values) in blocks:
+        f.write(h + "\n")
+        fields = labels.get(blockKey(h))
+        for i, v in enumerate(values):
+            if fields is not None:
+                f.write("%s\t%.12g\n" % (fields[i], v))
+            else:
+                f.write("%.12g\n" % v)
+    f.close()
+
+def readMask(filename=maskFile):
+    """
+    Mask values keyed by block, NaN where parameters are free
+    """
+    if not os.path.exists(filename):
+        return {}
+    (header, blocks) = readParams(filename)
+    return dict([(blockKey(h), v) for (h, v) in blocks])
+
+def blockDeltas(prevBlocks, currBlocks):
+    """
+    The largest absolute change of every block present in both parameter sets
+    """
+    prev = dict([(blockKey(h), v) for (h, v) in prevBlocks])
+    deltas = {}
+    for (h, v) in currBlocks:
+        k = blockKey(h)
+        if k in prev and len(prev[k]) == len(v) and len(v) > 0:
+            deltas[k] = float(np.nanmax(np.abs(v - prev[k])))
+    return deltas
+
+def normalizeGroups(values, dims, groups=None):
+    """
+    Normalizes every run of dims values, or every set of values with the
+    same entry in groups when it is given
+    """
+    if groups is not None and len(groups) == len(values):
+        sums = np.bincount(groups, weights=values)
+        sums[sums == 0] = 1.0
+        return values / sums[groups]
+    if dims is None or dims == 0 or len(values) % dims != 0:
+        return values
+    groups = values.reshape(-1, dims)
+    sums = groups.sum(axis=1)
+    sums[sums == 0] = 1.0
+    return (groups / sums[:, np.newaxis]).reshape(-1)
+
+def extrapolate(prevBlocks, currBlocks, step, mask={}, labels={}):
+    """
+    Moves every block step times further along prev -> curr, clipped to
+    valid probabilities and renormalized, with masked entries restored
+    """
+    prev = dict([(blockKey(h), v) for (h, v) in prevBlocks])
+    blocks = []
+    for (h, v) in currBlocks:
+        k = blockKey(h)
+        if k not in prev or len(prev[k]) != len(v):
+            blocks.append((h, v))
+            continue
+        moved = v + step * (v - prev[k])
+        moved = np.where(v > 0, np.maximum(moved, minimumProbability), 0.0)
+        fixed = None
+        if k in mask and len(mask[k]) == len(v):
+            fixed = ~np.isnan(mask[k])
+            moved[fixed] = v[fixed]
+        moved = normalizeGroups(moved, blockDims(h), labelGroups(labels.get(k)))
+        if fixed is not None:
+            moved[fixed] = v[fixed]
+        blocks.append((h, moved))
+    return blocks
+
+def readLog(filename=logFile):
+    rows = []
+    if not os.path.exists(filename):
+        return rows
+    f = open(filename, "r")
+    f.readline()
+    for line in f:
+        rows.append(dict(zip(logColumns, line.rstrip("\n").split("\t"))))
+    f.close()
+    return rows
+
+def appendLog(row, filename=logFile):
+    if not os.path.exists(filename):
+        f = open(filename, "w")
+        f.write("\t".join(logColumns) + "\n")
+        f.close()
+    f = open(filename, "a")
+    f.write("\t".join([str(row.get(c, "")) for c in logColumns]) + "\n")
+    f.close()
+
+def loggedStatus(iteration, filename=logFile):
+    """
+    The logged outcome of a round, or None if it wasn't checked yet
+    """
+    status = None
+    for row in readLog(filename):
+        if row.get("iteration") == str(iteration):
+            status = row.get("status")
+    return status
+
+def lastStep(filename=logFile):
+    """
+    The extrapolation step of the previous round, or None
+    """
+    for row in reversed(readLog(filename)):
+        if row.get("step", "") not in ("", "0"):
+            return float(row["step"])
+    return None
+
+def checkIteration(iteration, settings, eSeconds=None, mSeconds=None):
+    """
+    Called after params<iteration+1>.txt is collected: logs the round,
+    extrapolates the new parameters when enabled, and returns whether EM
+    has converged
+    """
+    rounds = iteration + 1
+    (header, curr, labels) = readParams(paramsFile(iteration + 1), labels=True)
+    currLL = readLogZ(header)
+    (prevHeader, prev) = readParams(paramsFile(iteration))
+    prevLL = readLogZ(prevHeader)
+    deltas = blockDeltas(prev, curr)
+    maxDelta = max([0.0] + deltas.values())
+    maxBlock = ""
+    if len(deltas) > 0:
+        maxBlock = max(deltas.keys(), key=lambda k: deltas[k]).split(" ")[-1]
+    if iteration == 0 or prevLL <= -1e300:
+        improvement = float("inf")
+    else:
+        improvement = (prevLL - currLL) / currLL
+    status = "continue"
+    if rounds < settings.minIters:
+        pass
+    elif settings.maxIters is not None and rounds >= settings.maxIters:
+        status = "max_iters"
+    elif improvement < settings.tolerance \
+            and (improvement >= 0 or not settings.accelerate):
+        status = "logZ"
+    elif settings.paramTolerance is not None \
+            and maxDelta < settings.paramTolerance:
+        status = "params"
+    step = 0.0
+    if settings.accelerate and status == "continue" and iteration > 0:
+        step = lastStep()
+        if step is None:
+            step = settings.step
+        elif improvement < 0:
+            ## the last extrapolation lost likelihood, back off
+            step = step / 2
+        else:
+            step = min(step * 2, 4.0)
+        os.rename(paramsFile(iteration + 1),
+                  paramsFile(iteration + 1) + ".em")
+        writeParams(paramsFile(iteration + 1), header,
+                    extrapolate(prev, curr, step, readMask(), labels), labels)
+    row = {"iteration" : iteration, "logZ" : "%g" % currLL,
+           "improvement" : "%g" % improvement,
+           "max_param_delta" : "%g" % maxDelta, "max_delta_block" : maxBlock,
+           "step" : "%g" % step, "status" : status}
+    if eSeconds is not None:
+        row["e_seconds"] = "%.1f" % eSeconds
+    if mSeconds is not None:
+        row["m_seconds"] = "%.1f" % mSeconds
+    appendLog(row)
+    return status != "continue"
+
+def usage(code=0):
+    print __doc__
+    if code != None: sys.exit(code)
+
+def main(args):
+    try:
+        opts, args = getopt.getopt(args, "t:p:m:M:a")
+    except getopt.GetoptError, err:
+        print str(err)
+        usage(2)
+    if len(args) != 1:
+        usage(1)
+    settings = Settings()
+    for o, a in opts:
+        if o == "-t":
+            settings.tolerance = float(a)
+        elif o == "-p":
+            settings.paramTolerance = float(a)
+        elif o == "-m":
+            settings.minIters = int(a)
+        elif o == "-M":
+            settings.maxIters = int(a)
+        elif o == "-a":
+            settings.accelerate = True
+    if checkIteration(int(args[0]), settings):
+        print "converged"
+    else:
+        print "continue"
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
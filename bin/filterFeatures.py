@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import sys, os
+import iplStore
 
 args = list(sys.argv)
 args.pop(0) # remove the script name
@@ -16,6 +17,17 @@ filter = args[1]
 count = int(count)
 cutoff = float(cutoff)
 
+if iplStore.isStore(args[0]):
+    store = iplStore.IPLStore(args[0])
+    columns = None
+    if filterNA:
+        columns = (~store.nulls).nonzero()[0]
+    sys.stdout.write(store.header())
+    for line in store.lines(rows = lambda start, block:
+                            iplStore.selectRows(block, count, cutoff, columns)):
+        sys.stdout.write(line)
+    sys.exit(0)
+
 file = open(args[0])
 header = file.readline()
 sys.stdout.write(header)
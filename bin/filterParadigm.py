@@ -3,8 +3,10 @@
 filterParadigm.py
     by Sam Ng, Steve Benz, Charles Vaske, and Kyle Ellrott
 """
-import logging, os, re, sys
+import logging, operator, os, re, sys
 from optparse import OptionParser
+import numpy as np
+import iplStore, nullSignificance
 
 ## logger
 logging.basicConfig(filename="filter-paradigm.log", level=logging.INFO)
@@ -13,9 +15,133 @@ logging.basicConfig(filename="filter-paradigm.log", level=logging.INFO)
 bin_dir = os.path.dirname(os.path.abspath(__file__))
 filter_exec = "%s/%s" % (bin_dir, "filterFeatures.py")
 
+def readChunks(f, chunk_rows):
+    chunk = []
+    for line in f:
+        chunk.append(line)
+        if len(chunk) >= chunk_rows:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+def countAbove(rows, header_width, count_cols, options):
+    """
+    Mask of the split rows with at least count values >= min among the
+    counted columns, parsing only those columns when the rows are complete
+    """
+    if all([len(row) == header_width + 1 for row in rows]):
+        if len(count_cols) == 0:
+            return np.zeros(len(rows), dtype=bool)
+        getter = operator.itemgetter(*[c + 1 for c in count_cols])
+        fields = [getter(row) for row in rows]
+        if len(count_cols) == 1:
+            fields = [[field] for field in fields]
+        values = iplStore.parseRows(fields, len(count_cols), np.float64)
+        counted = np.ones(len(rows), dtype=int)
+    else:
+        width = max([header_width] + [len(row) - 1 for row in rows])
+        counting = np.ones(width, dtype=bool)
+        counting[:header_width] = False
+        counting[count_cols] = True
+        values = iplStore.parseRows([row[1:] for row in rows], width,
+                                    np.float64)[:, counting]
+        fields = np.array([len(row) - 1 for row in rows])
+        counted = (np.nonzero(counting)[0][np.newaxis, :] < fields[:, np.newaxis]).sum(axis=1)
+    with np.errstate(invalid="ignore"):
+        counts = (np.abs(values) >= options.min).sum(axis=1)
+    return (counts >= options.count) & (counted > 0)
+
+def filterText(input_file, options, selected=None):
+    """
+    Writes the three outputs in one pass over the matrix, counting the
+    values >= min of a chunk of rows at a time, or keeping the selected
+    rows when a row mask is given
+    """
+    f = open(input_file, "r")
+    o = open(options.filtered_all, "w")
+    o_ur = open(options.unfiltered_real, "w")
+    o_fr = open(options.filtered_real, "w")
+    
+    header = f.readline()
+    o.write(header)
+    headerA = header.split("\t")[1:]
+    count_cols = [i for i, sample in enumerate(headerA)
+                  if not (options.filter_na and sample[:3] == "na_")]
+    sample_names = header.rstrip().split("\t")[1:]
+    include_cols = [i + 1 for i, sample in enumerate(sample_names)
+                    if not (sample.startswith("na_") or sample.startswith("nw_"))]
+    data = [sample_names[i - 1] for i in include_cols]
+    o_ur.write("%s\t%s\n" % ("id", "\t".join(data)))
+    o_fr.write("%s\t%s\n" % ("id", "\t".join(data)))
+    getter = operator.itemgetter(*include_cols + [0])
+    last_col = max(include_cols + [0])
+    row = 0
+    for lines in readChunks(f, options.chunk_rows):
+        rows = [line.strip("\n").split("\t") for line in lines]
+        if selected is None:
+            select = countAbove(rows, len(headerA), count_cols, options)
+        else:
+            select = selected[row:row + len(lines)]
+        row += len(lines)
+        for i, line in enumerate(lines):
+            parts = rows[i]
+            if len(line.rstrip()) != len(line) - 1:
+                ## the real outputs drop all trailing whitespace
+                parts = line.rstrip().split("\t")
+            if len(parts) > last_col:
+                data = getter(parts)[:-1]
+            else:
+                data = [parts[c] if c < len(parts) else "" for c in include_cols]
+            real = "%s\t%s\n" % (parts[0], "\t".join(data))
+            o_ur.write(real)
+            if select[i]:
+                o.write(line)
+                o_fr.write(real)
+    f.close()
+    o.close()
+    o_ur.close()
+    o_fr.close()
+
+def filterStore(store_dir, options, selected=None):
+    """
+    Writes the three outputs from a binary IPL store, a chunk at a time
+    """
+    store = iplStore.IPLStore(store_dir)
+    count_cols = None
+    if options.filter_na:
+        count_cols = np.nonzero(~store.nulls)[0]
+    real_cols = [i for i, sample in enumerate(store.samples)
+                 if not (sample.startswith("na_") or sample.startswith("nw_"))]
+    o = open(options.filtered_all, "w")
+    o_ur = open(options.unfiltered_real, "w")
+    o_fr = open(options.filtered_real, "w")
+    o.write(store.header())
+    data = [store.samples[i] for i in real_cols]
+    o_ur.write("%s\t%s\n" % ("id", "\t".join(data)))
+    o_fr.write("%s\t%s\n" % ("id", "\t".join(data)))
+    for (start, block) in store.chunks():
+        if selected is None:
+            select = iplStore.selectRows(block, options.count, options.min, count_cols)
+        else:
+            select = selected[start:start + block.shape[0]]
+        present = store.present(start, block)
+        for i in range(block.shape[0]):
+            feature = store.entities[start + i]
+            values = np.asarray(block[i])
+            mask = np.asarray(present[i])
+            real = "%s\t%s\n" % (feature, "\t".join(iplStore.formatRow(values[real_cols], mask[real_cols])))
+            o_ur.write(real)
+            if select[i]:
+                o.write("\t".join([feature] + iplStore.formatRow(values, mask)) + "\n")
+                o_fr.write(real)
+    o.close()
+    o_ur.close()
+    o_fr.close()
+
 def main():
     ## parse arguments
-    parser = OptionParser(usage = "%prog [options] unfiltered_all")
+    parser = OptionParser(usage = "%prog [options] unfiltered_all|ipl_store")
     parser.add_option("--fr", "--filter-real", dest="filtered_real", default="filtered.real.tab",
                       help="Feature-filtered output with only reals")
     parser.add_option("--fa", "--filter-all", dest="filtered_all", default="filtered.all.tab",
@@ -28,67 +154,30 @@ def main():
                       help="Filter Count")
     parser.add_option("-m", "--min", dest="min", type=float, default=0.5,
                       help="Min IPL Value")
+    parser.add_option("--fdr", dest="fdr", type=float, default=None,
+                      help="Keep features with count real samples at this q-value against their nulls instead of using min")
+    parser.add_option("--sig", "--significance", dest="significance", default=None,
+                      help="Q-value matrix output when filtering with --fdr")
+    parser.add_option("--chunk", dest="chunk_rows", type=int, default=1000,
+                      help="Rows filtered at a time")
     options, args = parser.parse_args()
     
     if len(args) != 1:
         logging.error("ERROR: incorrect number of arguments\n")
         sys.exit(1)
     input_file = os.path.abspath(args[0]) 
+    selected = None
+    if options.fdr is not None:
+        (entities, samples, p, q) = nullSignificance.scoreMatrix(input_file, options.chunk_rows)
+        selected = nullSignificance.significantRows(q, options.fdr, options.count)
+        logging.info("%i of %i features at q <= %g" % (selected.sum(), len(entities), options.fdr))
+        if options.significance is not None:
+            nullSignificance.writeMatrix(options.significance, entities, samples, q)
+    if iplStore.isStore(input_file):
+        filterStore(input_file, options, selected)
+        return
     
-    select = {}
-    f = open(input_file, "r")
-    o = open(options.filtered_all, "w")
-    
-    header = f.readline()
-    o.write(header)
-    headerA = header.split("\t")
-    headerA.pop(0)
-    
-    for line in f:
-        lineA = line.strip("\n").split("\t")
-        row_name = lineA.pop(0)
-        current_count = 0
-        #for val in lineA:
-        for i in range(len(lineA)):
-            val = lineA[i]
-            if options.filter_na and headerA[i][:3] == "na_":
-                continue
-            try:
-                if abs(float(val)) >= options.min:
-                    current_count += 1
-            except ValueError:
-                pass
-            if current_count >= options.count:
-                o.write(line)
-                select[row_name] = True
-                break
-    o.close()
-    f.close()
-    
-    o_ur = open(options.unfiltered_real, "w")
-    o_fr = open(options.filtered_real, "w")    
-    f = open(input_file, "r")
-    sample_names = f.readline().rstrip().split("\t")[1:]
-    include_cols = []
-    for i, sample in enumerate(sample_names):
-        if sample.startswith("na_") or sample.startswith("nw_"):
-            continue
-        include_cols.append(i)
-    data = [sample_names[i] for i in include_cols]
-    o_ur.write("%s\t%s\n" % ("id", "\t".join(data)))
-    o_fr.write("%s\t%s\n" % ("id", "\t".join(data)))
-    for line in f:
-        parts = line.rstrip().split("\t")
-        feature = parts[0]
-        data = [parts[i+1] for i in include_cols]
-        
-        o_ur.write("%s\t%s\n" % (feature, "\t".join(data)))
-        if feature in select:
-            o_fr.write("%s\t%s\n" % (feature, "\t".join(data)))
-    
-    f.close()
-    o_ur.close()
-    o_fr.close()
+    filterText(input_file, options, selected)
 
 if __name__ == "__main__":
     main()
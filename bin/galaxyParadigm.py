@@ -3,11 +3,20 @@
 galaxyParadigm.py
     by Sam Ng, Steve Benz, Charles Vaske, and Kyle Ellrott
 """
-import glob, logging, os, re, resource, shutil, sys, zipfile
+import glob, logging, os, re, resource, shutil, sys, time, zipfile
 
 from optparse import OptionParser
-from jobTree.scriptTree.target import Target
-from jobTree.scriptTree.stack import Stack
+try:
+    from jobTree.scriptTree.target import Target
+    from jobTree.scriptTree.stack import Stack
+except ImportError:
+    ## jobTree is only needed without --local
+    class Target(object):
+        def __init__(self, time=None):
+            pass
+    Stack = None
+import paradigmProfile, localScheduler, jobManifest, emConvergence
+import collectParameters, incrementalMerge, iplStore
 
 ## logger
 logging.basicConfig(filename="galaxy-paradigm.log", level=logging.INFO)
@@ -20,12 +29,19 @@ collect_exec = os.path.join(bin_dir, "collectParameters")
 batch_exec = os.path.join(bin_dir, "mergeSwarmFiles.py")
 merge_exec = os.path.join(bin_dir, "merge_merged.py")
 filter_exec = os.path.join(bin_dir, "filterFeatures.py")
+profile_exec = os.path.join(bin_dir, "paradigmProfile.py")
 
 ## defaults
 standard_dogma = os.path.join(bin_dir, "dogma_standard.zip")
 standard_pathway = os.path.join(bin_dir, "pathway_constitutive_v2.zip")
 standard_inference = "method=BP,updates=SEQFIX,tol=1e-9,maxiter=10000,logdomain=0"
 
+## checkpoint manifests
+def emManifest(iteration):
+    return os.path.join("manifests", "em%i" % iteration)
+final_manifest = os.path.join("manifests", "final")
+merge_state = "mergeState"
+
 ## functions
 def commandAvailable(executable):
     return(os.system("which %s > /dev/null 2> /dev/null" % executable) == 0)
@@ -35,20 +51,234 @@ def zipDirectory(directory, zip):
         for file in files:
             zip.write(os.path.join(root, file), os.path.join(root, file).lstrip(directory).lstrip("/"))
 
+def readJobList(filename):
+    f = open(filename, "r")
+    jobs = [job for job in f]
+    f.close()
+    return jobs
+
+## run steps, shared by the jobTree targets and the local scheduler
+def prepareStep(evidence_spec, disc, param_file, null_size, paradigm_exec, inference_spec, dogma_lib, pathway_lib, paradigm_public):
+    if os.path.exists("clusterFiles/"):
+        assert os.path.exists("jobs.list")
+        assert os.path.exists("jobsEM.list")
+        assert os.path.exists("config.txt")
+        assert os.path.exists("configEM.txt")
+        assert os.path.exists("params0.txt")
+    else:
+        optional_flags = " "
+        if paradigm_public:
+            optional_flags += "-y "
+        if param_file is not None:
+            optional_flags += "-t %s " % (param_file)
+        cmd = "%s %s%s -b \"%s\" -s same -n %s -i %s -e %s -d %s -p %s %s" \
+                                                            % (sys.executable,
+                                                               prepare_exec,
+                                                               optional_flags,
+                                                               disc,
+                                                               null_size,
+                                                               inference_spec,
+                                                               paradigm_exec,
+                                                               dogma_lib,
+                                                               pathway_lib,
+                                                               evidence_spec)
+        l = open("prepare.log", "w")
+        l.write("# " + cmd + "\n")
+        l.close()
+        os.system(cmd + " >> prepare.log")
+
+def expectationStep(iteration):
+    """
+    Points params.txt and outputFilesEM at the iteration, returning its jobs
+    """
+    os.system("rm -f params.txt")
+    os.system("ln -s params%i.txt params.txt" % iteration)
+    os.system("mkdir -p outputFilesEM%i" % iteration)
+    os.system("rm -f outputFilesEM")
+    os.system("ln -s outputFilesEM%i outputFilesEM" % iteration)
+    logging.info("Current directory: %s\n" % (os.getcwd()))
+    return readJobList("jobsEM.list")
+
+def maximizationStep(iteration, em, e_seconds=None):
+    """
+    Collects the iteration's expectations into the next params file,
+    returning whether EM has terminated
+    """
+    start = time.time()
+    jobManifest.consolidate(emManifest(iteration))
+    learned = [o for job in readJobList("jobsEM.list")
+               for o in jobManifest.jobOutputs(job)
+               if o.endswith("_learned_parameters.fa")]
+    if em.externalCollect:
+        cmd = "%s -p %s " % (collect_exec, " ".join(learned))
+        if (os.path.exists("mask.expectations")):
+            cmd += " mask.expectations "
+        cmd += "| %s -o params%i.txt /dev/stdin " \
+                    % (collect_exec, iteration + 1)
+        if (os.path.exists("mask.params")):
+            cmd += " mask.params "
+        os.system(cmd)
+    else:
+        mask_expectations = None
+        if os.path.exists("mask.expectations"):
+            mask_expectations = "mask.expectations"
+        mask_params = None
+        if os.path.exists("mask.params"):
+            mask_params = "mask.params"
+        collectParameters.collectParameters(learned,
+                                            "params%i.txt" % (iteration + 1),
+                                            mask_expectations, mask_params,
+                                            iteration + 1, em.collectJobs)
+    terminated = emConvergence.checkIteration(iteration, em, e_seconds,
+                                              time.time() - start)
+    logging.info("EM iteration %d: %s" % (iteration,
+                                          emConvergence.loggedStatus(iteration)))
+    return terminated
+
+def finalStep(iteration, incremental=False):
+    """
+    Points params.txt at the final parameters, returning the final jobs.
+    The incremental merge state is kept when a run is resumed with the
+    same parameters and jobs.
+    """
+    os.system("rm -f params.txt")
+    os.system("ln -s params%i.txt params.txt" % iteration)
+    if incremental and incrementalMerge.startRun(merge_state,
+            incrementalMerge.runSignature(["params%i.txt" % iteration,
+                                           "jobs.list", "config.txt"])):
+        logging.info("started a new incremental merge state")
+    os.system("mkdir -p outputFiles")
+    return readJobList("jobs.list")
+
+def foldOutputs(command):
+    """
+    Folds the final run outputs of a finished job into the incremental merge
+    """
+    incrementalMerge.foldFiles(merge_state,
+                               [o for o in jobManifest.jobOutputs(command)
+                                if o.startswith("outputFiles/")])
+
+def mergeStep(profile, jobs=1, incremental=False):
+    jobManifest.consolidate(final_manifest)
+    os.system("mkdir -p mergeFiles")
+    if incremental:
+        incrementalMerge.finish(merge_state, "outputFiles", "mergeFiles",
+                                jobs=jobs)
+    else:
+        os.system("%s %s -j %d outputFiles mergeFiles" % (sys.executable,
+                                                          batch_exec, jobs))
+    mergeFiles = glob.glob("mergeFiles/*transpose*")
+    if len(mergeFiles) == 1:
+        os.system("cat %s | sed 's/ loglikelihood=-[0-9.]*//g' > merge_merged_unfiltered.all.tab" % (mergeFiles[0]))
+    else:
+        os.system("%s %s bioInt mergeFiles/" % (sys.executable, merge_exec))
+    if profile:
+        os.system("%s %s %s > profile.log 2>&1" % (sys.executable, profile_exec,
+                                                  paradigmProfile.profileDir))
+
+def runLocalJobs(list_file, manifest, slots, timeout, profile, on_success=None):
+    """
+    Runs a job list with the local scheduler, returning whether all jobs
+    succeeded
+    """
+    wrapper = None
+    if profile:
+        wrapper = [sys.executable, profile_exec, "-r"]
+    failed = localScheduler.runJobList(list_file, slots, timeout, manifest,
+                                       wrapper, on_success)
+    if len(failed) > 0:
+        logging.error("ERROR: %d jobs of %s failed, rerun to resume\n"
+                      % (len(failed), list_file))
+        return False
+    return True
+
+def localRun(evidence_spec, disc, param_file, null_size, paradigm_exec, inference_spec, dogma_lib, pathway_lib, run_em, directory, paradigm_public, slots, timeout=None, profile=False, em=None, incremental=False):
+    """
+    Runs prepare, EM, the final run and the merge on this machine, returning
+    the number of failed steps.  Completed EM iterations and jobs are
+    skipped when a run is resumed.
+    """
+    os.chdir(directory)
+    logging.info("starting prepare")
+    prepareStep(evidence_spec, disc, param_file, null_size, paradigm_exec,
+                inference_spec, dogma_lib, pathway_lib, paradigm_public)
+    if em is None:
+        em = emConvergence.Settings()
+    iteration = 0
+    if run_em:
+        while True:
+            status = emConvergence.loggedStatus(iteration)
+            if status is not None:
+                logging.info("EM iteration %d already complete" % (iteration))
+                terminated = status != "continue"
+            else:
+                logging.info("EM iteration %d" % (iteration))
+                start = time.time()
+                expectationStep(iteration)
+                if not runLocalJobs("jobsEM.list", emManifest(iteration),
+                                    slots, timeout, profile):
+                    return 1
+                terminated = maximizationStep(iteration, em,
+                                              time.time() - start)
+            iteration += 1
+            if terminated:
+                break
+    logging.info("final run with params%i.txt" % (iteration))
+    finalStep(iteration, incremental)
+    on_success = None
+    if incremental:
+        on_success = foldOutputs
+    if not runLocalJobs("jobs.list", final_manifest, slots, timeout, profile,
+                        on_success):
+        return 1
+    mergeStep(profile, slots, incremental)
+    return 0
+
+def copyOutputs(options):
+    shutil.copy(os.path.join(options.work_dir, "merge_merged_unfiltered.all.tab"), options.output_ipls)
+    if options.output_store is not None:
+        if iplStore.isStore(options.output_store):
+            shutil.rmtree(options.output_store)
+        elif os.path.exists(options.output_store):
+            logging.error("ERROR: %s exists and is not an IPL store\n" % (options.output_store))
+            sys.exit(1)
+        iplStore.buildStore(os.path.join(options.work_dir, "merge_merged_unfiltered.all.tab"), options.output_store)
+    if options.output_params is not None:
+        shutil.copy(os.path.join(options.work_dir, "params.txt"), options.output_params)
+    if options.output_config is not None:
+        shutil.copy(os.path.join(options.work_dir, "config.txt"), options.output_config)
+    if options.output_files is not None:
+        zip_file = zipfile.ZipFile("outputFiles.zip", "w")
+        zipDirectory("outputFiles", zip_file)
+        zip_file.close()
+        shutil.copy(os.path.join(options.work_dir, "outputFiles.zip"), options.output_files)
+
 ## jt classes
 class ParadigmCommand(Target):
-    def __init__(self, command, directory):
+    def __init__(self, command, directory, profile=False, manifest=None, incremental=False):
         Target.__init__(self, time=1000)
         self.command = command
         self.directory = directory
+        self.profile = profile
+        self.manifest = manifest
+        self.incremental = incremental
     def run(self):
         os.chdir(self.directory)
         
         resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
-        os.system(self.command)
+        if self.manifest is not None:
+            inputs = jobManifest.inputsHash(self.command)
+        if self.profile:
+            status = paradigmProfile.runJobLine(self.command)
+        else:
+            status = os.system(self.command)
+        if self.manifest is not None:
+            jobManifest.writeRecord(self.manifest, self.command, inputs, status)
+        if self.incremental and status == 0:
+            foldOutputs(self.command)
 
 class PrepareParadigm(Target):
-    def __init__(self, evidence_spec, disc, param_file, null_size, paradigm_exec, inference_spec, dogma_lib, pathway_lib, run_em, directory, paradigm_public):
+    def __init__(self, evidence_spec, disc, param_file, null_size, paradigm_exec, inference_spec, dogma_lib, pathway_lib, run_em, directory, paradigm_public, profile=False, em=None, incremental=False):
         Target.__init__(self, time=10000)
         self.evidence_spec = evidence_spec
         self.disc = disc
@@ -61,133 +291,102 @@ class PrepareParadigm(Target):
         self.run_em = run_em
         self.directory = directory
         self.paradigm_public = paradigm_public
+        self.profile = profile
+        self.em = em
+        self.incremental = incremental
+        if self.em is None:
+            self.em = emConvergence.Settings()
     def run(self):
         os.chdir(self.directory)
         
-        if os.path.exists("clusterFiles/"):
-            assert os.path.exists("jobs.list")
-            assert os.path.exists("jobsEM.list")
-            assert os.path.exists("config.txt")
-            assert os.path.exists("configEM.txt")
-            assert os.path.exists("params0.txt")
-        else:
-            optional_flags = " "
-            if self.paradigm_public:
-                optional_flags += "-y "
-            if self.param_file is not None:
-                optional_flags += "-t %s " % (self.param_file)
-            cmd = "%s %s%s -b \"%s\" -s same -n %s -i %s -e %s -d %s -p %s %s" \
-                                                                % (sys.executable,
-                                                                   prepare_exec,
-                                                                   optional_flags,
-                                                                   self.disc,
-                                                                   self.null_size,
-                                                                   self.inference_spec,
-                                                                   self.paradigm_exec,
-                                                                   self.dogma_lib,
-                                                                   self.pathway_lib,
-                                                                   self.evidence_spec)
-            l = open("prepare.log", "w")
-            l.write("# " + cmd + "\n")
-            l.close()
-            os.system(cmd + " >> prepare.log")
+        prepareStep(self.evidence_spec, self.disc, self.param_file,
+                    self.null_size, self.paradigm_exec, self.inference_spec,
+                    self.dogma_lib, self.pathway_lib, self.paradigm_public)
         if self.run_em:
-            self.setFollowOnTarget(ExpectationIteration(0, 0.001, self.directory))
+            self.setFollowOnTarget(ExpectationIteration(0, self.em, self.directory,
+                                                        self.profile,
+                                                        self.incremental))
         else:
-            self.setFollowOnTarget(FinalRun(0, self.directory))
+            self.setFollowOnTarget(FinalRun(0, self.directory, self.profile,
+                                            self.incremental))
 
 class MaximizationIteration(Target):
-    def __init__(self, iteration, tolerance, directory):
+    def __init__(self, iteration, em, directory, profile=False, e_start=None, incremental=False):
         Target.__init__(self, time=10000)
         self.iteration = iteration
-        self.tolerance = tolerance
+        self.em = em
         self.directory = directory
-    def readLL(self, filename):
-        f = open(filename, "r")
-        topline = f.readline().rstrip()
-        f.close()
-        m = re.search("logZ=([0-9.e+-]*)", topline)
-        return float(m.group(1))
-    def emHasTerminated(self):
-        if self.iteration < 2:
-            return False
-        prevLL = self.readLL("params%i.txt" % (self.iteration - 1))
-        currLL = self.readLL("params%i.txt" % (self.iteration))
-        decrease = ((prevLL - currLL) / currLL)
-        logging.info("LL: %5g, Decrease: %3g" % (currLL, 100*decrease))
-        return decrease < self.tolerance
+        self.profile = profile
+        self.e_start = e_start
+        self.incremental = incremental
     def run(self):
         os.chdir(self.directory)
         
-        cmd = "%s -p outputFilesEM/*learn* " % (collect_exec)
-        if (os.path.exists("mask.expectations")):
-            cmd += " mask.expectations "
-        cmd += "| %s -o params%i.txt /dev/stdin " \
-                    % (collect_exec, self.iteration + 1)
-        if (os.path.exists("mask.params")):
-            cmd += " mask.params "
-        os.system(cmd)
-        if self.emHasTerminated():
-            self.setFollowOnTarget(FinalRun(self.iteration + 1, self.directory))
+        e_seconds = None
+        if self.e_start is not None:
+            e_seconds = time.time() - self.e_start
+        if maximizationStep(self.iteration, self.em, e_seconds):
+            self.setFollowOnTarget(FinalRun(self.iteration + 1, self.directory,
+                                            self.profile, self.incremental))
         else:
             self.setFollowOnTarget(ExpectationIteration(self.iteration + 1,
-                                                        self.tolerance,
-                                                        self.directory))
+                                                        self.em,
+                                                        self.directory,
+                                                        self.profile,
+                                                        self.incremental))
 
 class ExpectationIteration(Target):
-    def __init__(self, iteration, tolerance, directory):
+    def __init__(self, iteration, em, directory, profile=False, incremental=False):
         Target.__init__(self, time=1000)
         self.iteration = iteration
-        self.tolerance = tolerance
+        self.em = em
         self.directory = directory
+        self.profile = profile
+        self.incremental = incremental
     def run(self):
         os.chdir(self.directory)
         
-        os.system("rm -f params.txt")
-        os.system("ln -s params%i.txt params.txt" % self.iteration)
-        os.system("mkdir -p outputFilesEM%i" % self.iteration)
-        os.system("rm -f outputFilesEM")
-        os.system("ln -s outputFilesEM%i outputFilesEM" % self.iteration)
-        logging.info("Current directory: %s\n" % (os.getcwd()))
-        f = open("jobsEM.list", "r")
-        for job in f:
-            self.addChildTarget(ParadigmCommand(job, self.directory))
-        f.close()
+        start = time.time()
+        manifest = emManifest(self.iteration)
+        jobs = expectationStep(self.iteration)
+        for job in jobManifest.pendingJobs(jobs, manifest):
+            self.addChildTarget(ParadigmCommand(job, self.directory,
+                                                self.profile, manifest))
         self.setFollowOnTarget(MaximizationIteration(self.iteration, 
-                                                     self.tolerance,
-                                                     self.directory))
+                                                     self.em,
+                                                     self.directory,
+                                                     self.profile,
+                                                     start,
+                                                     self.incremental))
 
 class FinalRun(Target):
-    def __init__(self, iteration, directory):
+    def __init__(self, iteration, directory, profile=False, incremental=False):
         Target.__init__(self, time=10000)
         self.iteration = iteration
         self.directory = directory
+        self.profile = profile
+        self.incremental = incremental
     def run(self):
         os.chdir(self.directory)
         
-        os.system("rm -f params.txt")
-        os.system("ln -s params%i.txt params.txt" % self.iteration)
-        os.system("mkdir -p outputFiles")
-        f = open("jobs.list", "r")
-        for job in f:
-            self.addChildTarget(ParadigmCommand(job, self.directory))
-        f.close()
-        self.setFollowOnTarget(Merge(self.directory))
+        jobs = finalStep(self.iteration, self.incremental)
+        for job in jobManifest.pendingJobs(jobs, final_manifest):
+            self.addChildTarget(ParadigmCommand(job, self.directory,
+                                                self.profile, final_manifest,
+                                                self.incremental))
+        self.setFollowOnTarget(Merge(self.directory, self.profile,
+                                     self.incremental))
 
 class Merge(Target):
-    def __init__(self, directory):
+    def __init__(self, directory, profile=False, incremental=False):
         Target.__init__(self, time=10000)
         self.directory = directory
+        self.profile = profile
+        self.incremental = incremental
     def run(self):
         os.chdir(self.directory)
         
-        os.system("mkdir -p mergeFiles")
-        os.system("%s %s outputFiles mergeFiles" % (sys.executable, batch_exec))
-        mergeFiles = glob.glob("mergeFiles/*transpose*")
-        if len(mergeFiles) == 1:
-            os.system("cat %s | sed 's/ loglikelihood=-[0-9.]*//g' > merge_merged_unfiltered.all.tab" % (mergeFiles[0]))
-        else:
-            os.system("%s %s bioInt mergeFiles/" % (sys.executable, merge_exec))
+        mergeStep(self.profile, incremental=self.incremental)
 
 def gp_main():
     ## check for fresh run
@@ -196,7 +395,8 @@ def gp_main():
     
     ## parse arguments
     parser = OptionParser(usage = "%prog [options] attachment file:path [attachment file:path ...]")
-    Stack.addJobTreeOptions(parser)
+    if Stack is not None:
+        Stack.addJobTreeOptions(parser)
     parser.add_option("--jobFile",
                       help = "Add as a child of jobFile rather than making a new jobTree")
     parser.add_option("-w", "--workdir", dest = "work_dir", default = "./",
@@ -215,9 +415,33 @@ def gp_main():
                       help = "Skip EM steps")
     parser.add_option("-y", dest = "paradigm_public", action = "store_true", default = False,
                       help = "This flag must be enabled when using the publically available version of paradigm")
+    parser.add_option("--profile", dest = "profile", action = "store_true", default = False,
+                      help = "Record wall time and peak memory of every paradigm job and write timings.tab and timingsEM.tab to the work directory")
+    parser.add_option("--incremental-merge", dest = "incremental_merge", action = "store_true", default = False,
+                      help = "Fold final run outputs into the merge as their jobs finish")
+    parser.add_option("--local", dest = "local_jobs", type = "int", default = 0,
+                      help = "Run on this machine with this many parallel jobs instead of jobTree")
+    parser.add_option("--em-tolerance", dest = "em_tolerance", type = "float", default = 0.001,
+                      help = "Stop EM when the relative logZ improvement of a round is below this")
+    parser.add_option("--em-param-tolerance", dest = "em_param_tolerance", type = "float", default = None,
+                      help = "Stop EM when no parameter changes more than this in a round")
+    parser.add_option("--em-min-iters", dest = "em_min_iters", type = "int", default = 3,
+                      help = "Minimum number of EM rounds")
+    parser.add_option("--em-max-iters", dest = "em_max_iters", type = "int", default = None,
+                      help = "Maximum number of EM rounds")
+    parser.add_option("--em-accelerate", dest = "em_accelerate", action = "store_true", default = False,
+                      help = "Extrapolate EM parameters along each round's step")
+    parser.add_option("--collect-jobs", dest = "collect_jobs", type = "int", default = 1,
+                      help = "Processes reading EM expectations in each maximization step")
+    parser.add_option("--external-collect", dest = "external_collect", action = "store_true", default = False,
+                      help = "Collect EM expectations with the collectParameters binary instead of collectParameters.py")
+    parser.add_option("--job-timeout", dest = "job_timeout", type = "float", default = None,
+                      help = "Seconds before a paradigm job is killed when running with --local")
     
     parser.add_option("-o", "--output-ipls", dest = "output_ipls", default = "unfiltered.all.tab",
                       help = "Unfiltered Output")
+    parser.add_option("--os", "--output-store", dest = "output_store", default = None,
+                      help = "Unfiltered Output as a binary IPL store directory")
     parser.add_option("--op", "--output-params", dest = "output_params", default = None,
                       help = "Parameter Output")
     parser.add_option("--oc", "--output-config", dest = "output_config", default = None,
@@ -227,7 +451,13 @@ def gp_main():
     
     options, args = parser.parse_args()
     logging.info("options: %s" % (str(options)))
-    print "Using Batch System '%s'" % (options.batchSystem)
+    if options.local_jobs > 0:
+        print "Using %d local job slots" % (options.local_jobs)
+    elif Stack is None:
+        logging.error("ERROR: jobTree is not installed, use --local\n")
+        sys.exit(1)
+    else:
+        print "Using Batch System '%s'" % (options.batchSystem)
     
     evidence_list = []
     for i, element in enumerate(args):
@@ -241,6 +471,10 @@ def gp_main():
         logging.error("ERROR: incorrect number of arguments\n")
         sys.exit(1)
     
+    if options.output_store is not None and os.path.exists(options.output_store) and not iplStore.isStore(options.output_store):
+        logging.error("ERROR: %s exists and is not an IPL store\n" % (options.output_store))
+        sys.exit(1)
+    
     work_dir = os.path.abspath(options.work_dir)
     if not os.path.exists(work_dir):
         os.makedirs(work_dir)
@@ -251,6 +485,13 @@ def gp_main():
     else:
         param_file  = None
     run_em = options.run_em
+    em = emConvergence.Settings(tolerance = options.em_tolerance,
+                                paramTolerance = options.em_param_tolerance,
+                                minIters = options.em_min_iters,
+                                maxIters = options.em_max_iters,
+                                accelerate = options.em_accelerate,
+                                collectJobs = options.collect_jobs,
+                                externalCollect = options.external_collect)
     
     ## import dogma and pathway libraries
     if zipfile.is_zipfile(options.dogma_lib):
@@ -274,6 +515,33 @@ def gp_main():
         logging.error("ERROR: pathway cannot be a regular file\n")
         sys.exit(1)
     
+    ## run locally
+    if options.local_jobs > 0:
+        cwd = os.getcwd()
+        failed = localRun(evidence_spec = " ".join(evidence_list),
+                          disc = disc,
+                          param_file = param_file,
+                          null_size = null_size,
+                          paradigm_exec = paradigm_exec,
+                          inference_spec = standard_inference,
+                          dogma_lib = dogma_lib,
+                          pathway_lib = pathway_lib,
+                          run_em = run_em,
+                          directory = work_dir,
+                          paradigm_public = options.paradigm_public,
+                          slots = options.local_jobs,
+                          timeout = options.job_timeout,
+                          profile = options.profile,
+                          em = em,
+                          incremental = options.incremental_merge)
+        os.chdir(cwd)
+        if failed:
+            logging.warning("WARNING: run failed, run again to resume")
+            sys.exit(1)
+        copyOutputs(options)
+        logging.info("Run complete!")
+        return
+    
     ## initialize the stack and run
     logging.info("starting prepare")
     s = Stack(PrepareParadigm(evidence_spec=" ".join(evidence_list),
@@ -286,7 +554,10 @@ def gp_main():
                               pathway_lib = pathway_lib,
                               run_em = run_em,
                               directory = work_dir,
-                              paradigm_public = options.paradigm_public))
+                              paradigm_public = options.paradigm_public,
+                              profile = options.profile,
+                              em = em,
+                              incremental = options.incremental_merge))
     if options.jobFile:
         s.addToJobFile(options.jobFile)
     else:
@@ -300,16 +571,7 @@ def gp_main():
         if failed:
             logging.warning("WARNING: %d jobs failed" % (failed))
         else:
-            shutil.copy(os.path.join(options.work_dir, "merge_merged_unfiltered.all.tab"), options.output_ipls)
-            if options.output_params is not None:
-                shutil.copy(os.path.join(options.work_dir, "params.txt"), options.output_params)
-            if options.output_config is not None:
-                shutil.copy(os.path.join(options.work_dir, "config.txt"), options.output_config)
-            if options.output_files is not None:
-                zip_file = zipfile.ZipFile("outputFiles.zip", "w")
-                zipDirectory("outputFiles", zip_file)
-                zip_file.close()
-                shutil.copy(os.path.join(options.work_dir, "outputFiles.zip"), options.output_files)
+            copyOutputs(options)
             
             logging.info("Run complete!")
             if os.path.exists(lasttree_dir):
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+"""incrementalMerge.py: fold paradigm outputs into merged groups as they finish
+
+Parses every finished output file once into a binary delta of its pid
+group (see mergeSwarmFiles.MergeGroup), <group>/<file>.npz in a state
+directory, so folding a file costs only that file.  A file is folded again
+when its size or modification time changes.  finish folds whatever is
+left, consolidates the deltas of each group once, in the order of their
+files' modification times so the latest rerun of a bucket wins, and writes
+the same merged_<group>.out and merged_transpose_<group>.out files as
+mergeSwarmFiles.py, without re-reading the outputs that were already
+folded.  finish drops the deltas of files that no longer exist.  A state
+directory is tied to one run by startRun, which keeps the state when the
+same run is resumed and clears it when the run's inputs changed; clear
+removes the state of an earlier run.
+
+Usage:
+  incrementalMerge.py fold state_dir output_file [output_file ...]
+  incrementalMerge.py watch [-i seconds] [-s suffix] state_dir in_dir
+  incrementalMerge.py finish [-j jobs] [-s suffix] state_dir in_dir out_dir
+  incrementalMerge.py clear state_dir
+
+Options:
+   -i int     seconds between scans of in_dir (default 30)
+   -s str     suffix of the output files (default .fa)
+   -j int     processes writing merged groups (default 1)
+
+watch runs until interrupted or until a file named "stop" appears in the
+state directory.
+"""
+import os, sys, getopt, glob, shutil, time, fcntl, multiprocessing, hashlib
+import numpy as np
+import mergeSwarmFiles
+
+def deltaPath(stateDir, group, fname):
+    return os.path.join(stateDir, group, os.path.basename(fname) + ".npz")
+
+def deltaSources(path):
+    """
+    The {file : signature} a delta was folded from
+    """
+    state = np.load(path, allow_pickle=True)
+    sources = dict([tuple(s) for s in state["sources"]])
+    state.close()
+    return sources
+
+def fileSignature(fname):
+    st = os.stat(fname)
+    return "%d:%d" % (st.st_size, st.st_mtime)
+
+def foldGroup(stateDir, group, files):
+    """
+    Writes a delta for each of the files without one for their current
+    contents, returning how many were folded
+    """
+    groupDir = os.path.join(stateDir, group)
+    if not os.path.exists(groupDir):
+        try:
+            os.makedirs(groupDir)
+        except OSError:
+            pass
+    lock = open(os.path.join(groupDir, "lock"), "w")
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    folded = 0
+    try:
+        for f in files:
+            if not os.path.exists(f):
+                continue
+            path = deltaPath(stateDir, group, f)
+            if os.path.exists(path) \
+                    and deltaSources(path).get(f) == fileSignature(f):
+                continue
+            g = mergeSwarmFiles.MergeGroup(group)
+            g.addFile(f)
+            g.saveState(path)
+            folded += 1
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+    return folded
+
+def loadGroup(stateDir, group):
+    """
+    Consolidates the deltas of a group, oldest source file first
+    """
+    def sourceTime(path):
+        return max([int(s.split(":")[1]) for s in deltaSources(path).values()])
+    g = mergeSwarmFiles.MergeGroup(group)
+    paths = [p for p in glob.glob(os.path.join(stateDir, group, "*.npz"))
+             if not p.endswith(".tmp.npz")]
+    for path in sorted(paths, key=lambda p: (sourceTime(p), p)):
+        g.addState(path)
+    return g
+
+def clearState(stateDir):
+    if os.path.exists(stateDir):
+        shutil.rmtree(stateDir)
+
+def runSignature(files):
+    """
+    Digest of the contents of the files a run's outputs depend on
+    """
+    digest = hashlib.md5()
+    for fname in files:
+        f = open(fname)
+        digest.update(fname + "\0" + f.read() + "\0")
+        f.close()
+    return digest.hexdigest()
+
+def startRun(stateDir, signature):
+    """
+    Ties the state to a run, keeping it when the run is resumed and
+    clearing it when the signature changed.  Returns whether it was cleared.
+    """
+    runFile = os.path.join(stateDir, "run")
+    if os.path.exists(runFile):
+        f = open(runFile)
+        previous = f.read().strip()
+        f.close()
+        if previous == signature:
+            return False
+    clearState(stateDir)
+    os.makedirs(stateDir)
+    f = open(runFile, "w")
+    f.write(signature + "\n")
+    f.close()
+    return True
+
+def dropMissing(stateDir, group):
+    """
+    Removes the deltas of a group whose source files no longer exist,
+    returning how many were removed
+    """
+    dropped = 0
+    for path in glob.glob(os.path.join(stateDir, group, "*.npz")):
+        if path.endswith(".tmp.npz"):
+            continue
+        if not [f for f in deltaSources(path) if os.path.exists(f)]:
+            os.remove(path)
+            dropped += 1
+    return dropped
+
+def foldFiles(stateDir, files):
+    """
+    Folds output files into the state of their groups
+    """
+    groups = mergeSwarmFiles.groupFilesById(files)
+    folded = 0
+    for group in sorted(groups.keys()):
+        folded += foldGroup(stateDir, group, groups[group])
+    return folded
+
+def foldDirectory(stateDir, indirectory, suffix=".fa"):
+    files = mergeSwarmFiles.getFilesMatching(indirectory, ["*" + suffix])
+    return foldFiles(stateDir, sorted(files, key=os.path.getmtime))
+
+def watch(stateDir, indirectory, suffix=".fa", interval=30):
+    stopFile = os.path.join(stateDir, "stop")
+    while not os.path.exists(stopFile):
+        folded = foldDirectory(stateDir, indirectory, suffix)
+        if folded > 0:
+            print "folded %d files" % (folded)
+            sys.stdout.flush()
+        time.sleep(interval)
+
+def writeGroup(args):
+    (stateDir, group, outdirectory) = args
+    start = time.time()
+    g = loadGroup(stateDir, group)
+    if len(g.sampleNames) > 0:
+        g.writeFiles(outdirectory)
+    return (group, len(g.sources), len(g.sampleNames), len(g.entityNames),
+            time.time() - start)
+
+def finish(stateDir, indirectory, outdirectory, suffix=".fa", jobs=1):
+    """
+    Folds the remaining outputs and writes the merged files of every group
+    """
+    folded = foldDirectory(stateDir, indirectory, suffix)
+    print "folded %d remaining files" % (folded)
+    groups = []
+    if os.path.exists(stateDir):
+        groups = sorted([g for g in os.listdir(stateDir)
+                         if os.path.isdir(os.path.join(stateDir, g))])
+    dropped = sum([dropMissing(stateDir, group) for group in groups])
+    if dropped > 0:
+        print "dropped %d deltas of missing files" % (dropped)
+    tasks = [(stateDir, group, outdirectory) for group in groups]
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.map(writeGroup, tasks, 1)
+        pool.close()
+        pool.join()
+    else:
+        results = map(writeGroup, tasks)
+    for (group, files, samples, entities, seconds) in results:
+        print "wrote %s from %d files: %d samples x %d entities in %.2f s" \
+            % (group, files, samples, entities, seconds)
+
+def usage(code=0):
+    print __doc__
+    if code != None: sys.exit(code)
+
+def main(args):
+    if len(args) < 1:
+        usage(1)
+    mode = args[0]
+    try:
+        opts, args = getopt.getopt(args[1:], "i:s:j:")
+    except getopt.GetoptError, err:
+        print str(err)
+        usage(2)
+    interval = 30
+    suffix = ".fa"
+    jobs = 1
+    for o, a in opts:
+        if o == "-i":
+            interval = float(a)
+        elif o == "-s":
+            suffix = a
+        elif o == "-j":
+            jobs = int(a)
+    if mode == "fold" and len(args) >= 2:
+        print "folded %d files" % (foldFiles(args[0], args[1:]))
+    elif mode == "watch" and len(args) == 2:
+        watch(args[0], args[1], suffix, interval)
+    elif mode == "finish" and len(args) == 3:
+        finish(args[0], args[1], args[2], suffix, jobs)
+    elif mode == "clear" and len(args) == 1:
+        clearState(args[0])
+    else:
+        usage(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
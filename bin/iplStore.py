@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+"""iplStore.py: chunked binary store of IPL matrices
+
+A store is a directory holding an entity by sample float32 matrix, written
+in chunks of chunk_rows entities (values_<i>.npy, or values_<i>.npz when
+compressed), with entities.txt and samples.txt naming the rows and
+columns, nulls.npy marking the null (na_) samples and meta.json describing
+the layout.  A boolean chunk beside each values chunk (present_<i>.npy)
+marks the fields the matrix had: absent fields are written back empty,
+while present ones that are NaN or not numbers are written back as nan,
+as the merge writes them.  A store can also keep a sample-major copy
+(samples_<i>.npy) so single samples are read as fast as single entities.
+Uncompressed chunks are memory mapped, so reading an entity or a sample
+doesn't load the matrix.
+
+Usage:
+  iplStore.py build [options] matrix.tab store_dir
+  iplStore.py dump store_dir [matrix.tab]
+  iplStore.py info store_dir
+
+Options:
+   -r int     entities per chunk (default 1024)
+   -z         compress the chunks (they are then loaded, not mapped)
+   -t         also write the sample-major copy
+"""
+import os, sys, json, getopt
+import numpy as np
+from mergeSwarmFiles import formatValues
+
+metaFile = "meta.json"
+defaultChunkRows = 1024
+nullPrefix = "na_"
+
+def isStore(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, metaFile))
+
+def isNull(sample):
+    return sample.startswith(nullPrefix)
+
+def readNames(filename):
+    f = open(filename, "r")
+    names = [line.rstrip("\n") for line in f]
+    f.close()
+    return names
+
+def writeNames(filename, names):
+    f = open(filename, "w")
+    for name in names:
+        f.write(name + "\n")
+    f.close()
+
+def saveChunk(directory, name, values, compress):
+    if compress:
+        np.savez_compressed(os.path.join(directory, name + ".npz"),
+                            values=values)
+    else:
+        np.save(os.path.join(directory, name + ".npy"), values)
+
+def parseValues(tokens, width, dtype=np.float32):
+    """
+    float32 values of a row's fields, NaN where missing or not a number
+    """
+    values = np.empty(width, dtype=dtype)
+    values[:] = np.nan
+    tokens = tokens[:width]
+    try:
+        values[:len(tokens)] = np.array(tokens, dtype=np.float64)
+    except ValueError:
+        for i, t in enumerate(tokens):
+            try:
+                values[i] = float(t)
+            except ValueError:
+                pass
+    return values
+
+def parseRows(rows, width, dtype=np.float32):
+    """
+    parseValues of a list of split rows as a matrix, converting complete
+    numeric rows in one step
+    """
+    if all([len(row) == width for row in rows]):
+        try:
+            return np.array(rows, dtype=np.float64).astype(dtype, copy=False)
+        except ValueError:
+            pass
+    return np.array([parseValues(row, width, dtype) for row in rows],
+                    dtype=dtype).reshape(len(rows), width)
+
+def formatRow(values, present=None):
+    """
+    Fields of a row of values as the merge writes them, empty where the
+    present mask is not set
+    """
+    text = formatValues(values)
+    if present is not None and not present.all():
+        for i in np.nonzero(~present)[0]:
+            text[i] = ""
+    return text
+
+def selectRows(block, count, cutoff, columns=None):
+    """
+    Mask of the rows of a block with at least count values of absolute
+    value >= cutoff among the given columns
+    """
+    if columns is not None:
+        block = block[:, columns]
+    with np.errstate(invalid="ignore"):
+        counts = (np.abs(block) >= cutoff).sum(axis=1)
+    return (counts >= count) & (block.shape[1] > 0)
+
+class StoreWriter(object):
+    """
+    Writes a store a chunk of entities at a time
+    """
+    def __init__(self, directory, samples, corner="pid_entity",
+                 chunkRows=defaultChunkRows, compress=False):
+        self.directory = directory
+        self.samples = list(samples)
+        self.corner = corner
+        self.chunkRows = chunkRows
+        self.compress = compress
+        self.entities = []
+        self.buffer = []
+        self.presence = []
+        self.chunks = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+    def addRow(self, entity, values, present=None):
+        """
+        Adds a row of values, with the mask of its fields that are present
+        (all of them by default)
+        """
+        values = np.asarray(values, dtype=np.float32)
+        if present is None:
+            present = np.ones(len(values), dtype=bool)
+        self.entities.append(entity)
+        self.buffer.append(values)
+        self.presence.append(np.asarray(present, dtype=bool))
+        if len(self.buffer) >= self.chunkRows:
+            self.flush()
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        saveChunk(self.directory, "values_%i" % (self.chunks),
+                  np.vstack(self.buffer), self.compress)
+        saveChunk(self.directory, "present_%i" % (self.chunks),
+                  np.vstack(self.presence), self.compress)
+        self.chunks += 1
+        self.buffer = []
+        self.presence = []
+    def close(self, sampleMajor=False):
+        self.flush()
+        writeNames(os.path.join(self.directory, "entities.txt"), self.entities)
+        writeNames(os.path.join(self.directory, "samples.txt"), self.samples)
+        np.save(os.path.join(self.directory, "nulls.npy"),
+                np.array([isNull(s) for s in self.samples], dtype=bool))
+        meta = {"version" : 1, "corner" : self.corner,
+                "entities" : len(self.entities), "samples" : len(self.samples),
+                "chunk_rows" : self.chunkRows, "chunks" : self.chunks,
+                "compressed" : self.compress, "sample_chunks" : 0,
+                "presence" : True}
+        f = open(os.path.join(self.directory, metaFile), "w")
+        json.dump(meta, f, indent=1, sort_keys=True)
+        f.close()
+        if sampleMajor:
+            writeSampleMajor(self.directory)
+
+def writeSampleMajor(directory):
+    """
+    Adds the sample-major copy of a store, one band of chunk_rows samples
+    at a time
+    """
+    store = IPLStore(directory)
+    bands = 0
+    for start in range(0, len(store.samples), store.chunkRows):
+        stop = min(start + store.chunkRows, len(store.samples))
+        band = np.empty((stop - start, len(store.entities)), dtype=np.float32)
+        for (row, block) in store.chunks():
+            band[:, row:row + block.shape[0]] = block[:, start:stop].T
+        saveChunk(directory, "samples_%i" % (bands), band, store.compressed)
+        bands += 1
+    store.meta["sample_chunks"] = bands
+    f = open(os.path.join(directory, metaFile), "w")
+    json.dump(store.meta, f, indent=1, sort_keys=True)
+    f.close()
+
+class IPLStore(object):
+    """
+    Read access to a store by entity, by sample or a chunk at a time
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        f = open(os.path.join(directory, metaFile), "r")
+        self.meta = json.load(f)
+        f.close()
+        self.corner = str(self.meta["corner"])
+        self.chunkRows = self.meta["chunk_rows"]
+        self.compressed = self.meta["compressed"]
+        self.entities = readNames(os.path.join(directory, "entities.txt"))
+        self.samples = readNames(os.path.join(directory, "samples.txt"))
+        self.nulls = np.load(os.path.join(directory, "nulls.npy"))
+        self.entityIndex = dict([(e, i) for i, e in enumerate(self.entities)])
+        self.sampleIndex = dict([(s, i) for i, s in enumerate(self.samples)])
+        self.loaded = {}
+    def load(self, name):
+        if name not in self.loaded:
+            path = os.path.join(self.directory, name)
+            if self.compressed:
+                npz = np.load(path + ".npz")
+                self.loaded[name] = npz["values"]
+                npz.close()
+            else:
+                self.loaded[name] = np.load(path + ".npy", mmap_mode="r")
+        return self.loaded[name]
+    def chunk(self, i):
+        return self.load("values_%i" % (i))
+    def chunks(self):
+        """
+        Yields (first row, values) for every chunk of entities; compressed
+        chunks are loaded one at a time and not kept
+        """
+        for i in range(self.meta["chunks"]):
+            block = self.chunk(i)
+            if self.compressed:
+                del self.loaded["values_%i" % (i)]
+            yield (i * self.chunkRows, block)
+    def present(self, start, block):
+        """
+        Mask of the present fields of the chunk starting at row start.
+        Stores written before the mask existed count NaN as absent.
+        """
+        if not self.meta.get("presence", False):
+            return ~np.isnan(block)
+        name = "present_%i" % (start / self.chunkRows)
+        mask = self.load(name)
+        if self.compressed:
+            del self.loaded[name]
+        return mask
+    def realColumns(self):
+        return np.nonzero(~self.nulls)[0]
+    def entity(self, name):
+        row = self.entityIndex[name]
+        return np.array(self.chunk(row / self.chunkRows)[row % self.chunkRows])
+    def sample(self, name):
+        col = self.sampleIndex[name]
+        if self.meta.get("sample_chunks", 0) > 0:
+            band = self.load("samples_%i" % (col / self.chunkRows))
+            return np.array(band[col % self.chunkRows])
+        values = np.empty(len(self.entities), dtype=np.float32)
+        for (row, block) in self.chunks():
+            values[row:row + block.shape[0]] = block[:, col]
+        return values
+    def rows(self, names):
+        """
+        The values of the given entities, in the given order
+        """
+        values = np.empty((len(names), len(self.samples)), dtype=np.float32)
+        for i, name in enumerate(names):
+            values[i] = self.entity(name)
+        return values
+    def columns(self, names):
+        """
+        The values of the given samples for every entity
+        """
+        values = np.empty((len(self.entities), len(names)), dtype=np.float32)
+        for i, name in enumerate(names):
+            values[:, i] = self.sample(name)
+        return values
+    def header(self, columns=None):
+        samples = self.samples
+        if columns is not None:
+            samples = [samples[c] for c in columns]
+        return "\t".join([self.corner] + samples) + "\n"
+    def lines(self, columns=None, rows=None):
+        """
+        Yields the text lines of the matrix without its header, restricted
+        to columns and to the rows where the rows mask of each chunk is
+        set, when rows is a function of (first row, values)
+        """
+        for (start, block) in self.chunks():
+            keep = range(block.shape[0])
+            if rows is not None:
+                keep = np.nonzero(rows(start, block))[0]
+            present = self.present(start, block)
+            for i in keep:
+                values = np.asarray(block[i])
+                mask = np.asarray(present[i])
+                if columns is not None:
+                    values = values[columns]
+                    mask = mask[columns]
+                yield "\t".join([self.entities[start + i]]
+                                 + formatRow(values, mask)) + "\n"
+
+def buildStore(matrixFile, directory, chunkRows=defaultChunkRows,
+               compress=False, sampleMajor=False):
+    """
+    Writes a store from a tab separated matrix with a header line
+    """
+    f = open(matrixFile, "r")
+    header = f.readline().rstrip("\r\n").split("\t")
+    writer = StoreWriter(directory, header[1:], header[0], chunkRows, compress)
+    width = len(header) - 1
+    for line in f:
+        tokens = line.rstrip("\r\n").split("\t")
+        present = np.zeros(width, dtype=bool)
+        present[:len(tokens) - 1] = [t != "" for t in tokens[1:width + 1]]
+        writer.addRow(tokens[0], parseValues(tokens[1:], width), present)
+    f.close()
+    writer.close(sampleMajor)
+
+def dumpStore(directory, out):
+    store = IPLStore(directory)
+    out.write(store.header())
+    for line in store.lines():
+        out.write(line)
+
+def usage(code=0):
+    print __doc__
+    if code != None: sys.exit(code)
+
+def main(args):
+    if len(args) < 1:
+        usage(1)
+    mode = args[0]
+    try:
+        opts, args = getopt.getopt(args[1:], "r:zt")
+    except getopt.GetoptError, err:
+        print str(err)
+        usage(2)
+    chunkRows = defaultChunkRows
+    compress = False
+    sampleMajor = False
+    for o, a in opts:
+        if o == "-r":
+            chunkRows = int(a)
+        elif o == "-z":
+            compress = True
+        elif o == "-t":
+            sampleMajor = True
+    if mode == "build" and len(args) == 2:
+        buildStore(args[0], args[1], chunkRows, compress, sampleMajor)
+    elif mode == "dump" and len(args) in (1, 2):
+        out = sys.stdout
+        if len(args) == 2:
+            out = open(args[1], "w")
+        dumpStore(args[0], out)
+        if out is not sys.stdout:
+            out.close()
+    elif mode == "info" and len(args) == 1:
+        store = IPLStore(args[0])
+        print "%i entities x %i samples (%i null), %i chunks of %i entities%s" \
+            % (len(store.entities), len(store.samples), store.nulls.sum(),
+               store.meta["chunks"], store.chunkRows,
+               ["", ", compressed"][store.compressed])
+        if store.meta.get("sample_chunks", 0) > 0:
+            print "sample-major copy in %i chunks" % (store.meta["sample_chunks"])
+    else:
+        usage(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""jobManifest.py: checkpoint manifests for paradigm job lists
+
+Every finished job line is recorded in a manifest directory (one per EM
+iteration and one for the final run) with the hash of the line, the hash
+of the files it reads (pathway, config, params and evidence), its exit
+status and its outputs.  A job is complete when it has a successful record
+with the current inputs hash and all of its outputs exist, so an
+interrupted run only reruns missing or failed jobs, and a final run with
+unchanged params and evidence is skipped.  Jobs write their own record
+files, which consolidate() folds into the directory's manifest.tab.
+
+Usage:
+  jobManifest.py manifest_dir job_list
+
+Prints the complete, failed and missing job counts of a job list.
+"""
+import os, sys, re, glob, hashlib
+import pathwayCost
+
+manifestFile = "manifest.tab"
+hashCache = {}
+
+def jobHash(line):
+    return hashlib.md5(line.strip()).hexdigest()
+
+def fileHash(filename):
+    """
+    md5 of a file's contents, cached by path, size and modification time
+    """
+    if not os.path.exists(filename):
+        return "missing"
+    st = os.stat(filename)
+    key = (os.path.realpath(filename), st.st_size, st.st_mtime)
+    if key not in hashCache:
+        h = hashlib.md5()
+        f = open(filename, "rb")
+        while True:
+            block = f.read(1 << 20)
+            if not block:
+                break
+            h.update(block)
+        f.close()
+        hashCache[key] = h.hexdigest()
+    return hashCache[key]
+
+def jobOutputs(line):
+    """
+    The files the paradigm commands of a job line write with -o and -e
+    """
+    return re.findall("-[oe] (\S+)", line)
+
+def jobInputs(line):
+    """
+    The files the paradigm commands of a job line read: its pathway and
+    config, the params file and evidence the config names under the -b
+    prefix, and any other existing file on the line
+    """
+    inputs = []
+    for command in pathwayCost.unpackCommands(line):
+        config = re.search("-c (\S+)", command)
+        prefix = re.search("-b ?(\S+)", command)
+        if config and os.path.exists(config.group(1)):
+            f = open(config.group(1), "r")
+            text = f.read()
+            f.close()
+            inputs += re.findall("param_file=([^,\]\s]+)", text)
+            if prefix:
+                inputs += [prefix.group(1) + s for s in
+                           re.findall("evidence \[suffix=([^,\]]+)", text)]
+        for token in command.split():
+            if token not in inputs and token not in jobOutputs(command) \
+                    and os.path.isfile(token):
+                inputs.append(token)
+    return sorted(set(inputs))
+
+def inputsHash(line):
+    h = hashlib.md5()
+    for filename in jobInputs(line):
+        h.update("%s\t%s\n" % (filename, fileHash(filename)))
+    return h.hexdigest()
+
+def writeRecord(directory, line, inputs, status):
+    """
+    Records a finished job, atomically so readers never see half a record
+    """
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass
+    name = os.path.join(directory, jobHash(line) + ".tab")
+    f = open(name + ".tmp", "w")
+    f.write("%s\t%s\t%i\t%s\t%s\n" % (jobHash(line), inputs, status,
+                                      ",".join(jobOutputs(line)), line.strip()))
+    f.close()
+    os.rename(name + ".tmp", name)
+
+def readRecordFile(filename, records):
+    f = open(filename, "r")
+    for line in f:
+        parts = line.rstrip("\n").split("\t")
+        if len(parts) != 5:
+            continue
+        records[parts[0]] = {"inputs" : parts[1], "status" : int(parts[2]),
+                             "outputs" : [o for o in parts[3].split(",") if o],
+                             "command" : parts[4]}
+    f.close()
+
+def readManifest(directory):
+    """
+    Records keyed by job hash, later job records replacing manifest.tab
+    """
+    records = {}
+    if os.path.exists(os.path.join(directory, manifestFile)):
+        readRecordFile(os.path.join(directory, manifestFile), records)
+    for filename in glob.glob(os.path.join(directory, "*.tab")):
+        if os.path.basename(filename) != manifestFile:
+            readRecordFile(filename, records)
+    return records
+
+def consolidate(directory):
+    """
+    Folds the job record files into manifest.tab
+    """
+    if not os.path.exists(directory):
+        return
+    records = readManifest(directory)
+    name = os.path.join(directory, manifestFile)
+    f = open(name + ".tmp", "w")
+    for h in sorted(records.keys()):
+        r = records[h]
+        f.write("%s\t%s\t%i\t%s\t%s\n" % (h, r["inputs"], r["status"],
+                                          ",".join(r["outputs"]), r["command"]))
+    f.close()
+    os.rename(name + ".tmp", name)
+    for filename in glob.glob(os.path.join(directory, "*.tab")):
+        if os.path.basename(filename) != manifestFile:
+            os.unlink(filename)
+
+def isComplete(line, records):
+    r = records.get(jobHash(line))
+    return r is not None and r["status"] == 0 \
+        and all([os.path.exists(o) for o in r["outputs"]]) \
+        and r["inputs"] == inputsHash(line)
+
+def pendingJobs(lines, directory):
+    """
+    The lines of a job list without a valid checkpoint in directory
+    """
+    records = readManifest(directory)
+    return [line for line in lines if not isComplete(line, records)]
+
+def usage(code=0):
+    print __doc__
+    if code != None: sys.exit(code)
+
+def main(args):
+    if len(args) != 2:
+        usage(1)
+    records = readManifest(args[0])
+    f = open(args[1], "r")
+    lines = [line for line in f if line.strip()]
+    f.close()
+    (complete, failed, missing) = (0, 0, 0)
+    for line in lines:
+        r = records.get(jobHash(line))
+        if isComplete(line, records):
+            complete += 1
+        elif r is not None and r["status"] != 0:
+            failed += 1
+        else:
+            missing += 1
+    print "%i complete, %i failed, %i missing or out of date" % (complete,
+                                                                 failed,
+                                                                 missing)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
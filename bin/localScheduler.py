@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""localScheduler.py: run a paradigm job list on the local machine
+
+Runs the lines of a jobs.list with a bounded pool of processes, longest
+predicted job first (from the matching .cost file written by
+prepareParadigm.py).  Each finished line is checkpointed in a manifest
+directory (see jobManifest.py), and lines with a successful checkpoint for
+their current inputs are skipped, so an interrupted list can be resumed by
+running it again.  Every job runs in its own session without core dumps
+and is terminated with its children when it exceeds the timeout (killed
+if it hasn't exited killGrace seconds later); the outputs of failed jobs
+are removed.
+
+Usage:
+  localScheduler.py [options] jobs.list
+
+Options:
+   -j int     jobs to run at once (default: number of cpus)
+   -t int     seconds before a job is killed (default: no limit)
+   -d dir     manifest directory (default: manifests/ and the job list name)
+   -q         run quietly, don't output status
+"""
+import os, sys, getopt, time, signal, resource, subprocess, multiprocessing
+import jobManifest
+
+pollInterval = 0.1
+killGrace = 5.0
+verbose = True
+
+def log(msg):
+    if verbose:
+        sys.stderr.write(msg)
+
+def readJobList(filename):
+    """
+    Returns (seconds, line) jobs from a job list and its .cost file, longest
+    first, keeping list order for jobs without a cost
+    """
+    f = open(filename, "r")
+    lines = [line.rstrip("\n") for line in f if line.strip()]
+    f.close()
+    costs = [0.0] * len(lines)
+    costFile = os.path.splitext(filename)[0] + ".cost"
+    if os.path.exists(costFile):
+        f = open(costFile, "r")
+        values = [float(line) for line in f if line.strip()]
+        f.close()
+        if len(values) == len(lines):
+            costs = values
+    order = sorted(range(len(lines)), key=lambda i: (-costs[i], i))
+    return [(costs[i], lines[i]) for i in order]
+
+def removeOutputs(line):
+    for o in jobManifest.jobOutputs(line):
+        if os.path.exists(o):
+            os.unlink(o)
+
+def limitJob():
+    """
+    Runs in the child before exec: new session so the whole job can be
+    killed, and no core dumps
+    """
+    os.setsid()
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+
+def startJob(line, wrapper=None):
+    if wrapper is None:
+        return subprocess.Popen(line, shell=True, preexec_fn=limitJob)
+    return subprocess.Popen(wrapper + [line], preexec_fn=limitJob)
+
+def killJob(p, grace=killGrace):
+    """
+    Terminates a job's session so it can clean up, and kills whatever is
+    left of it after grace seconds
+    """
+    try:
+        os.killpg(p.pid, signal.SIGTERM)
+    except OSError:
+        return
+    stop = time.time() + grace
+    while p.poll() is None and time.time() < stop:
+        time.sleep(pollInterval)
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+def runJobs(jobs, slots, timeout=None, manifest=None, wrapper=None,
+            onSuccess=None):
+    """
+    Runs (seconds, line) jobs in order on slots processes, returning the
+    lines that failed.  wrapper is an argument list to run each line with
+    instead of the shell, e.g. a profiler, and onSuccess is called with
+    each line that succeeds.
+    """
+    pending = [job[1] for job in jobs]
+    if manifest is not None:
+        pending = jobManifest.pendingJobs(pending, manifest)
+    if len(pending) < len(jobs):
+        log("skipping %i completed jobs\n" % (len(jobs) - len(pending)))
+    pending.reverse()
+    total = len(pending)
+    running = {}
+    failed = []
+    finished = 0
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < max(1, slots):
+            line = pending.pop()
+            removeOutputs(line)
+            inputs = None
+            if manifest is not None:
+                inputs = jobManifest.inputsHash(line)
+            p = startJob(line, wrapper)
+            running[p.pid] = (p, line, time.time(), inputs)
+        time.sleep(pollInterval)
+        for pid in running.keys():
+            (p, line, start, inputs) = running[pid]
+            status = p.poll()
+            if status is None:
+                if timeout is not None and time.time() - start > timeout:
+                    log("killing job after %.0f s: %s\n" % (time.time() - start,
+                                                           line))
+                    killJob(p)
+                    p.wait()
+                    status = -signal.SIGKILL
+                else:
+                    continue
+            del running[pid]
+            finished += 1
+            if manifest is not None:
+                jobManifest.writeRecord(manifest, line, inputs, status)
+            if status == 0 and onSuccess is not None:
+                onSuccess(line)
+            if status != 0:
+                failed.append(line)
+                removeOutputs(line)
+                log("job failed with status %i: %s\n" % (status, line))
+            log("%i/%i jobs finished, %i running, %i failed\n"
+                % (finished, total, len(running), len(failed)))
+    return failed
+
+def runJobList(filename, slots, timeout=None, manifest=None, wrapper=None,
+               onSuccess=None):
+    if manifest is None:
+        manifest = os.path.join("manifests",
+                                os.path.splitext(os.path.basename(filename))[0])
+    failed = runJobs(readJobList(filename), slots, timeout, manifest, wrapper,
+                     onSuccess)
+    jobManifest.consolidate(manifest)
+    return failed
+
+def usage(code=0):
+    print __doc__
+    if code != None: sys.exit(code)
+
+def main(args):
+    global verbose
+    try:
+        opts, args = getopt.getopt(args, "j:t:d:q")
+    except getopt.GetoptError, err:
+        print str(err)
+        usage(2)
+    if len(args) != 1:
+        usage(1)
+    slots = multiprocessing.cpu_count()
+    timeout = None
+    manifest = None
+    for o, a in opts:
+        if o == "-j":
+            slots = int(a)
+        elif o == "-t":
+            timeout = float(a)
+        elif o == "-d":
+            manifest = a
+        elif o == "-q":
+            verbose = False
+    failed = runJobList(args[0], slots, timeout, manifest)
+    if len(failed) > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
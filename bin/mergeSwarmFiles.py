@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 
-import sys, os, string, fnmatch
+import sys, os, string, fnmatch, getopt, itertools, time, multiprocessing
 import array
+import numpy as np
 
 def getFilesMatching(baseDir, patterns):
     list = []
@@ -16,17 +17,22 @@ def getFilesMatching(baseDir, patterns):
     return list 
 
 
+def groupId(file):
+    i = file.find("pid")
+    if i == -1:
+        return None
+
+    s = file[i:].split('_')
+    return s[0] + '_' + s[1]
+
 def groupFilesById(allfiles):
 
     groups = {}
     for file in allfiles:
-        i = file.find("pid")
-        if i == -1:
+        pid = groupId(file)
+        if pid is None:
             continue
 
-        s = file[i:].split('_')
-        pid = s[0] + '_' + s[1]
-
         if not pid in groups:
             groups[pid] = []
 
@@ -66,188 +72,250 @@ def addData(fname, sampleData):
 
     inFile.close()
 
-"""    
-def outputData(outname, sampleData):
-    outFile = open(outname, 'w')
-
-    entities = sampleData.keys()
-    entities.sort()
-    
-    s = "id" + '\t' + '\t'.join(entities) + '\n'
-    outFile.write(s)
-    
-    sampleNames = []
-    for e in entities:
-        names = sampleData[e].keys()
-        for n in names:
-            if not n in sampleNames:
-                sampleNames.append(n)
-
-    sampleNames.sort()
-    sampleNames.reverse() # put "sample" on top
-
-    for sample in sampleNames:
-        data = []
-        for e in entities:
-            try:
-                val = sampleData[e][sample]
-            except:
-                val = "NA"
-            data.append(val)
-        s = sample + '\t' + '\t'.join(data) + '\n'
-        outFile.write(s)
-
-    outFile.close()
-
-def outputDataTranspose(outname, sampleData):
-    outFile = open(outname, 'w')
+def formatValues(values):
+    """
+    Formats float32 values the way str() formats Python 2 floats, as a
+    list of fields (a list of rows of fields for a matrix)
+    """
+    if values.ndim == 1:
+        return map(str, values.tolist())
+    return [map(str, row) for row in values.tolist()]
+
+class MergeGroup(object):
+    """
+    The samples and entities of one pid group's output files.  Entities
+    keep the order they first appear in, a sample that appears again
+    replaces its earlier values, and entities a sample lacks are 0.0.
+    A group can be saved and loaded again to fold in more files later.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.entities = {}
+        self.entityNames = []
+        self.samples = {}
+        self.sampleNames = []
+        self.rows = []
+        self.base = None
+        self.sources = {}
+    def addSample(self, sample):
+        if sample not in self.samples:
+            self.samples[sample] = len(self.sampleNames)
+            self.sampleNames.append(sample)
+            self.rows.append(None)
+        return self.samples[sample]
+    def addFile(self, fname):
+        inFile = open(fname)
+        st = os.fstat(inFile.fileno())
+        self.sources[fname] = "%d:%d" % (st.st_size, st.st_mtime)
+        entities = self.entities
+        values = None
+        for line in inFile:
+            if line.startswith('>'):
+                currentId = line.rstrip().strip('>').strip()
+                values = array.array("f", [0.0]) * len(self.entityNames)
+                self.rows[self.addSample(currentId)] = values
+                continue
+
+            if values is None:
+                continue
+
+            data = line.rstrip().split('\t')
+            name = data[0]
+            if "__" in name:
+                continue
 
-    entities = sampleData.keys()
-    entities.sort()
-    
-    sampleNames = []
-    for e in entities:
-        names = sampleData[e].keys()
-        for n in names:
-            if not n in sampleNames:
-                sampleNames.append(n)
-
-    sampleNames.sort()
-    sampleNames.reverse() # put "sample" on top
-
-    s = "id" + '\t' + '\t'.join(sampleNames) + '\n'
-    outFile.write(s)
-    
-    for e in entities:
-        data = []
-        for sample in sampleNames:
             try:
-                val = sampleData[e][sample]
-            except:
-                val = "NA"
-            data.append(val)
-        s = e + '\t' + '\t'.join(data) + '\n'
-        outFile.write(s)
-
-    outFile.close()
-"""    
-    
-def outputData(outname, sampleData, col_map):
-    entities = col_map.keys()
-    entities.sort(key=lambda x : col_map[x])
-
-    sampleNames = sampleData.keys()
-    sampleNames.sort()
-    sampleNames.reverse() # put "sample" on top
-   
-    s = "id" + '\t' + '\t'.join(entities) + '\n'
-
-    outFile = open(outname, 'w')
-    outFile.write(s)
-    for sample in sampleNames:
-        data = []
-        for e in entities:
-            data.append( str(sampleData[sample][col_map[e]]) )
-        s = sample + '\t' + '\t'.join(data) + '\n'
-        outFile.write(s)
-    outFile.close()
-
-def outputDataTranspose(outname, sampleData, col_map):
-    entities = col_map.keys()
-    entities.sort(key=lambda x : col_map[x])
-
-    sampleNames = sampleData.keys()
-    sampleNames.sort()
-    sampleNames.reverse() # put "sample" on top
-   
-    s = "id" + '\t' + '\t'.join(sampleNames) + '\n'
-
+                val = float(data[1])
+            except ValueError:
+                val = float('nan')
+
+            col = entities.get(name)
+            if col is None:
+                col = len(self.entityNames)
+                entities[name] = col
+                self.entityNames.append(name)
+            if col >= len(values):
+                values.extend(array.array("f", [0.0]) * (col + 1 - len(values)))
+            values[col] = val
+        inFile.close()
+    def addState(self, filename):
+        """
+        Folds in a group saved with saveState, its samples replacing the
+        ones read so far
+        """
+        state = MergeGroup.loadState(self.name, filename)
+        for name in state.entityNames:
+            if name not in self.entities:
+                self.entities[name] = len(self.entityNames)
+                self.entityNames.append(name)
+        cols = np.array([self.entities[name] for name in state.entityNames],
+                        dtype=np.intp)
+        for i, sample in enumerate(state.sampleNames):
+            values = np.zeros(len(self.entityNames), dtype=np.float32)
+            values[cols] = state.base[i]
+            self.rows[self.addSample(sample)] = values
+        self.sources.update(state.sources)
+    def sampleRow(self, row):
+        """
+        float32 values of a sample over all the entities read so far
+        """
+        values = self.rows[row]
+        if values is None:
+            values = self.base[row]
+        else:
+            values = np.frombuffer(values, dtype=np.float32)
+        if len(values) < len(self.entityNames):
+            values = np.concatenate((values, np.zeros(
+                len(self.entityNames) - len(values), dtype=np.float32)))
+        return values
+    def matrix(self):
+        """
+        Samples by entities float32 matrix of the values read so far
+        """
+        data = np.zeros((len(self.sampleNames), len(self.entityNames)),
+                        dtype=np.float32)
+        for row in range(len(self.sampleNames)):
+            data[row] = self.sampleRow(row)
+        return data
+    def saveState(self, filename):
+        """
+        Saves the group to a .npz file, replacing it atomically
+        """
+        tmpname = filename + ".tmp.npz"
+        np.savez(tmpname, data=self.matrix(),
+                 sampleNames=np.array(self.sampleNames, dtype=object),
+                 entityNames=np.array(self.entityNames, dtype=object),
+                 sources=np.array(sorted(self.sources.items()), dtype=object))
+        os.rename(tmpname, filename)
+    @staticmethod
+    def loadState(name, filename):
+        group = MergeGroup(name)
+        state = np.load(filename, allow_pickle=True)
+        group.sampleNames = list(state["sampleNames"])
+        group.samples = dict([(n, i) for i, n in enumerate(group.sampleNames)])
+        group.rows = [None] * len(group.sampleNames)
+        group.entityNames = list(state["entityNames"])
+        group.entities = dict([(n, i) for i, n in enumerate(group.entityNames)])
+        group.sources = dict([tuple(s) for s in state["sources"]])
+        group.base = state["data"]
+        state.close()
+        return group
+    def writeFiles(self, outdirectory, cellsPerBlock=16384):
+        """
+        Writes merged_<group>.out (samples by entities) and its transpose
+        straight from the sample rows, a block of entities at a time
+        """
+        order = sorted(range(len(self.sampleNames)),
+                       key=lambda i: self.sampleNames[i], reverse=True)
+        sampleNames = [self.sampleNames[i] for i in order]
+        rows = [self.sampleRow(i) for i in order]
+
+        outname = os.path.join(outdirectory, "merged_" + self.name + ".out")
+        writeMatrix(outname, sampleNames, self.entityNames,
+                    lambda start, stop: np.array(rows[start:stop]),
+                    cellsPerBlock)
+        outnameTranspose = os.path.join(outdirectory,
+                                        "merged_transpose_" + self.name + ".out")
+        writeMatrix(outnameTranspose, self.entityNames, sampleNames,
+                    lambda start, stop: np.array([r[start:stop] for r in rows]).T,
+                    cellsPerBlock)
+        return outname
+
+def writeMatrix(outname, rowNames, colNames, block, cellsPerBlock=16384):
+    """
+    Writes a matrix as text, where block(start, stop) gives the values of
+    rows start to stop.  Blocks hold about cellsPerBlock values, so only
+    one block at a time is held as Python floats and strings.
+    """
+    rowsPerBlock = max(1, cellsPerBlock // max(1, len(colNames)))
     outFile = open(outname, 'w')
-    outFile.write(s)
-    for e in entities:
-        data = []
-        for sample in sampleNames:
-            data.append( str(sampleData[sample][col_map[e]]) )
-        s = e + '\t' + '\t'.join(data) + '\n'
-        outFile.write(s)
+    outFile.write("id" + '\t' + '\t'.join(colNames) + '\n')
+    for start in range(0, len(rowNames), rowsPerBlock):
+        text = formatValues(block(start, start + rowsPerBlock))
+        outFile.write(''.join([rowNames[start + i] + '\t' + '\t'.join(fields)
+                               + '\n' for i, fields in enumerate(text)]))
     outFile.close()
 
-    
-def mergeGroups(outdirectory, groups):
-
-    for g,files in groups.iteritems():        
-        sampleData = {}
-        ipl_map = {}
-        for fname in files:
-            inFile = open(fname)
-            
-            currentId = None
-            for line in inFile:
-                if line.startswith('>'):
-                    currentId = line.rstrip().strip('>').strip()
-                    sampleData[currentId] = array.array("f")
-                    if len(ipl_map) > 0:
-                        for a in ipl_map:
-                            sampleData[currentId].append(0.0)
-                    continue
-
-                if currentId is None:
-                    continue
-
-                data = line.rstrip().split('\t')
-                name = data[0]
-                if len(name.split("__")) > 1:
-                    continue
-
-                try:
-                    val = float(data[1])
-                except ValueError:
-                    val = float('nan')
-                    
-                if name not in ipl_map:
-                    ipl_map[name] = len(ipl_map)
-                    sampleData[currentId].append(val)
-                else:
-                    sampleData[currentId][ipl_map[name]] = val
-            inFile.close()
-            #addData(f, sampleData)
-
-        if len(sampleData) > 0:
-            outname = os.path.join(outdirectory, "merged_" + g + ".out")
-    
-            print "merging", len(files), "files into", outname
-            outputData(outname, sampleData, ipl_map)
-    
-            outnameTranspose = os.path.join(outdirectory, "merged_transpose_" + g + ".out")
-            outputDataTranspose(outnameTranspose, sampleData, ipl_map)
-
-def main(suffix, indirectory, outdirectory):
+def mergeGroup(args):
+    """
+    Merges and writes one group, returning its size and timing
+    """
+    (outdirectory, g, files) = args
+    start = time.time()
+    group = MergeGroup(g)
+    for fname in files:
+        group.addFile(fname)
+
+    if len(group.sampleNames) > 0:
+        group.writeFiles(outdirectory)
+    return (g, len(files), len(group.sampleNames), len(group.entityNames),
+            time.time() - start)
+
+def mergeGroups(outdirectory, groups, jobs=1, slowest=10):
+    """
+    Merges the groups in sorted order, on a pool of jobs processes that
+    each hold one group at a time, and reports per-group timings
+    """
+    tasks = [(outdirectory, g, groups[g]) for g in sorted(groups.keys())]
+    start = time.time()
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap(mergeGroup, tasks, 1)
+    else:
+        pool = None
+        results = itertools.imap(mergeGroup, tasks)
+    timings = []
+    for (g, files, samples, entities, seconds) in results:
+        timings.append((seconds, g, files))
+        if samples > 0:
+            print "merged %d files into %s: %d samples x %d entities in %.2f s (%d/%d)" \
+                % (files, os.path.join(outdirectory, "merged_" + g + ".out"),
+                   samples, entities, seconds, len(timings), len(tasks))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    print "merged %d groups in %.1f s, %.1f s of group time" \
+        % (len(tasks), time.time() - start, sum([t[0] for t in timings]))
+    if len(timings) > 0:
+        print "slowest groups:"
+    for (seconds, g, files) in sorted(timings, reverse=True)[0:slowest]:
+        print "  %s\t%d files\t%.2f s" % (g, files, seconds)
+
+def main(suffix, indirectory, outdirectory, jobs=1):
     allfiles = getFilesMatching(indirectory, [suffix])
     print "found ", len(allfiles), " files total"
     
     groups = groupFilesById(allfiles)
     print "grouped files into ", len(groups), " groups"
 
-    mergeGroups(outdirectory, groups)
+    mergeGroups(outdirectory, groups, jobs)
     
 
 def usage():
-    print "python mergeSwarmFiles.py [suffix] indirectory outdirectory"
+    print "python mergeSwarmFiles.py [-j jobs] [suffix] indirectory outdirectory"
     sys.exit(0)
     
 if __name__ == "__main__":
-    if len(sys.argv) != 3 and len(sys.argv) != 4:
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "j:")
+    except getopt.GetoptError:
+        usage()
+    jobs = 1
+    for o, a in opts:
+        if o == "-j":
+            jobs = int(a)
+
+    if len(args) != 2 and len(args) != 3:
         usage()
         
-    if len(sys.argv) == 3:
+    if len(args) == 2:
         suffix = "*.fa"
-        indirectory = sys.argv[1]
-        outdirectory = sys.argv[2]
+        indirectory = args[0]
+        outdirectory = args[1]
 
-    if len(sys.argv) == 4:
-        suffix = "*" + sys.argv[1]
-        indirectory = sys.argv[2]
-        outdirectory = sys.argv[3]
+    if len(args) == 3:
+        suffix = "*" + args[0]
+        indirectory = args[1]
+        outdirectory = args[2]
 
-    main(suffix, indirectory, outdirectory)
-        
+    main(suffix, indirectory, outdirectory, jobs)
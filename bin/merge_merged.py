@@ -3,16 +3,17 @@
 import os
 import sys
 import fnmatch
+import getopt
+import numpy as np
+from mergeSwarmFiles import formatValues
+import iplStore
 #from hgSQL import hgSQL
 
-resultMatrix = {} # first key is entity, then sample
-allMatrix = {}
-
-sampleList = []
-allsampleList = []
-
 def usage():
-    print "Usage: "+sys.argv[0]+" db merged_dir"
+    print "Usage: "+sys.argv[0]+" [-s store_dir [-z] [-t]] db merged_dir"
+    print "  -s dir   also write the matrix as a binary store (see iplStore.py)"
+    print "  -z       compress the store's chunks"
+    print "  -t       add the store's sample-major copy"
     sys.exit(0)
 
 def getFilesMatching(baseDir, patterns):
@@ -26,39 +27,128 @@ def getFilesMatching(baseDir, patterns):
                     list.append(ptr)
     return list
 
-def addFileToResult(file):
-    pid = file[:-4].split("_").pop()
-    fh = open(file,"r")
-    header = fh.readline().strip("\n").split("\t")
-    sampleOrder = header[1:]
-    #print sampleOrder
-    for sample in sampleOrder:
-        if sample.startswith("na_") == False and sample.split(" ").pop(0) not in sampleList:
-            sampleList.append(sample.split(" ").pop(0))
-        if sample.split(" ").pop(0) not in allsampleList:
-            allsampleList.append(sample.split(" ").pop(0))
-    for line in fh:
-        dataA = line.strip("\n").split("\t")
-        entity = dataA.pop(0)
-        resultMatrix[pid+"_"+entity] = {}
-        allMatrix[pid+"_"+entity] = {}
-        for i in range(len(dataA)):
-            sample = sampleOrder[i] ## sng ##
-            if sample.startswith("na_") == False:
-                resultMatrix[pid+"_"+entity][sampleOrder[i].split(" ").pop(0)] = dataA[i]
-            allMatrix[pid+"_"+entity][sampleOrder[i].split(" ").pop(0)] = dataA[i]
-    fh.close()
+def shortName(sample):
+    return sample.split(" ").pop(0)
+
+class MergedMatrix(object):
+    """
+    The pid_entity by sample values of every merged transpose file, in one
+    preallocated float32 matrix with a presence mask.  Samples are indexed
+    from the file headers up front; a pid_entity seen again takes the row
+    of its last file.  Numbers are written back as str() of their float32
+    value, which is how mergeSwarmFiles.py wrote them, and fields that are
+    not numbers, like NA, are kept as they were written.
+    """
+    def __init__(self, files):
+        self.files = files
+        self.samples = {}
+        self.sampleList = []
+        self.realList = []
+        rows = 0
+        for file in files:
+            fh = open(file, "r")
+            header = fh.readline().strip("\n").split("\t")
+            rows += sum([1 for line in fh])
+            fh.close()
+            for sample in header[1:]:
+                name = shortName(sample)
+                if sample.startswith("na_") == False and name not in self.samples:
+                    self.realList.append(name)
+                if name not in self.samples:
+                    self.samples[name] = len(self.sampleList)
+                    self.sampleList.append(name)
+        self.realColumns = [self.samples[s] for s in self.realList]
+        self.values = np.zeros((rows, len(self.sampleList)), dtype=np.float32)
+        self.present = np.zeros((rows, len(self.sampleList)), dtype=bool)
+        self.tokens = {}
+        self.rowIndex = {}
+        self.rows = 0
+    def addFile(self, file):
+        pid = file[:-4].split("_").pop()
+        fh = open(file, "r")
+        header = fh.readline().strip("\n").split("\t")
+        columns = np.array([self.samples[shortName(s)] for s in header[1:]],
+                           dtype=np.int64)
+        for line in fh:
+            dataA = line.strip("\n").split("\t")
+            entity = dataA.pop(0)
+            key = pid + "_" + entity
+            if key in self.rowIndex:
+                row = self.rowIndex[key]
+                self.present[row, :] = False
+                self.values[row, :] = 0.0
+                self.tokens.pop(row, None)
+            else:
+                row = self.rows
+                self.rows += 1
+                self.rowIndex[key] = row
+            n = min(len(dataA), len(columns))
+            self.setRow(row, columns[:n], dataA[:n])
+        fh.close()
+    def setRow(self, row, columns, tokens):
+        try:
+            vals = np.array(tokens, dtype=np.float64).astype(np.float32)
+        except ValueError:
+            vals = np.zeros(len(tokens), dtype=np.float32)
+            kept = {}
+            for i, t in enumerate(tokens):
+                try:
+                    vals[i] = float(t)
+                except ValueError:
+                    kept[columns[i]] = t
+            self.tokens[row] = kept
+        self.values[row, columns] = vals
+        self.present[row, columns] = True
+    def rowText(self, row):
+        text = formatValues(self.values[row])
+        present = self.present[row]
+        if not present.all():
+            for col in np.nonzero(~present)[0]:
+                text[col] = ""
+        for col, token in self.tokens.get(row, {}).items():
+            text[col] = token
+        return text
+    def write(self, resultName, allName):
+        """
+        Writes the real sample and all sample files in one pass
+        """
+        resultFile = open(resultName, "w")
+        resultFile.write("pid_entity\t")
+        resultFile.write("\t".join(self.realList)+"\n")
+        allFile = open(allName, "w")
+        allFile.write("pid_entity\t")
+        allFile.write("\t".join(self.sampleList)+"\n")
+        for entity in self.rowIndex:
+            text = self.rowText(self.rowIndex[entity])
+            resultFile.write("\t".join([entity] + [text[i] for i in self.realColumns]) + "\n")
+            allFile.write("\t".join([entity] + text) + "\n")
+        resultFile.close()
+        allFile.close()
+    def rowValues(self, row):
+        """
+        The values of a row with missing and non-numeric fields as NaN
+        """
+        values = np.where(self.present[row], self.values[row], np.nan)
+        for col in self.tokens.get(row, {}):
+            values[col] = np.nan
+        return values
+    def writeStore(self, directory, compress=False, sampleMajor=False):
+        writer = iplStore.StoreWriter(directory, self.sampleList,
+                                      compress=compress)
+        for entity in self.rowIndex:
+            row = self.rowIndex[entity]
+            writer.addRow(entity, self.rowValues(row), self.present[row])
+        writer.close(sampleMajor)
 
-def main(db,directory):
+def main(db,directory,store=None,compress=False,sampleMajor=False):
     files = getFilesMatching(directory, ["*_transpose_*"])
+    files = [f for f in files if f[:-4].split("_").pop() != "example"]
     
     print "Loading data",
     sys.stdout.flush()
+    merged = MergedMatrix(files)
     for f in files:
-        pid = f[:-4].split("_").pop()
-        if pid == "example":
-            continue
-        addFileToResult(f)
+        merged.addFile(f)
         print ".",
         sys.stdout.flush()
         
@@ -86,41 +176,30 @@ def main(db,directory):
     #connection.close()
     #print "done."
     print "Printing Results..."
-    resultFile = open("merge_merged_unfiltered.tab","w")
-    resultFile.write("pid_entity\t")
-    resultFile.write("\t".join(sampleList)+"\n")
-    for entity in resultMatrix:
-        resultFile.write(entity)
-        for sample in sampleList:
-            resultFile.write("\t")
-            #print sample
-            #print resultMatrix[entity]
-            #sys.exit(0)
-            if sample in resultMatrix[entity]:
-                resultFile.write(resultMatrix[entity][sample])
-        resultFile.write("\n")
-    resultFile.close()
-    
-    allFile = open("merge_merged_unfiltered.all.tab","w")
-    allFile.write("pid_entity\t")
-    allFile.write("\t".join(allsampleList)+"\n")
-    for entity in allMatrix:
-        allFile.write(entity)
-        for sample in allsampleList:
-            allFile.write("\t")
-            #print sample
-            #print allMatrix[entity]
-            #sys.exit(0)
-            if sample in allMatrix[entity]:
-                allFile.write(allMatrix[entity][sample])
-        allFile.write("\n")
-    allFile.close()
+    merged.write("merge_merged_unfiltered.tab", "merge_merged_unfiltered.all.tab")
+    if store is not None:
+        print "Writing store %s..." % (store)
+        merged.writeStore(store, compress, sampleMajor)
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "s:zt")
+    except getopt.GetoptError:
+        usage()
+    if len(args) != 2:
         usage()
+    store = None
+    compress = False
+    sampleMajor = False
+    for o, a in opts:
+        if o == "-s":
+            store = a
+        elif o == "-z":
+            compress = True
+        elif o == "-t":
+            sampleMajor = True
     
-    db = sys.argv[1]
-    directory = sys.argv[2]
-    main(db,directory)
+    db = args[0]
+    directory = args[1]
+    main(db,directory,store,compress,sampleMajor)
 
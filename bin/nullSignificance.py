@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""nullSignificance.py: empirical significance of IPLs against their nulls
+
+Scores every real sample of an unfiltered IPL matrix against the null
+(na_) samples of the same pathway entity.  The absolute null IPLs of each
+entity are sorted once and every real IPL is placed among them by binary
+search, giving the empirical p-value
+
+  p = (1 + nulls with |IPL| >= |real IPL|) / (1 + nulls)
+
+Benjamini-Hochberg q-values are then computed for each sample over all of
+its entities.  Missing values and entities without nulls get no p-value.
+The matrix is read a chunk of entities at a time; the p-values of the real
+samples are kept, one float32 each.
+
+Usage:
+  nullSignificance.py [options] unfiltered_all|ipl_store
+
+Options:
+   -p file    p-value matrix (default: significance.p.tab)
+   -q file    q-value matrix (default: significance.q.tab)
+   -f file    entities with at least count samples at q <= fdr
+              (default: significant.list)
+   -a flt     fdr (default 0.05)
+   -c int     count (default 1)
+   -r int     entities per chunk (default 1000)
+
+filterParadigm.py --fdr applies the same filter to its outputs.
+"""
+import os, sys, getopt
+import numpy as np
+import iplStore
+
+def isReal(sample):
+    return not (sample.startswith("na_") or sample.startswith("nw_"))
+
+def readChunks(input_file, chunkRows=1000):
+    """
+    Yields (samples, entities, values) for every chunk of entities of a
+    matrix file or store
+    """
+    if iplStore.isStore(input_file):
+        store = iplStore.IPLStore(input_file)
+        for (start, block) in store.chunks():
+            yield (store.samples, store.entities[start:start + block.shape[0]],
+                   np.asarray(block, dtype=np.float64))
+        return
+    f = open(input_file, "r")
+    samples = f.readline().rstrip("\r\n").split("\t")[1:]
+    entities = []
+    rows = []
+    for line in f:
+        parts = line.rstrip("\r\n").split("\t")
+        entities.append(parts[0])
+        rows.append(parts[1:])
+        if len(rows) >= chunkRows:
+            yield (samples, entities,
+                   iplStore.parseRows(rows, len(samples), np.float64))
+            entities = []
+            rows = []
+    f.close()
+    if len(rows) > 0:
+        yield (samples, entities,
+               iplStore.parseRows(rows, len(samples), np.float64))
+
+def empiricalPValues(real, nulls):
+    """
+    p-values of the real IPLs of each entity (row) against its null IPLs
+    """
+    nulls = np.sort(np.abs(nulls), axis=1)
+    counts = (~np.isnan(nulls)).sum(axis=1)
+    real = np.abs(real)
+    p = np.empty(real.shape, dtype=np.float32)
+    p[:] = np.nan
+    for i in np.nonzero(counts > 0)[0]:
+        n = counts[i]
+        above = n - np.searchsorted(nulls[i, :n], real[i], side="left")
+        p[i] = (above + 1.0) / (n + 1.0)
+    p[np.isnan(real)] = np.nan
+    return p
+
+def qValues(p):
+    """
+    Benjamini-Hochberg q-values of each column of p-values
+    """
+    q = np.empty(p.shape, dtype=np.float32)
+    q[:] = np.nan
+    for j in range(p.shape[1]):
+        tested = np.nonzero(~np.isnan(p[:, j]))[0]
+        m = len(tested)
+        if m == 0:
+            continue
+        order = tested[np.argsort(p[tested, j], kind="mergesort")]
+        adjusted = p[order, j].astype(np.float64) * m / np.arange(1, m + 1)
+        q[order, j] = np.minimum(np.minimum.accumulate(adjusted[::-1])[::-1],
+                                 1.0)
+    return q
+
+def scoreMatrix(input_file, chunkRows=1000):
+    """
+    Returns the entities, real samples, p-values and q-values of a matrix
+    """
+    entities = []
+    chunks = []
+    for (samples, names, values) in readChunks(input_file, chunkRows):
+        realCols = [i for i, s in enumerate(samples) if isReal(s)]
+        nullCols = [i for i, s in enumerate(samples) if s.startswith("na_")]
+        entities += names
+        chunks.append(empiricalPValues(values[:, realCols],
+                                       values[:, nullCols]))
+    if len(chunks) == 0:
+        return ([], [], np.zeros((0, 0)), np.zeros((0, 0)))
+    p = np.vstack(chunks)
+    return (entities, [samples[i] for i in realCols], p, qValues(p))
+
+def significantRows(q, fdr=0.05, count=1):
+    """
+    Mask of the entities with at least count samples at q <= fdr
+    """
+    with np.errstate(invalid="ignore"):
+        return (q <= fdr).sum(axis=1) >= count
+
+def writeMatrix(filename, entities, samples, values):
+    f = open(filename, "w")
+    f.write("\t".join(["id"] + samples) + "\n")
+    for i, entity in enumerate(entities):
+        text = np.char.mod("%.4g", values[i]).astype(object)
+        text[np.isnan(values[i])] = "NA"
+        f.write("\t".join([entity] + list(text)) + "\n")
+    f.close()
+
+def usage(code=0):
+    print __doc__
+    if code != None: sys.exit(code)
+
+def main(args):
+    try:
+        opts, args = getopt.getopt(args, "p:q:f:a:c:r:")
+    except getopt.GetoptError, err:
+        print str(err)
+        usage(2)
+    if len(args) != 1:
+        usage(1)
+    pFile = "significance.p.tab"
+    qFile = "significance.q.tab"
+    listFile = "significant.list"
+    fdr = 0.05
+    count = 1
+    chunkRows = 1000
+    for o, a in opts:
+        if o == "-p":
+            pFile = a
+        elif o == "-q":
+            qFile = a
+        elif o == "-f":
+            listFile = a
+        elif o == "-a":
+            fdr = float(a)
+        elif o == "-c":
+            count = int(a)
+        elif o == "-r":
+            chunkRows = int(a)
+    (entities, samples, p, q) = scoreMatrix(args[0], chunkRows)
+    writeMatrix(pFile, entities, samples, p)
+    writeMatrix(qFile, entities, samples, q)
+    selected = significantRows(q, fdr, count)
+    f = open(listFile, "w")
+    for i in np.nonzero(selected)[0]:
+        f.write(entities[i] + "\n")
+    f.close()
+    print "%i of %i entities significant" % (selected.sum(), len(entities))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
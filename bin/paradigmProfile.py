@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""paradigmProfile.py: profile paradigm jobs and recalibrate timings.tab
+
+galaxyParadigm.py --profile runs every job line through runJobLine, which
+records the wall time and peak RSS of each command on the line in
+profileFiles/.  This script aggregates those records into per-pathway
+timings for the final run (timings.tab) and the EM passes
+(timingsEM.tab) in the format prepareParadigm.py reads, with the peak RSS
+in kilobytes as a third column.
+
+Usage:
+  paradigmProfile.py [options] profile_dir
+  paradigmProfile.py -r job_line
+
+Options:
+   -s int     number of real samples the profiled run had (default: counted
+              from the first evidence file in config.txt under clusterFiles/)
+   -t file    existing timings.tab, pathways that weren't profiled keep
+              their time from it
+   -o file    final run timings output (default: timings.tab)
+   -e file    EM timings output (default: timingsEM.tab)
+   -r line    run a job line, recording it in profileFiles/, instead
+"""
+import os, sys, re, getopt, glob, socket, subprocess, time
+import pathwayCost
+
+profileDir = "profileFiles"
+recordColumns = ["pass", "pathway", "batch", "bucket", "buckets",
+                 "wall_seconds", "max_rss_kb", "status"]
+
+def splitJobLine(line):
+    """
+    The commands of a (possibly packed) job line
+    """
+    return [c for c in pathwayCost.unpackCommands(line) if c]
+
+def describeCommand(command):
+    """
+    Returns the pass, pathway, null batch and bucket a paradigm command runs
+    """
+    m = re.search("-p (\S+_pathway\.tab)", command)
+    pathway = os.path.basename(m.group(1)) if m else ""
+    if "configEM.txt" in command:
+        runPass = "em"
+    else:
+        runPass = "final"
+    m = re.search("na_batch_(\d+)_", command)
+    batch = m.group(1) if m else ""
+    m = re.search("-[oe] \S*_b(\d+)_(\d+)_", command)
+    if m:
+        (bucket, buckets) = (int(m.group(1)), int(m.group(2)))
+    else:
+        (bucket, buckets) = (0, 1)
+    return (runPass, pathway, batch, bucket, buckets)
+
+def runProfiled(command):
+    """
+    Runs command through the shell, returning its exit status, wall time
+    and the peak RSS in kilobytes of it and everything it waited for
+    """
+    start = time.time()
+    p = subprocess.Popen(command, shell=True)
+    (pid, status, usage) = os.wait4(p.pid, 0)
+    if os.WIFSIGNALED(status):
+        status = -os.WTERMSIG(status)
+    else:
+        status = os.WEXITSTATUS(status)
+    p.returncode = status
+    return (status, time.time() - start, usage.ru_maxrss)
+
+def runJobLine(line, directory=profileDir):
+    """
+    Runs the commands of a job line until one fails, appending a record for
+    each to a profile file unique to this host and process, and returns the
+    exit status of the failed command or 0
+    """
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass
+    recordFile = os.path.join(directory, "%s.%i.tab" % (socket.gethostname(),
+                                                        os.getpid()))
+    lineStatus = 0
+    for command in splitJobLine(line):
+        (status, wall, maxRSS) = runProfiled(command)
+        lineStatus = status
+        (runPass, pathway, batch, bucket, buckets) = describeCommand(command)
+        f = open(recordFile, "a")
+        f.write("%s\t%s\t%s\t%i\t%i\t%.3f\t%i\t%i\n" % (runPass, pathway, batch,
+                                                      bucket, buckets, wall,
+                                                      maxRSS, status))
+        f.close()
+        if status != 0:
+            break
+    return lineStatus
+
+def readRecords(directory):
+    records = []
+    for recordFile in sorted(glob.glob(os.path.join(directory, "*.tab"))):
+        f = open(recordFile, "r")
+        for line in f:
+            parts = line.rstrip("\n").split("\t")
+            if len(parts) != len(recordColumns):
+                continue
+            record = dict(zip(recordColumns, parts))
+            for key in ["bucket", "buckets", "max_rss_kb", "status"]:
+                record[key] = int(record[key])
+            record["wall_seconds"] = float(record["wall_seconds"])
+            records.append(record)
+        f.close()
+    return records
+
+def aggregateTimings(records, runPass):
+    """
+    Seconds and peak RSS for the real samples of every pathway in a pass.
+    Repeated runs of a bucket (EM iterations) are averaged, then buckets
+    are summed, using the bucketing with the most complete coverage.
+    """
+    runs = {}
+    for r in records:
+        if r["pass"] != runPass or r["batch"] != "" or r["status"] != 0 \
+                or r["pathway"] == "":
+            continue
+        key = (r["pathway"], r["buckets"])
+        runs.setdefault(key, {}).setdefault(r["bucket"], []).append(r)
+    timings = {}
+    for (pathway, buckets), bucketRuns in runs.items():
+        coverage = len(bucketRuns) / float(buckets)
+        seconds = sum([sum([r["wall_seconds"] for r in rs]) / len(rs)
+                       for rs in bucketRuns.values()]) / coverage
+        maxRSS = max([r["max_rss_kb"] for rs in bucketRuns.values()
+                      for r in rs])
+        if pathway not in timings or coverage > timings[pathway][2]:
+            timings[pathway] = (seconds, maxRSS, coverage)
+    return timings
+
+def writeTimings(filename, samples, timings, previous={}):
+    f = open(filename, "w")
+    f.write("# samples %i\n" % samples)
+    for pathway in sorted(set(timings.keys()) | set(previous.keys())):
+        if pathway in timings:
+            (seconds, maxRSS, coverage) = timings[pathway]
+            f.write("%.2f\t%s\t%i\n" % (seconds, pathway, maxRSS))
+        else:
+            f.write("%.2f\t%s\n" % (previous[pathway] * samples, pathway))
+    f.close()
+
+def countSamples(config="config.txt", dataDir="clusterFiles"):
+    f = open(config, "r")
+    m = re.search("evidence \[suffix=([^,\]]+)", f.read())
+    f.close()
+    if not m:
+        print "no evidence found in %s, give the number of samples with -s" \
+            % config
+        sys.exit(1)
+    f = open(os.path.join(dataDir, m.group(1)), "r")
+    samples = sum([1 for line in f]) - 1
+    f.close()
+    return samples
+
+def usage(code=0):
+    print __doc__
+    if code != None: sys.exit(code)
+
+def main(args):
+    try:
+        opts, args = getopt.getopt(args, "s:t:o:e:r:")
+    except getopt.GetoptError, err:
+        print str(err)
+        usage(2)
+    for o, a in opts:
+        if o == "-r":
+            sys.exit(min(abs(runJobLine(a)), 255))
+    if len(args) != 1:
+        usage(1)
+    samples = None
+    previous = {}
+    finalOut = "timings.tab"
+    emOut = "timingsEM.tab"
+    for o, a in opts:
+        if o == "-s":
+            samples = int(a)
+        elif o == "-t":
+            previous = pathwayCost.readTimingFile(a)
+        elif o == "-o":
+            finalOut = a
+        elif o == "-e":
+            emOut = a
+    if samples is None:
+        samples = countSamples()
+    records = readRecords(args[0])
+    for runPass, filename in (("final", finalOut), ("em", emOut)):
+        timings = aggregateTimings(records, runPass)
+        if len(timings) == 0:
+            continue
+        writeTimings(filename, samples, timings, previous)
+        sys.stderr.write("wrote %i %s pathway timings to %s\n"
+                         % (len(timings), runPass, filename))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
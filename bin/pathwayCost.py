@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""pathwayCost.py: estimate per-sample paradigm run times from pathway structure
+
+The model counts the factor table entries paradigm builds for a pathway:
+every gene/protein node expands into its dogma, and every node gets a
+factor over itself and its parents, where a node with more parents than
+max_in_degree is split into a tree of intermediate nodes with at most
+max_in_degree parents each.  The component> and member> parents of a
+complex also become one clique in a junction tree, so with JTREE every
+complex adds the entries of its (split) component fan-in once more.
+Table entries are scaled by a per inference method factor, and, when a
+timings.tab is available, calibrated so the model's median matches the
+measured pathways.
+
+Usage:
+  pathwayCost.py [options] pathway_file [pathway_file ...]
+
+Options:
+   -i string   inference parameters (default method=JTREE)
+   -m int      max_in_degree of the pathway config (default 5)
+   -t file     timings.tab to calibrate the model against
+"""
+import os, sys, re, getopt, heapq
+
+states = 3                 # states per variable
+dogmaFactors = 4           # factors added per gene/protein by the dogma
+geneTypes = ["protein"]
+complexEdges = ["component>", "member>"]
+cliqueMethods = ["JTREE"]  # methods that build cliques over complex components
+packSeparator = ") && ("
+secondsPerEntry = 2e-5     # before calibration
+methodFactors = {"JTREE" : 4.0, "BP" : 1.0}
+defaultMethodFactor = 2.0
+
+def readTimingFile(filename):
+    """
+    Reads a timings.tab into per-sample seconds keyed by pathway file name
+    """
+    tfile = open(filename, "r")
+    samplesline = tfile.readline().rstrip();
+    m = re.search('^#\s*samples\s*(\d+)\s*', samplesline)
+    if not m:
+        print "missing samples line on pathway timings"
+        sys.exit(1)
+    samples = int(m.group(1))
+    result = {}
+    for line in tfile:
+        timestring, pathway = line.rstrip().split("\t")[0:2]
+        result[pathway] = float(timestring) / samples
+    tfile.close()
+    return result
+
+def readPathwayStats(pathwayFile):
+    """
+    Returns node, edge, in-degree and complex fan-in counts for a paradigm
+    pathway file
+    """
+    nodeTypes = {}
+    inDegree = {}
+    complexFanIn = {}
+    edges = 0
+    f = open(pathwayFile, "r")
+    for line in f:
+        parts = line.rstrip("\r\n").split("\t")
+        if len(parts) == 2:
+            nodeTypes[parts[1]] = parts[0]
+        elif len(parts) >= 3:
+            edges += 1
+            inDegree[parts[1]] = inDegree.get(parts[1], 0) + 1
+            if parts[2] in complexEdges:
+                complexFanIn[parts[1]] = complexFanIn.get(parts[1], 0) + 1
+    f.close()
+    return {"nodes" : len(nodeTypes),
+            "genes" : len([n for n in nodeTypes if nodeTypes[n] in geneTypes]),
+            "edges" : edges,
+            "inDegrees" : inDegree.values(),
+            "maxInDegree" : max([0] + inDegree.values()),
+            "complexFanIns" : complexFanIn.values(),
+            "maxComplexFanIn" : max([0] + complexFanIn.values())}
+
+def factorEntries(inDegree, maxInDegree):
+    """
+    Factor table entries for a node with inDegree parents
+    """
+    maxInDegree = max(2, maxInDegree)
+    entries = 0
+    while inDegree > maxInDegree:
+        entries += states ** (maxInDegree + 1)
+        inDegree = inDegree - maxInDegree + 1
+    return entries + states ** (inDegree + 1)
+
+def inferenceMethod(inference):
+    m = re.search("method=([A-Za-z_]+)", inference)
+    if m:
+        return m.group(1)
+    return ""
+
+def modelCost(stats, inference, maxInDegree):
+    """
+    Uncalibrated per-sample seconds for a pathway with the given stats
+    """
+    unlinked = stats["nodes"] - len(stats["inDegrees"])
+    entries = stats["genes"] * dogmaFactors * states ** 2 \
+        + unlinked * states \
+        + sum([factorEntries(d, maxInDegree) for d in stats["inDegrees"]])
+    if inferenceMethod(inference) in cliqueMethods:
+        entries += sum([factorEntries(d, maxInDegree)
+                        for d in stats["complexFanIns"]])
+    factor = methodFactors.get(inferenceMethod(inference), defaultMethodFactor)
+    return secondsPerEntry * factor * entries
+
+def calibrationScale(modelled, timings):
+    """
+    The median ratio of measured to modelled per-sample time
+    """
+    ratios = sorted([timings[p] / modelled[p] for p in modelled
+                     if p in timings and modelled[p] > 0])
+    if len(ratios) == 0:
+        return 1.0
+    return ratios[len(ratios) / 2]
+
+def pathwayCosts(pathFiles, inference, maxInDegree, timings={}):
+    """
+    Per-sample seconds for every pathway file, keyed by basename.  Measured
+    timings are used where present and the calibrated model elsewhere.
+    """
+    modelled = {}
+    for p in pathFiles:
+        modelled[os.path.basename(p)] = modelCost(readPathwayStats(p),
+                                                  inference, maxInDegree)
+    scale = calibrationScale(modelled, timings)
+    costs = {}
+    for pathway in modelled:
+        if pathway in timings:
+            costs[pathway] = timings[pathway]
+        else:
+            costs[pathway] = modelled[pathway] * scale
+    return costs
+
+def packCommands(commands):
+    """
+    A job line running commands one after the other, stopping with the exit
+    status of the first one that fails
+    """
+    if len(commands) == 1:
+        return commands[0]
+    return "(" + packSeparator.join(commands) + ")"
+
+def unpackCommands(line):
+    """
+    The commands of a (possibly packed) job line
+    """
+    line = line.strip()
+    if line.startswith("(") and line.endswith(")") and packSeparator in line:
+        return [c.strip() for c in line[1:-1].split(packSeparator)]
+    return [line]
+
+def packJobs(jobs, targetLength):
+    """
+    First-fit decreasing packing of (seconds, command) jobs shorter than
+    targetLength into jobs of up to targetLength, run one after the other
+    """
+    packed = [job for job in jobs if job[0] >= targetLength]
+    bins = []
+    for seconds, command in sorted([job for job in jobs
+                                    if job[0] < targetLength], reverse=True):
+        for b in bins:
+            if b[0] + seconds <= targetLength:
+                b[0] += seconds
+                b[1].append(command)
+                break
+        else:
+            bins.append([seconds, [command]])
+    packed += [(b[0], packCommands(b[1])) for b in bins]
+    return packed
+
+def makespan(costs, slots):
+    """
+    Predicted wall time of running jobs longest first on slots workers
+    """
+    loads = [0.0] * max(1, slots)
+    for seconds in sorted(costs, reverse=True):
+        heapq.heappush(loads, heapq.heappop(loads) + seconds)
+    return max(loads)
+
+def usage(code=0):
+    print __doc__
+    if code != None: sys.exit(code)
+
+def main(args):
+    try:
+        opts, args = getopt.getopt(args, "i:m:t:")
+    except getopt.GetoptError, err:
+        print str(err)
+        usage(2)
+    if len(args) == 0:
+        usage(1)
+    inference = "method=JTREE"
+    maxInDegree = 5
+    timings = {}
+    for o, a in opts:
+        if o == "-i":
+            inference = a
+        elif o == "-m":
+            maxInDegree = int(a)
+        elif o == "-t":
+            timings = readTimingFile(a)
+    costs = pathwayCosts(args, inference, maxInDegree, timings)
+    print "pathway\tnodes\tedges\tmax_in_degree\tmax_complex_fan_in\tseconds_per_sample"
+    for p in args:
+        stats = readPathwayStats(p)
+        pathway = os.path.basename(p)
+        print "%s\t%i\t%i\t%i\t%i\t%.4g" % (pathway, stats["nodes"],
+                                           stats["edges"],
+                                           stats["maxInDegree"],
+                                           stats["maxComplexFanIn"],
+                                           costs[pathway])
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
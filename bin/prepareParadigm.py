@@ -36,6 +36,20 @@ Options:
    -i string            inference parameters 
                         (default is method=JTREE,updates=HUGIN,verbose=1)
    -c options           options to pass to createNullFiles.py (quote them all)
+   -j int               worker processes for writing null batches, passed
+                        to createNullFiles.py with the -c options (default: 1)
+   -l                   lazy nulls: don't write na_batch files up front, each
+                        null job generates just its own bucket of null rows
+                        right before paradigm runs and removes them after
+   -r int               random seed for the null samples (default: random)
+   -T int               target job length in seconds (default: 45); jobs are
+                        sized from pathway timings.tab entries (and
+                        timingsEM.tab for EM jobs, see paradigmProfile.py)
+                        or a cost model of the pathway graph (see
+                        pathwayCost.py)
+   -P int               parallel job slots for the makespan report in
+                        jobs.plan (default: 100)
+   -u                   don't pack short jobs together into one job line
    -b flt;flt[,flt;flt] boundaries for discretization, use comma to specify different
                         boundaries per evidence (default 0.333;0.667)
    -y                   using the public version of paradigm
@@ -43,8 +57,9 @@ Options:
 """
 ## Written by: Charles Vaske
 ## Modifications by: Sam Ng
-import os, sys, glob, getopt, re, subprocess, math, json
+import os, sys, glob, getopt, re, subprocess, math, json, random
 import pandas
+import pathwayCost
 
 ###
 ### Experiments to find the path of the currently executing script
@@ -65,6 +80,7 @@ evidenceTypes = {
     }
 
 dataDir = "clusterFiles"
+lazyDir = dataDir + "/lazy"
 #outputEmDir = "outputFilesEM"
 #outputDir = "outputFiles"
 
@@ -78,10 +94,15 @@ paradigmExec = os.path.join(os.path.abspath(os.path.dirname(__file__)), "paradig
 dryrun = False
 
 nullOptions = ""
+nullJobs = 1
 nullBatches = 2
 nullBatchSize = 500
+nullSeed = None
+lazyNulls = False
 
 targetJobLength = 45 # seconds
+jobSlots = 100 # parallel jobs assumed for the makespan report
+packJobs = True
 
 disc = "0.333;0.667"
 paramFile = ""
@@ -214,27 +235,68 @@ def readPathwayFeatures(pathway):
             features.append(parts[1])
     return features
 
-def readPathwayTiming(directory, pathways):
-    if not os.path.exists(directory + "/timings.tab"):
-        return {pathway.split('/')[-1] : 900.0 for pathway in pathways}
-    tfile = open(directory + "/timings.tab", "r")
-    samplesline = tfile.readline().rstrip();
-    m = re.search('^#\s*samples\s*(\d+)\s*', samplesline)
-    if not m:
-        print "missing samples line on pathway timings"
-        sys.exit(1)
-    samples = int(m.group(1))
-    result = {}
-    for line in tfile:
-        timestring, pathway = line.rstrip().split("\t")
-        result[pathway] = float(timestring) / samples
-    return result
-
-def numBuckets(pathway, samples, timings, targetLength):
-    if pathway not in timings:
+def readPathwayTiming(directory, pathways, name="timings.tab"):
+    if not os.path.exists(directory + "/" + name):
+        return {}
+    return pathwayCost.readTimingFile(directory + "/" + name)
+
+def maxInDegree(config):
+    m = re.search("max_in_degree=(\d+)", config)
+    if m:
+        return int(m.group(1))
+    return 5
+
+def numBuckets(pathway, samples, costs, targetLength):
+    if pathway not in costs:
         return samples
-    length = timings[pathway] * samples
-    return min(int(math.ceil(length / targetLength)), samples)
+    length = costs[pathway] * samples
+    return max(1, min(int(math.ceil(length / targetLength)), samples))
+
+def writeJobList(filename, jobs):
+    """
+    Writes (seconds, command) jobs, after packing short ones together, to
+    filename with their predicted seconds in the matching .cost file, and
+    reports the predicted makespan
+    """
+    if packJobs:
+        jobs = pathwayCost.packJobs(jobs, targetJobLength)
+    jobs = sorted(jobs, key=lambda job: -job[0])
+    stem = os.path.splitext(filename)[0]
+    jfile = open(filename, "w")
+    cfile = open(stem + ".cost", "w")
+    for seconds, command in jobs:
+        jfile.write(command + "\n")
+        cfile.write("%.2f\n" % seconds)
+    jfile.close()
+    cfile.close()
+    total = sum([job[0] for job in jobs])
+    longest = max([0.0] + [job[0] for job in jobs])
+    report = "%s: %i jobs, %.0f cpu seconds, longest job %.0f s, " \
+        "predicted makespan %.0f s on %i slots\n" \
+        % (filename, len(jobs), total, longest,
+           pathwayCost.makespan([job[0] for job in jobs], jobSlots), jobSlots)
+    log(report)
+    rfile = open("jobs.plan", "a")
+    rfile.write(report)
+    rfile.close()
+
+def lazyNullCommand(pathwayFile, pbid, batch, bucket, buckets, out, evidence):
+    """
+    A job that writes the null rows of one batch bucket from the restricted
+    evidence in dataDir, runs paradigm on just those rows and removes them
+    again whether paradigm succeeded, failed or was terminated, exiting
+    with its status
+    """
+    prefix = "%s/%s_na_batch" % (lazyDir, pbid)
+    generate = "%s %s/createNullFiles.py -q %s -r %i -B %i -k %i,%i -p %s %s %s" % \
+        (sys.executable, scriptDirectory, nullOptions, nullSeed, batch, bucket,
+         buckets, prefix, str(nullBatchSize),
+         " ".join([e["outputFile"] for e in evidence]))
+    run = "%s -p %s -c config.txt -b %s_%i_ -o %s" % \
+        (paradigmExec, pathwayFile, prefix, batch, out)
+    clean = "rm -f %s_%i_*" % (prefix, batch)
+    return "trap '%s; exit 143' TERM; (%s > /dev/null && %s); s=$?; %s; exit $s" \
+        % (clean, generate, run, clean)
 
 def usage(code=0):
     print __doc__
@@ -297,7 +359,7 @@ def mkdir(dirname):
 def prepareParadigm(args):
     pathwayDir = None
     try:
-        opts, args = getopt.getopt(args, "p:n:e:qc:b:s:t:i:d:y")
+        opts, args = getopt.getopt(args, "p:n:e:qc:b:s:t:i:d:yj:lr:T:P:u")
     except getopt.GetoptError, err:
         print str(err)
         usage(2)
@@ -307,7 +369,8 @@ def prepareParadigm(args):
         usage(1)
     
     global paradigmExec, dryrun, nullOptions, disc
-    global nullBatches, nullBatchSize, paramFile, inference, dogmaDir
+    global nullBatches, nullBatchSize, nullJobs, paramFile, inference, dogmaDir
+    global nullSeed, lazyNulls, targetJobLength, jobSlots, packJobs
     global configTop, configTopEM
     global publicParadigm, publicBatchFix
     for o, a in opts:
@@ -340,6 +403,18 @@ def prepareParadigm(args):
             verbose = False
         elif o == "-c":
             nullOptions = a
+        elif o == "-j":
+            nullJobs = int(a)
+        elif o == "-l":
+            lazyNulls = True
+        elif o == "-r":
+            nullSeed = int(a)
+        elif o == "-T":
+            targetJobLength = float(a)
+        elif o == "-P":
+            jobSlots = int(a)
+        elif o == "-u":
+            packJobs = False
         elif o == "-b":
             disc = a
         elif o == "-t":
@@ -363,9 +438,25 @@ def prepareParadigm(args):
         cmd = evidenceStreamCommand(e["spec"]) + " > " + e["suffix"]
         syscmd(cmd)
     
-    cmd = "%s %s/createNullFiles.py %s -t %s -p %s/na_batch -b %i %s " % \
-        (sys.executable, scriptDirectory, nullOptions, dataDir, dataDir, 
-         nullBatches, str(nullBatchSize)) \
+    if lazyNulls and publicParadigm:
+        print "WARNING: lazy nulls are not supported with the public paradigm,"
+        print "         writing na_batch files up front"
+        lazyNulls = False
+    if nullSeed is None:
+        nullSeed = random.SystemRandom().randint(0, 2**31 - 1)
+    log("Null sample seed: %i\n" % nullSeed)
+    if lazyNulls:
+        mkdir(lazyDir)
+        prepareBatches = 0
+        prepareOptions = nullOptions + " -z"
+    else:
+        prepareBatches = nullBatches
+        prepareOptions = nullOptions
+    if nullJobs > 1:
+        prepareOptions += " -j %i" % nullJobs
+    cmd = "%s %s/createNullFiles.py %s -r %i -t %s -p %s/na_batch -b %i %s " % \
+        (sys.executable, scriptDirectory, prepareOptions, nullSeed, dataDir,
+         dataDir, prepareBatches, str(nullBatchSize)) \
         + " ".join([e["suffix"] for e in evidence])
     syscmd(cmd)
     
@@ -409,25 +500,36 @@ def prepareParadigm(args):
     
     pathFiles = glob.glob(dataDir + "/*_pathway.tab")
     timings = readPathwayTiming(pathwayDir, pathFiles)
+    costs = pathwayCost.pathwayCosts(pathFiles, inference, maxInDegree(configTop),
+                                     timings)
+    timingsEM = readPathwayTiming(pathwayDir, pathFiles, "timingsEM.tab")
+    if len(timingsEM) > 0:
+        costsEM = pathwayCost.pathwayCosts(pathFiles, inference,
+                                           maxInDegree(configTopEM), timingsEM)
+    else:
+        costsEM = costs
     
+    if os.path.exists("jobs.plan"):
+        os.unlink("jobs.plan")
     log("writing EM jobs list\n")
-    jfile = open("jobsEM.list", "w")
+    jobs = []
     for p in pathFiles:
         pathway = os.path.basename(p)
-        buckets = numBuckets(pathway, samples, timings, targetJobLength)
+        buckets = numBuckets(pathway, samples, costsEM, targetJobLength)
         pid = pathway[0:-len("_pathway.tab")]
         if buckets == 1 and not publicParadigm:
             emOut = "outputFilesEM/" + pid + "_learned_parameters.fa"
-            jfile.write("%s -p %s -c configEM.txt -b %s/ -e %s\n" % 
-                        (paradigmExec, p, dataDir, emOut))
+            c = "%s -p %s -c configEM.txt -b %s/ -e %s" % \
+                (paradigmExec, p, dataDir, emOut)
+            jobs.append((costsEM[pathway] * samples, c))
         elif not publicParadigm:
             for b in range(buckets):
                 pbid = "%s_b%i_%i" % (pid, b, buckets)
                 emOut = "outputFilesEM/" + pbid + "_learned_parameters.fa"
                 out = "outputFilesEM/" + pbid + "_output.fa"
-                c = "%s -p %s -c configEM.txt -b%s/ -e %s -s %i,%i\n" % \
+                c = "%s -p %s -c configEM.txt -b%s/ -e %s -s %i,%i" % \
                     (paradigmExec, p, dataDir, emOut, b, buckets)
-                jfile.write(c)
+                jobs.append((costsEM[pathway] * samples / buckets, c))
         else:
             publicBatchFix = True
             buckets = samples
@@ -435,57 +537,69 @@ def prepareParadigm(args):
                 pbid = "%s_b%i_%i" % (pid, b, buckets)
                 emOut = "outputFilesEM/" + pbid + "_learned_parameters.fa"
                 out = "outputFilesEM/" + pbid + "_output.fa"
-                c = "%s -p %s -c configEM.txt -b%s/%s_ -e %s\n" % \
+                c = "%s -p %s -c configEM.txt -b%s/%s_ -e %s" % \
                     (paradigmExec, p, dataDir, pbid, emOut)
-                jfile.write(c)
-    jfile.close()
+                jobs.append((costsEM[pathway], c))
+    writeJobList("jobsEM.list", jobs)
     
     log("writing jobs list\n")
-    jfile = open("jobs.list", "w")
+    jobs = []
     for p in pathFiles:
         pathway = os.path.basename(p)
-        buckets = numBuckets(pathway, samples, timings, targetJobLength)
+        buckets = numBuckets(pathway, samples, costs, targetJobLength)
         pid = pathway[0:-len("_pathway.tab")]
         if buckets == 1 and not publicParadigm:
             out = "outputFiles/" + pid + "_output.fa"
-            jfile.write("%s -p %s -c config.txt -b %s/ -o %s\n" % 
-                        (paradigmExec, p, dataDir, out))
+            c = "%s -p %s -c config.txt -b %s/ -o %s" % \
+                (paradigmExec, p, dataDir, out)
+            jobs.append((costs[pathway] * samples, c))
         elif not publicParadigm:
             for b in range(buckets):
                 pbid = "%s_b%i_%i" % (pid, b, buckets)
                 out = "outputFiles/" + pbid + "_output.fa"
-                c = "%s -p %s -c config.txt -b %s/ -o %s -s %i,%i\n" % \
+                c = "%s -p %s -c config.txt -b %s/ -o %s -s %i,%i" % \
                     (paradigmExec, p, dataDir, out, b, buckets)
-                jfile.write(c)
+                jobs.append((costs[pathway] * samples / buckets, c))
         else:
             publicBatchFix = True
             buckets = samples
             for b in range(buckets):
                 pbid = "%s_b%i_%i" % (pid, b, buckets)
                 out = "outputFiles/" + pbid + "_output.fa"
-                c = "%s -p %s -c config.txt -b %s/%s_ -o %s\n" % \
+                c = "%s -p %s -c config.txt -b %s/%s_ -o %s" % \
                     (paradigmExec, p, dataDir, pbid, out)
-                jfile.write(c)
+                jobs.append((costs[pathway], c))
         for n in range(1, nullBatches + 1):
             if nullBatchSize == "same":
                 numNullSamples = samples
             else:
                 numNullSamples = nullBatchSize
             buckets = numBuckets(pathway, numNullSamples, 
-                                 timings, targetJobLength)
-            if buckets == 1 and not publicParadigm:
+                                 costs, targetJobLength)
+            bucketCost = costs[pathway] * numNullSamples / buckets
+            if lazyNulls:
+                for b in range(buckets):
+                    if buckets == 1:
+                        pbid = pid
+                    else:
+                        pbid = "%s_b%i_%i" % (pid, b, buckets)
+                    out = "outputFiles/%s_batch_%s_output.fa" % (pbid, str(n))
+                    jobs.append((bucketCost, lazyNullCommand(p, pbid, n, b,
+                                                             buckets, out,
+                                                             evidence)))
+            elif buckets == 1 and not publicParadigm:
                 out = "outputFiles/" + pid + "_batch_" + str(n) + "_output.fa"
-                c = "%s -p %s -c config.txt -b %s/na_batch_%i_ -o %s\n" % \
+                c = "%s -p %s -c config.txt -b %s/na_batch_%i_ -o %s" % \
                     (paradigmExec, p, dataDir, n, out)
-                jfile.write(c)
+                jobs.append((bucketCost, c))
             elif not publicParadigm:
                 for b in range(buckets):
                     pbid = "%s_b%i_%i" % (pid, b, buckets)
                     out = "outputFiles/%s_batch_%s_output.fa" % (pbid, str(n))
                     batch = "%s/na_batch_%i_" % (dataDir, n)
-                    c = "%s -p %s -c config.txt -b %s -o %s -s %i,%i\n" % \
+                    c = "%s -p %s -c config.txt -b %s -o %s -s %i,%i" % \
                         (paradigmExec, p, batch, out, b, buckets)
-                    jfile.write(c)
+                    jobs.append((bucketCost, c))
             else:
                 publicBatchFix = True
                 buckets = numNullSamples
@@ -493,10 +607,10 @@ def prepareParadigm(args):
                     pbid = "%s_b%i_%i" % (pid, b, buckets)
                     out = "outputFiles/%s_batch_%s_output.fa" % (pbid, str(n))
                     batch = "%s/%s_na_batch_%i_" % (dataDir, pbid, n)
-                    c = "%s -p %s -c config.txt -b %s -o %s\n" % \
+                    c = "%s -p %s -c config.txt -b %s -o %s" % \
                         (paradigmExec, p, batch, out)
-                    jfile.write(c)
-    jfile.close()
+                    jobs.append((costs[pathway], c))
+    writeJobList("jobs.list", jobs)
     
     if len(paramFile) > 0:
         writeBaseParamsFile("params0.txt", evidence, storedParams = readParams(paramFile))
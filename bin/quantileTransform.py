@@ -5,12 +5,21 @@ import time
 import array
 import csv
 import math
+import os
+import shutil
+import tempfile
 import ctypes
 import ctypes.util
+import numpy as np
 
 libc = ctypes.cdll.LoadLibrary(ctypes.util.find_library("c"))
 
 verbose = False;
+engine = "numpy"
+writeBlockCols = 256
+memoryLimit = 512 # megabytes, for the external engine
+tempDir = None
+bytesPerCell = 64 # rough peak cost of one text cell while parsing/formatting
 
 def usage(code=0):
     print "quantileTransform.py: rank transform an evidence file for Paradigm"
@@ -20,6 +29,11 @@ def usage(code=0):
     print "Options:"
     print "  -r int   number of header rows"
     print "  -c int   number of header columns "
+    print "  -e str   rank engine: numpy (default) or reference, the original"
+    print "           pure python/qsort path kept for diffing outputs, or"
+    print "           external, which sorts on disk for matrices larger than RAM"
+    print "  -m int   megabytes of memory the external engine may use (default 512)"
+    print "  -T dir   directory for the external engine's temporary files"
     print "  -v       print progress reports to stderr"
     if (code != None):
         sys.exit(code)
@@ -55,7 +69,11 @@ def csort(buf):
     libc.qsort( ctypes.cast(addr, ctypes.POINTER(ctypes.c_float)), count, ctypes.sizeof(ctypes.c_float), cmp_float)     
 
 
-def transformFile(fh, sep="\t"):
+def transformFileReference(fh, sep="\t"):
+    """
+    The original rank transform, sorting with qsort and ranking through a
+    float keyed dict.  Kept so the numpy engine can be diffed against it.
+    """
     startTime = time.time()
     log("reading file...")
     
@@ -125,9 +143,250 @@ def transformFile(fh, sep="\t"):
     log("wrote transposed matrix")
     printElapsed(startTime)
 
+def parseValues(vals):
+    """
+    Converts a row of strings to float32, returning the row and the number
+    of cells that parsed.  Cells that don't parse become nan.
+    """
+    try:
+        return (np.array(vals, dtype=np.float32), len(vals))
+    except ValueError:
+        fvals = np.empty(len(vals), dtype=np.float32)
+        parsed = 0
+        for i, val in enumerate(vals):
+            try:
+                fvals[i] = float(val)
+                parsed += 1
+            except ValueError:
+                fvals[i] = np.nan
+        return (fvals, parsed)
+
+def readMatrix(fh, sep="\t"):
+    """
+    Reads the evidence matrix into a rows x columns float32 array
+    """
+    cols = None
+    rows = []
+    data = []
+    totalValues = 0
+    reader = csv.reader(fh, delimiter=sep)
+    for row in reader:
+        if cols is None:
+            cols = row[1:]
+            numCols = len(cols)
+        else:
+            rows.append(row[0])
+            assert(len(row)-1 == numCols)
+            (fvals, parsed) = parseValues(row[1:])
+            data.append(fvals)
+            totalValues += parsed
+    if cols is None:
+        cols = []
+    if len(data) > 0:
+        values = np.vstack(data)
+    else:
+        values = np.empty((0, len(cols)), dtype=np.float32)
+    return (rows, cols, values, totalValues)
+
+def rankValues(values, totalValues):
+    """
+    Rank transforms every cell of values against all non-nan values.  Tied
+    values all receive the rank of the last of the ties in sorted order,
+    matching the reference engine; nan cells stay nan.
+    """
+    flat = values.ravel()
+    present = ~np.isnan(flat)
+    presentValues = flat[present]
+    order = np.argsort(presentValues, kind="mergesort")
+    sortedValues = presentValues[order]
+    ranks = np.empty(flat.shape, dtype=np.float64)
+    ranks.fill(np.nan)
+    ranks[present] = (np.searchsorted(sortedValues, presentValues,
+                                      side="right") - 1) / float(totalValues)
+    return ranks.reshape(values.shape)
+
+def formatRanks(ranks):
+    """
+    Formats a block of ranks with "%5g", writing NA for missing values
+    """
+    strings = np.char.mod("%5g", ranks)
+    strings[np.isnan(ranks)] = "NA"
+    return strings
+
+def writeRankLines(out, labels, ranks, sep="\t"):
+    """
+    Writes one output line per row of ranks, prefixed by its label
+    """
+    block = formatRanks(ranks)
+    lines = []
+    for j in range(len(labels)):
+        lines.append("%s%s%s\n" % (labels[j], sep, sep.join(block[j])))
+    out.write("".join(lines))
+
+def writeTransposed(out, rows, cols, ranks, sep="\t"):
+    """
+    Writes the transpose of ranks a block of output lines at a time
+    """
+    out.write("samples%s%s\n" % (sep, sep.join(rows)))
+    for start in range(0, len(cols), writeBlockCols):
+        stop = min(start + writeBlockCols, len(cols))
+        writeRankLines(out, cols[start:stop],
+                       np.ascontiguousarray(ranks[:, start:stop].T), sep)
+
+def transformFile(fh, sep="\t"):
+    startTime = time.time()
+    log("reading file...")
+
+    (rows, cols, values, totalValues) = readMatrix(fh, sep)
+    numRows = len(rows)
+    numCols = len(cols)
+    if (numRows == 0):
+        print "Empty input"
+        exit(10)
+
+    log("read %i rows %i columns" % (numRows, numCols))
+    printElapsed(startTime)
+
+    if totalValues == 0:
+        assert False, "did not read any values"
+    log("%f%% missing data\n" % (100 - 100*float(totalValues)
+                      / ((numRows) * (numCols))))
+    printElapsed(startTime)
+
+    log("sorting float values...")
+    ranks = rankValues(values, totalValues)
+    log("rank transformed all data\n")
+    printElapsed(startTime)
+
+    writeTransposed(sys.stdout, rows, cols, ranks, sep)
+    log("wrote transposed matrix")
+    printElapsed(startTime)
+
+def mergeRuns(runFiles, outFile, bufferValues):
+    """
+    k-way merges sorted float32 run files into outFile, holding at most
+    about bufferValues values in memory.  Each round takes the next block
+    of every run, emits everything up to the smallest block maximum and
+    advances the runs past what was emitted.
+    """
+    runs = [np.memmap(f, dtype=np.float32, mode="r") for f in runFiles]
+    positions = [0] * len(runs)
+    blockValues = max(1, bufferValues / (len(runs) + 1))
+    out = open(outFile, "wb")
+    while True:
+        active = [i for i in range(len(runs)) if positions[i] < len(runs[i])]
+        if len(active) == 0:
+            break
+        blocks = [runs[i][positions[i]:positions[i] + blockValues]
+                  for i in active]
+        bound = min([b[-1] for b in blocks])
+        pieces = []
+        for i, b in zip(active, blocks):
+            n = np.searchsorted(b, bound, side="right")
+            pieces.append(np.array(b[:n]))
+            positions[i] += n
+        merged = np.concatenate(pieces)
+        merged.sort(kind="mergesort")
+        merged.tofile(out)
+    out.close()
+    del runs
+
+def externalTransformFile(fh, sep="\t"):
+    """
+    Rank transforms a matrix that may not fit in memory.  The first pass
+    reads the input in chunks, spilling the parsed matrix and one sorted run
+    of values per chunk to disk.  The runs are merged into a single sorted
+    file, and a second pass ranks and writes the transposed output a block
+    of columns at a time, reading the spilled matrix through a memory map.
+    """
+    startTime = time.time()
+    workDir = tempfile.mkdtemp(prefix="quantileTransform.", dir=tempDir)
+    try:
+        budgetCells = max(1, memoryLimit * 1024 * 1024 / bytesPerCell)
+        matrixFile = os.path.join(workDir, "matrix.f32")
+        sortedFile = os.path.join(workDir, "sorted.f32")
+
+        log("reading file in chunks...")
+        matrixOut = open(matrixFile, "wb")
+        runFiles = []
+        cols = None
+        rows = []
+        chunk = []
+        totalValues = 0
+        def flushChunk():
+            values = np.vstack(chunk)
+            values.tofile(matrixOut)
+            run = values[~np.isnan(values)]
+            if len(run) > 0:
+                run.sort(kind="mergesort")
+                runFile = os.path.join(workDir, "run%i.f32" % len(runFiles))
+                run.tofile(runFile)
+                runFiles.append(runFile)
+            del chunk[:]
+        reader = csv.reader(fh, delimiter=sep)
+        for row in reader:
+            if cols is None:
+                cols = row[1:]
+                numCols = len(cols)
+                chunkRows = max(1, budgetCells / max(1, numCols))
+            else:
+                rows.append(row[0])
+                assert(len(row)-1 == numCols)
+                (fvals, parsed) = parseValues(row[1:])
+                chunk.append(fvals)
+                totalValues += parsed
+                if len(chunk) >= chunkRows:
+                    flushChunk()
+        if len(chunk) > 0:
+            flushChunk()
+        matrixOut.close()
+
+        numRows = len(rows)
+        if (numRows == 0):
+            print "Empty input"
+            exit(10)
+
+        log("read %i rows %i columns into %i sorted runs" % (numRows, numCols,
+                                                             len(runFiles)))
+        printElapsed(startTime)
+
+        if totalValues == 0:
+            assert False, "did not read any values"
+        log("%f%% missing data\n" % (100 - 100*float(totalValues)
+                          / ((numRows) * (numCols))))
+
+        log("merging sorted runs...")
+        mergeRuns(runFiles, sortedFile, budgetCells)
+        for runFile in runFiles:
+            os.unlink(runFile)
+        printElapsed(startTime)
+
+        log("writing transposed ranks...")
+        sortedValues = np.memmap(sortedFile, dtype=np.float32, mode="r")
+        matrix = np.memmap(matrixFile, dtype=np.float32, mode="r",
+                           shape=(numRows, numCols))
+        blockCols = max(1, min(writeBlockCols, budgetCells / numRows))
+        out = sys.stdout
+        out.write("samples%s%s\n" % (sep, sep.join(rows)))
+        for start in range(0, numCols, blockCols):
+            stop = min(start + blockCols, numCols)
+            values = np.ascontiguousarray(matrix[:, start:stop].T)
+            present = ~np.isnan(values)
+            ranks = np.empty(values.shape, dtype=np.float64)
+            ranks.fill(np.nan)
+            ranks[present] = (np.searchsorted(sortedValues, values[present],
+                                              side="right") - 1) \
+                                              / float(totalValues)
+            writeRankLines(out, cols[start:stop], ranks, sep)
+        del matrix, sortedValues
+        log("wrote transposed matrix")
+        printElapsed(startTime)
+    finally:
+        shutil.rmtree(workDir)
+
 def main(argv):
     try:
-        opts, args = getopt.getopt(argv[1:], "v")
+        opts, args = getopt.getopt(argv[1:], "ve:m:T:")
     except getopt.GetoptError, err:
         print str(err)
         usage(2)
@@ -139,14 +398,28 @@ def main(argv):
     else:
         usage(1)
 
-    global verbose
+    global verbose, engine, memoryLimit, tempDir
     for o, a in opts:
         if o == "-v":
             verbose = True;
+        elif o == "-e":
+            engine = a
+        elif o == "-m":
+            memoryLimit = int(a)
+        elif o == "-T":
+            tempDir = a
         else:
             assert False, "unhandled option"
     
-    transformFile(fh)
+    if engine == "numpy":
+        transformFile(fh)
+    elif engine == "reference":
+        transformFileReference(fh)
+    elif engine == "external":
+        externalTransformFile(fh)
+    else:
+        print "Unknown rank engine \"%s\"" % engine
+        usage(1)
 
 if __name__ == "__main__":
     main(sys.argv)
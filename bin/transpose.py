@@ -1,51 +1,48 @@
 #!/usr/bin/env python
+"""
+transpose.py: transposes a tab separated matrix with row and column labels
 
-import string,sys
-import getopt
-import array
-
-if __name__ == "__main__":
+Values are read as floats (NaN where they don't parse) into a float32
+binary intermediate on disk, one row at a time, and the intermediate is
+then memory mapped and written out a band of columns at a time, so the
+matrix doesn't have to fit in memory.
 
-    opts, args = getopt.getopt(sys.argv[1:], "lf")
-    if (len(args))!=2:
-        sys.stderr.write("python transpose.py extractDataIn transposeOut-Paradigm\n")
-        sys.exit(2)
-
-    label_print = True
-    use_float = True
-    for o, a in opts:
-            if o == "-l":
-                label_print = False
-            if o == "-f":
-                use_float = True
+Usage:
+  python transpose.py [options] extractDataIn transposeOut-Paradigm
 
-    fin= open(args[0],'r')
-    if args[1] == "-":
-        fout = sys.stdout
-    else:
-        fout= open(args[1],'w')
+Options:
+   -l         don't print the column labels
+   -m int     megabytes of memory for each band of columns (default 256)
+   -t dir     directory for the intermediate (default: system temp)
+"""
+import string,sys,os
+import getopt
+import tempfile
+import numpy as np
+import iplStore
 
+def writeIntermediate(fin, binary):
+    """
+    Writes the rows of a matrix to a binary file, returning the column
+    labels and the row labels
+    """
     col_label = None
     row_label = []
-    matrix=[]
     for line in fin:
         data = string.split(line.rstrip("\n\r"),'\t')
         if col_label is None:
             col_label = data
         else:
-            if use_float:
-                o = array.array('f')
-                for i in data[1:]:
-                    try:
-                        o.append(float(i))
-                    except ValueError:
-                        o.append(float('nan'))
-            else:
-                o = data[1:]
             row_label.append(data[0])
-            matrix.append(o)
+            iplStore.parseValues(data[1:], len(col_label) - 1).tofile(binary)
+    return (col_label, row_label)
 
-    #header
+def writeTransposed(matrix, col_label, row_label, fout, label_print=True,
+                    memory=256):
+    """
+    Writes the columns of a memory mapped matrix as rows, a band of
+    columns at a time
+    """
     out = []
     if label_print:
         out = [col_label[0]] + row_label
@@ -53,14 +50,62 @@ if __name__ == "__main__":
         out = row_label
     fout.write("\t".join(out) + "\n")
 
-    #body
-    for col in range(1, len(col_label)):
-        out = []
-        if label_print:
-            out.append(col_label[col])
-        for row in matrix:
-            out.append(str(row[col-1]))
-        fout.write("\t".join(out) + "\n")
+    ## each value takes 4 bytes in the band and up to 16 as text
+    band = max(1, int(memory * 1024 * 1024 / (20 * max(1, len(row_label)))))
+    for start in range(0, len(col_label) - 1, band):
+        stop = min(start + band, len(col_label) - 1)
+        block = np.array(matrix[:, start:stop]).T
+        for col in range(start, stop):
+            out = map(str, block[col - start].tolist())
+            if label_print:
+                out = [col_label[col + 1]] + out
+            fout.write("\t".join(out) + "\n")
+
+def transpose(fin, fout, label_print=True, memory=256, temp_dir=None):
+    (handle, binary_name) = tempfile.mkstemp(suffix=".f32", dir=temp_dir)
+    try:
+        binary = os.fdopen(handle, "wb")
+        (col_label, row_label) = writeIntermediate(fin, binary)
+        binary.close()
+        if col_label is None:
+            return
+        if len(row_label) == 0 or len(col_label) == 1:
+            matrix = np.zeros((len(row_label), len(col_label) - 1),
+                              dtype=np.float32)
+        else:
+            matrix = np.memmap(binary_name, dtype=np.float32, mode="r",
+                               shape=(len(row_label), len(col_label) - 1))
+        writeTransposed(matrix, col_label, row_label, fout, label_print,
+                        memory)
+        del matrix
+    finally:
+        os.unlink(binary_name)
+
+if __name__ == "__main__":
+
+    opts, args = getopt.getopt(sys.argv[1:], "lfm:t:")
+    if (len(args))!=2:
+        sys.stderr.write("python transpose.py [-l] [-m megabytes] [-t temp_dir] extractDataIn transposeOut-Paradigm\n")
+        sys.exit(2)
+
+    label_print = True
+    memory = 256
+    temp_dir = None
+    for o, a in opts:
+            if o == "-l":
+                label_print = False
+            if o == "-m":
+                memory = float(a)
+            if o == "-t":
+                temp_dir = a
+
+    fin= open(args[0],'r')
+    if args[1] == "-":
+        fout = sys.stdout
+    else:
+        fout= open(args[1],'w')
+
+    transpose(fin, fout, label_print, memory, temp_dir)
 
     fin.close()
     fout.close()